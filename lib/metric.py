@@ -0,0 +1,52 @@
+# Metrics of pentakill components
+# Each component keeps metric objects and reports them by get_metrics()
+# method, which returns dictionary of metric name and value.
+# All metrics are thread-safe.
+import threading
+
+# Count of events
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+        self.mutex = threading.Lock()
+
+    def add(self, num=1):
+        with self.mutex:
+            self.value += num
+
+    def get(self):
+        return self.value
+
+# Statistics of observed values such as latency in seconds
+# ewma is exponentially weighted moving average with weight 'alpha'
+# for the newest value
+class Average(object):
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.ewma = None
+        self.mutex = threading.Lock()
+
+    def observe(self, value):
+        with self.mutex:
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+            if self.ewma is None:
+                self.ewma = value
+            else:
+                self.ewma += self.alpha * (value - self.ewma)
+
+    def get_ewma(self):
+        return self.ewma
+
+    def get(self):
+        with self.mutex:
+            return {'count': self.count,
+                    'total': self.total,
+                    'avg': self.total / self.count if self.count else None,
+                    'ewma': self.ewma,
+                    'max': self.max}
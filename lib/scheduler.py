@@ -0,0 +1,173 @@
+# Scheduler runs delayed events in one background thread
+# Events are kept in heap ordered by their time, so scheduling and
+# cancelling an event does not create a thread as threading.Timer does.
+# Event is cancelled by the handle returned by schedule() or by its name.
+#
+# Events run one at a time in the scheduler thread, so they must be short.
+# Event which may block, e.g. one making requests to server, should be
+# scheduled with 'blocking' True. It is handed to a pool of worker threads
+# then, not to delay other events. Workers are started as needed up to
+# 'max_workers', so one slow blocking event does not delay the others.
+from pentakill.lib import metric
+import threading
+import collections
+import traceback
+import heapq
+import time
+
+class Scheduler(object):
+    # max_workers : maximum number of threads running blocking events
+    def __init__(self, name='scheduler', max_workers=4):
+        self.name = name
+        self.max_workers = max(max_workers, 1)
+        # heap of events, event is list [time, sequence, method, args,
+        # name, blocking, alive]
+        self.heap = []
+        # alive event by name
+        self.names = {}
+        self.seq = 0
+        self.cond = threading.Condition()
+        # blocking events to be run by workers, tuple (due time, method,
+        # args)
+        self.blocking = collections.deque()
+        self.blocking_cond = threading.Condition()
+        self.thread = None
+        # number of workers and those waiting for event
+        self.workers = 0
+        self.idle = 0
+
+        self.threads_created = metric.Counter()
+        self.scheduled = metric.Counter()
+        self.fired = metric.Counter()
+        self.cancelled = metric.Counter()
+        # time from due time of event to its start, in worker for blocking
+        # event
+        self.lag = metric.Average()
+
+    # Run method(*args) after 'delay' sec and returns handle of event
+    # name : event with the same name which is not run yet is cancelled
+    # blocking : True if method may block
+    def schedule(self, delay, method, args=(), name=None, blocking=False):
+        with self.cond:
+            if name is not None and name in self.names:
+                self._cancel(self.names[name])
+            self.seq += 1
+            event = [time.time() + delay, self.seq, method, args, name,
+                     blocking, True]
+            heapq.heappush(self.heap, event)
+            if name is not None:
+                self.names[name] = event
+            self.scheduled.add()
+            if self.thread is None:
+                self.thread = self._start(self._run)
+            # wake up only if this is the earliest one
+            if self.heap[0] is event:
+                self.cond.notify()
+        return event
+
+    # Cancel event by handle or name
+    # Returns True if event is cancelled before it runs
+    def cancel(self, event):
+        with self.cond:
+            if not isinstance(event, list):
+                event = self.names.get(event)
+                if event is None:
+                    return False
+            if not event[6]:
+                return False
+            self._cancel(event)
+            return True
+
+    # Lock must be held
+    # Cancelled event is left in heap and skipped when it comes out
+    def _cancel(self, event):
+        event[6] = False
+        event[2] = event[3] = None
+        if event[4] is not None and self.names.get(event[4]) is event:
+            del self.names[event[4]]
+        self.cancelled.add()
+
+    def get_pending(self):
+        with self.cond:
+            return sum(1 for event in self.heap if event[6])
+
+    def get_metrics(self):
+        return {'threads_created': self.threads_created.get(),
+                'scheduled': self.scheduled.get(),
+                'fired': self.fired.get(),
+                'cancelled': self.cancelled.get(),
+                'pending': self.get_pending(),
+                'workers': self.workers,
+                'lag': self.lag.get()}
+
+    def _start(self, target):
+        thread = threading.Thread(target=target, name=self.name)
+        thread.daemon = True
+        thread.start()
+        self.threads_created.add()
+        return thread
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while True:
+                    while self.heap and not self.heap[0][6]:
+                        heapq.heappop(self.heap)
+                    if not self.heap:
+                        self.cond.wait()
+                        continue
+                    left = self.heap[0][0] - time.time()
+                    if left <= 0:
+                        break
+                    self.cond.wait(left)
+                event = heapq.heappop(self.heap)
+                event[6] = False
+                if event[4] is not None and self.names.get(event[4]) is event:
+                    del self.names[event[4]]
+                method, args = event[2], event[3]
+                event[2] = event[3] = None
+            self.fired.add()
+            if event[5]:
+                self._hand_over(event[0], method, args)
+            else:
+                self.lag.observe(max(time.time() - event[0], 0.0))
+                self._call(method, args)
+
+    # New worker is started if all are busy and pool is not full
+    def _hand_over(self, due, method, args):
+        with self.blocking_cond:
+            self.blocking.append((due, method, args))
+            if self.idle < len(self.blocking) and self.workers < self.max_workers:
+                self.workers += 1
+                self._start(self._work)
+            else:
+                self.blocking_cond.notify()
+
+    def _work(self):
+        while True:
+            with self.blocking_cond:
+                self.idle += 1
+                while not self.blocking:
+                    self.blocking_cond.wait()
+                self.idle -= 1
+                due, method, args = self.blocking.popleft()
+            self.lag.observe(max(time.time() - due, 0.0))
+            self._call(method, args)
+
+    # Error of event should not stop scheduler
+    def _call(self, method, args):
+        try:
+            method(*args)
+        except Exception:
+            traceback.print_exc()
+
+# Scheduler shared in process
+_default = None
+_default_mutex = threading.Lock()
+
+def get_scheduler():
+    global _default
+    with _default_mutex:
+        if _default is None:
+            _default = Scheduler()
+        return _default
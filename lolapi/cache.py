@@ -0,0 +1,112 @@
+# Pentakill response cache 1.0
+#
+# Responses of API calls which change slowly are kept for time to live
+# (TTL) of the call, so the same call in the meantime does not use quota.
+# Cache is bounded by bytes of responses and least recently used ones are
+# evicted first. Size of response is measured by length of its JSON.
+#
+# After TTL, response is still served as stale for 'stale_time' sec. The
+# first get of stale response tells caller to fetch it again (revalidate)
+# and put new one, the others just get stale one meanwhile. If it fails,
+# caller calls fail_revalidate() so that next get tells it again.
+
+from pentakill.lib import metric
+import threading
+import collections
+import json
+import time
+
+class ResponseCache(object):
+    # max_bytes : maximum total size of responses kept
+    # stale_time : time in second stale response is served after TTL
+    def __init__(self, max_bytes, stale_time=0.0):
+        self.max_bytes = max_bytes
+        self.stale_time = stale_time
+        # key -> [value, size, expire time, revalidating]
+        # the most recently used one is at the end
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.mutex = threading.Lock()
+
+        self.hits = metric.Counter()
+        self.stale_hits = metric.Counter()
+        self.misses = metric.Counter()
+        self.evictions = metric.Counter()
+
+    # Returns None if 'key' is not cached or too old, otherwise tuple
+    # (value, revalidate). 'revalidate' is True for the first get of
+    # stale value, then caller is expected to put new value.
+    def get(self, key, now=None):
+        now = now or time.time()
+        with self.mutex:
+            try:
+                entry = self.entries.get(key)
+            except TypeError:
+                # unhashable key can't be cached
+                return None
+            if entry is not None and now >= entry[2] + self.stale_time:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses.add()
+                return None
+            self.entries.move_to_end(key)
+            if now < entry[2]:
+                self.hits.add()
+                return (entry[0], False)
+            self.stale_hits.add()
+            revalidate = not entry[3]
+            entry[3] = True
+            return (entry[0], revalidate)
+
+    # Keep 'value' for 'ttl' sec
+    # Value larger than max_bytes is not kept
+    def put(self, key, value, ttl, now=None):
+        now = now or time.time()
+        try:
+            hash(key)
+            size = len(json.dumps(value))
+        except (TypeError, ValueError):
+            return
+        if size > self.max_bytes:
+            return
+        with self.mutex:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = [value, size, now + ttl, False]
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions.add()
+
+    # Let stale value of 'key' be revalidated again by next get, when
+    # revalidation failed
+    def fail_revalidate(self, key):
+        with self.mutex:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry[3] = False
+
+    def clear(self):
+        with self.mutex:
+            self.entries.clear()
+            self.bytes = 0
+
+    def get_metrics(self):
+        hits = self.hits.get() + self.stale_hits.get()
+        total = hits + self.misses.get()
+        with self.mutex:
+            entries, used = len(self.entries), self.bytes
+        return {'entries': entries,
+                'bytes': used,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits.get(),
+                'stale_hits': self.stale_hits.get(),
+                'misses': self.misses.get(),
+                'hit_ratio': float(hits) / total if total else None,
+                'evictions': self.evictions.get()}
+
+    # Lock must be held
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.bytes -= entry[1]
@@ -68,6 +68,21 @@ If you don't want to include, leave it to empty string
 '''
 C_USER_AGENT = 'Pentakill League of Legends API 1.0'
 
+'''
+Connection pool
+
+POOL_ON: If True, LOLAPI borrows connections from pool shared by
+         all LOLAPI objects in the process instead of owning them
+POOL_MAX_SIZE: maximum number of connections per host
+POOL_IDLE_TIMEOUT: idle connection is closed after this time in second
+                   It should be shorter than keep-alive timeout of server
+POOL_REAP_INTERVAL: interval in second of closing idle connections
+'''
+POOL_ON = True
+POOL_MAX_SIZE = 10
+POOL_IDLE_TIMEOUT = 30.0
+POOL_REAP_INTERVAL = 5.0
+
 '''
 Default key
 
@@ -78,6 +93,16 @@ If you don't give key when initialize, this key is used.
 '''
 KEY = 'RGAPI-a15deef5-19e9-40f5-80c1-64943be30bfc'
 
+'''
+Keys used by LOLFastAPI
+
+If more than one key is given, requests are spread over keys.
+KEY_RECHECK_INTERVAL: interval in second of checking a key which is
+                      out of rotation due to error such as 401
+'''
+KEYS = [KEY]
+KEY_RECHECK_INTERVAL = 30.0
+
 
 '''
 Default request number per time
@@ -85,6 +110,18 @@ form : tuple (req number, per time in sec)
 '''
 LIMIT = (10, 10.0)
 
+'''
+Request number limits applied at the same time
+form : list of tuple (req number, per time in sec), shortest one first
+'''
+LIMITS = [LIMIT, (500, 600.0)]
+
+'''
+Time in second to wait after limit exceeded response
+which does not have Retry-After header
+'''
+RETRY_AFTER_DEFAULT = 1.0
+
 
 '''
 Season: Default season setting
@@ -105,6 +142,20 @@ Default number of core
 '''
 CORE_NUM = 5
 
+'''
+Core dispatch
+Each core sends one request at a time, so request waits for requests 
+dispatched to its core before.
+D_ROUND_ROBIN  : requests go to cores in turn
+D_LEAST_LOADED : request goes to idle core, or to core with the lowest
+                 estimated completion time if none is idle. Estimate is
+                 number of requests of core times moving average of its
+                 latency, plus time its current request is overdue.
+'''
+D_ROUND_ROBIN = 'round_robin'
+D_LEAST_LOADED = 'least_loaded'
+CORE_DISPATCH = D_LEAST_LOADED
+
 '''
 Status api and static api initialize
 '''
@@ -138,6 +189,23 @@ CONT_ERROR_SET2_NAME = 'api_error'
 CONT_ERROR_SET2_TUPLE1_ERRORS = ['timeout', 'error']
 CONT_ERROR_SET2_TUPLE1_THRESH = 3
 
+'''
+Circuit breakers
+When BREAKER_ON, errors in a row above (CONT_ERROR_*) open circuit breaker
+of the method instead of moving LOLAdmin to service unavailable state, 
+so only requests of that method fail fast. Critical errors still move 
+LOLAdmin to service unavailable state.
+Breaker opens after BREAKER_THRESHOLD failures in a row and lets a probe
+request through after backoff, which starts from BREAKER_BACKOFF sec and
+is doubled for each failed probe up to BREAKER_MAX_BACKOFF. Probe is the
+first request of the method after backoff passes, other requests of the
+method fail fast until the probe is responded.
+'''
+BREAKER_ON = True
+BREAKER_THRESHOLD = 3
+BREAKER_BACKOFF = 1.0
+BREAKER_MAX_BACKOFF = 60.0
+
 '''
 LOLFastAPI configuration
 '''
@@ -163,6 +231,121 @@ user is required to specify appropriate floating number value in second
 '''
 KEEP_ALIVE_INTERVAL = 12.0
 
+'''
+Keep alive mode
+How servants keep connections with server alive while idle
+
+KA_REQUEST   : send test request every KEEP_ALIVE_INTERVAL, it uses quota
+KA_TCP       : TCP keep-alive probes on pooled sockets every 
+               KEEP_ALIVE_INTERVAL, it keeps connection through NAT and
+               firewall but server may still close idle connection
+KA_RECONNECT : pool keeps KEEP_ALIVE_MIN_IDLE connections ready and
+               replaces them with new ones before they get idle for
+               POOL_IDLE_TIMEOUT, with TCP keep-alive probes as well.
+               TLS session is resumed, so it is cheap
+KA_TCP and KA_RECONNECT need connection pool on (POOL_ON), and they do 
+not use quota.
+'''
+KA_REQUEST = 'request'
+KA_TCP = 'tcp'
+KA_RECONNECT = 'reconnect'
+KEEP_ALIVE_MODE = KA_RECONNECT
+KEEP_ALIVE_MIN_IDLE = 2
+
+'''
+Priority classes
+Minimum share of requests reserved for each priority class of 
+lolfastapi (interactive, normal, background). Higher class is served 
+first unless lower one with waiting requests got less than its share.
+Served counts are multiplied by PRIORITY_SHARE_DECAY for every request 
+so that only recent requests are counted.
+'''
+PRIORITY_SHARES = (0.5, 0.2, 0.1)
+PRIORITY_SHARE_DECAY = 0.98
+# Servant skips requests whose method rate limit bucket (METHOD_LIMITS)
+# is full, looking at up to this number of requests of each class
+QUEUE_SCAN_DEPTH = 64
+
+'''
+Batching
+Single id requests to methods in BATCH_MAX_IDS made at about the same
+time are merged into one request with comma separated ids. Batch is 
+sent when BATCH_WINDOW seconds have passed since its first id or when
+it has maximum number of ids the method accepts.
+'''
+BATCH_ON = True
+BATCH_WINDOW = 0.02
+BATCH_MAX_IDS = {'get_summoners_by_ids': 40,
+                 'get_league_entries': 10}
+
+'''
+Deduplication
+Request identical to one in flight (same method and arguments) is not 
+sent again, it gets the response of the one in flight.
+'''
+DEDUP_ON = True
+
+'''
+Response cache
+Responses of methods in CACHE_TTL (and get_static_* methods) are cached
+for TTL in second by method and arguments. After TTL, stale response is 
+served for CACHE_STALE_TIME more while it's requested again in background.
+Total size of cached responses (as JSON) is bounded by CACHE_MAX_BYTES.
+'''
+CACHE_ON = True
+CACHE_MAX_BYTES = 32 * 1024 * 1024
+CACHE_STALE_TIME = 300.0
+CACHE_TTL = {'get_league_entries': 300.0,
+             'get_rank_stats': 600.0,
+             'get_stats_summary': 600.0,
+             'get_summoner_runes': 1800.0,
+             'get_summoner_masteries': 1800.0}
+CACHE_STATIC_TTL = 86400.0
+
+'''
+Static data store
+Static data (champions, items, runes, masteries) of a data dragon version
+is written once to a file in STATIC_STORE_DIR, which is shared by all
+processes and memory-mapped at startup. It's written again only when
+get_versions reports new version, which is checked at start of multiple
+get mode and then every STATIC_REFRESH_INTERVAL sec (None to check only
+at start).
+If STATIC_STORE_DIR is None, 'pentakill-static' in temporary directory
+is used.
+'''
+STATIC_STORE_ON = True
+STATIC_STORE_DIR = None
+STATIC_REFRESH_INTERVAL = 3600.0
+
+'''
+Adaptive concurrency
+When CONCURRENCY_ON, number of active servants and cores of LOLFastAPI 
+is changed at runtime every CONCURRENCY_INTERVAL sec between 
+CONCURRENCY_MIN and CONCURRENCY_MAX, starting from SERVANT_NUM.
+Number needed to use all quota is quota rate times average latency times
+CONCURRENCY_HEADROOM (Little's law). The number is
+- multiplied by CONCURRENCY_DECREASE if more than CONCURRENCY_LIMITED_RATIO
+  of responses are 429
+- decreased by one if more than CONCURRENCY_GATE_RATIO of requests waited
+  for permit and it's more than needed
+- increased by half of difference to needed number (at least one) if
+  requests are queued and it's less than needed
+'''
+CONCURRENCY_ON = True
+CONCURRENCY_INTERVAL = 1.0
+CONCURRENCY_MIN = 1
+CONCURRENCY_MAX = 50
+CONCURRENCY_DECREASE = 0.5
+CONCURRENCY_LIMITED_RATIO = 0.01
+CONCURRENCY_GATE_RATIO = 0.5
+CONCURRENCY_HEADROOM = 1.2
+
+'''
+asyncio backend
+Maximum number of connections of LOLAsyncAPI for each host
+'''
+ASYNC_CONNECTIONS = 50
+
 
 '''
 Constants for api version
@@ -257,10 +440,14 @@ P_STATUS_SHARD_BY_REGION = '/shards/{region}'
 # Match
 # match information by match id
 P_MATCH = '/api/lol/{region}/v{version}/match/{matchId}'
+# method rate limits of match
+L_MATCH = [(500, 10.0)]
 
 # Match list
 # match list by summoner id
 P_MATCH_LIST = '/api/lol/{region}/v{version}/matchlist/by-summoner/{summonerId}'
+# method rate limits of match list
+L_MATCH_LIST = [(500, 10.0)]
 
 # Stats
 # ranked game stats by summoner id
@@ -284,4 +471,17 @@ P_SUMMONER_RUNES = '/api/lol/{region}/v{version}/summoner/{summonerIds}/runes'
 # rank team information by summoner ids
 P_TEAMS_BY_SUMMONER_IDS = '/api/lol/{region}/v{version}/team/by-summoner/{summonerIds}'
 # rank team information by team ids
-P_TEAMS_BY_TEAM_IDS = '/api/lol/{region}/v{version}/team/{teamIds}'
\ No newline at end of file
+P_TEAMS_BY_TEAM_IDS = '/api/lol/{region}/v{version}/team/{teamIds}'
+
+'''
+Method rate limits
+Server limits requests of each method on top of application limit 
+(LIMITS). Permit is given only if both application limit and bucket of 
+the method have room.
+form : API method name -> tuple (bucket name, limits), methods with the
+       same bucket name share the bucket
+Limits are corrected by X-Method-Rate-Limit headers, and a method not here
+gets its bucket when server reports its limits.
+'''
+METHOD_LIMITS = {'get_match': ('match', L_MATCH),
+                 'get_match_history': ('matchlist', L_MATCH_LIST)}
\ No newline at end of file
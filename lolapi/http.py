@@ -8,6 +8,8 @@
 import socket, ssl, urllib.parse
 import time
 import zlib
+import io
+import threading
 
 '''
 One connection obeject can serve one request at one time. There are six states
@@ -61,6 +63,8 @@ S_SECOND_REQ_SENT = 5
 #Other constants
 C_TBUFSIZE = 8
 C_BUFSIZE = 1024
+# Size of receive buffer of connection
+C_RBUFSIZE = 16384
 
 '''
 IP constants
@@ -72,6 +76,60 @@ IPV64 = -2
 
 _SUPPORTED_ENCODING = ['identity', 'gzip', 'deflate', 'zlib']
 
+'''
+Timing hooks
+
+Hook is function called as hook(event, conn, elapsed) where event is one of 
+T_* constants, conn is HTTP object and elapsed is time taken in second.
+T_CONNECT   : TCP connection is made
+T_HANDSHAKE : TLS handshake is done, conn.sock.session_reused tells 
+              whether TLS session was resumed
+T_REQUEST   : response headers are read, elapsed is from sending request
+Hooks are called in the thread using connection, so they must be fast
+and must not raise exception.
+'''
+T_CONNECT = 'connect'
+T_HANDSHAKE = 'handshake'
+T_REQUEST = 'request'
+
+_timing_hooks = []
+
+def add_timing_hook(hook):
+    _timing_hooks.append(hook)
+    
+def remove_timing_hook(hook):
+    _timing_hooks.remove(hook)
+    
+def _call_timing_hooks(event, conn, elapsed):
+    for hook in _timing_hooks:
+        hook(event, conn, elapsed)
+        
+'''
+TLS context and sessions
+
+One SSL context is shared by all HTTPS connections in the process, and
+the last TLS session of each (host, port) is kept with its context so that
+new connection to the host resumes the session instead of full handshake.
+'''
+_ssl_context = None
+_ssl_sessions = {}
+_ssl_mutex = threading.Lock()
+
+def _get_ssl_context():
+    global _ssl_context
+    with _ssl_mutex:
+        if _ssl_context is None:
+            _ssl_context = ssl.create_default_context()
+        return _ssl_context
+    
+# Replace shared context, e.g. to trust another CA
+# Sessions made with previous context are forgotten
+def set_ssl_context(context):
+    global _ssl_context
+    with _ssl_mutex:
+        _ssl_context = context
+        _ssl_sessions.clear()
+
 class HTTP(object):
     # host : string representation of ipv4 address or host domain
     # port : integer value (default 80)
@@ -96,6 +154,9 @@ class HTTP(object):
         
         self.sock = None
         self._response = None
+        self._sent_time = None
+        # receive buffer, it is kept during keep-alive connection
+        self.reader = _SocketReader()
         
         self._debug = 0
         
@@ -196,6 +257,7 @@ class HTTP(object):
         if self.sock is None:
             self.connect()
             
+        self._sent_time = time.time()
         first_loop = True
         while True:
             try:
@@ -250,6 +312,7 @@ class HTTP(object):
             self.sock.settimeout(self.timeout)
             
         for ip in self.ips:
+            begin = time.time()
             try:
                 self.sock.connect((ip, self.port))
             except socket.error:
@@ -259,6 +322,7 @@ class HTTP(object):
                     continue             
                 raise SSLError(str(err), E_SSL_ERROR)
             else:
+                _call_timing_hooks(T_CONNECT, self, time.time() - begin)
                 return
             
         raise ConnectionFailure('failed to connect to host', E_CONN_FAILURE)
@@ -295,6 +359,7 @@ class HTTP(object):
             self.sendRequest()
             response = HTTPResponse(self, self.sock, self.timeout, self._debug)
         self._response = response
+        _call_timing_hooks(T_REQUEST, self, time.time() - self._sent_time)
         
         self.state = S_MSG_READ
         
@@ -305,6 +370,7 @@ class HTTP(object):
         if self.sock:
             self.sock.close()
             self.sock = None
+        self.reader.attach(None)
         if self._response:
             self._response.close()
             self._response = None
@@ -315,6 +381,85 @@ class HTTP(object):
     def debugMode(self, mode):
         self._debug = int(mode)
     
+# Receive buffer of connection shared by reading status line, headers and
+# body. It receives with recv_into() in large size, and bytes received
+# beyond current response remain for next response on keep-alive connection.
+# Socket errors are not handled here, HTTPResponse converts them.
+class _SocketReader(object):
+    def __init__(self, size=C_RBUFSIZE):
+        self.sock = None
+        # bytes in buf[start:end] are received but not read yet
+        # a line up to C_BUFSIZE must fit in it
+        self.buf = bytearray(max(size, C_BUFSIZE))
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+        
+    # Bytes buffered from previous socket are discarded
+    def attach(self, sock):
+        self.sock = sock
+        self.start = self.end = 0
+        
+    # Returns number of bytes received, 0 if connection is closed
+    def _fill(self):
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buf):
+            # move unread bytes to the front
+            left = self.end - self.start
+            self.view[:left] = self.view[self.start:self.end]
+            self.start, self.end = 0, left
+        read = self.sock.recv_into(self.view[self.end:])
+        self.end += read
+        return read
+    
+    def _take(self, size):
+        data = bytes(self.view[self.start:self.start + size])
+        self.start += size
+        return data
+        
+    # Returns line including newline, but at most 'size' bytes
+    # Returns bytes left without newline when connection is closed
+    def readline(self, size=C_BUFSIZE):
+        scanned = 0
+        while True:
+            idx = self.buf.find(b'\n', self.start + scanned, 
+                                min(self.end, self.start + size))
+            if idx >= 0:
+                return self._take(idx + 1 - self.start)
+            scanned = self.end - self.start
+            if scanned >= size:
+                return self._take(size)
+            if not self._fill():
+                return self._take(scanned)
+            
+    # Returns at most 'size' bytes, buffered bytes are returned first
+    # If size is None, returns whatever is available
+    def read(self, size=None):
+        if self.start == self.end:
+            self._fill()
+        left = self.end - self.start
+        if size is None or size < 0 or size > left:
+            size = left
+        return self._take(size)
+    
+    # Returns bytearray with exactly 'size' bytes, bytes which are not
+    # in buffer are received directly into it
+    def readexact(self, size):
+        data = bytearray(size)
+        view = memoryview(data)
+        cnt = min(size, self.end - self.start)
+        view[:cnt] = self.view[self.start:self.start + cnt]
+        self.start += cnt
+        while cnt < size:
+            read = self.sock.recv_into(view[cnt:])
+            if not read:
+                raise IncompleteRead('Incomplete read',
+                                     E_INCOMPLETE_READ)
+            cnt += read
+            
+        return data
+    
 class HTTPResponse(object):
     
     def __init__(self, conn, sock, timeout=None, debug=0):
@@ -322,6 +467,10 @@ class HTTPResponse(object):
         self.conn = conn
         self.sock = sock
         self.fp = None
+        # buffer of connection survives across responses of same socket
+        self.reader = conn.reader
+        if self.reader.sock is not sock:
+            self.reader.attach(sock)
         #self.fp = sock.makefile('rb', 0)
             
         self.timeout = timeout
@@ -347,33 +496,12 @@ class HTTPResponse(object):
         
         self._read_headers()
         
-    # slow readline function (two times when read 4k byte)
-    # it is better to use readline() method of file object
-    # returned by makefile() method. but if timeouts, data read by 
-    # makefile() method till now is gone so we should start connection again.
-    # but if we use this, we do not have to. call it again and again  << Only in buffered mode
+    # Reading through buffer of connection, not makefile() since
+    # data read by file object is gone when it timeouts
     # Python document states file-like socket object should not have a timeout
-    def _readline(self, size=C_BUFSIZE):
-        bbuf = []
-        cnt = 0
-        
-        while 1:
-            c = self.sock.recv(1)
-            if len(c) == 0:
-                break
-            
-            bbuf.append(c)
-            cnt += 1
-            
-            if c == b'\n' or cnt == size:
-                break
-        
-        return b''.join(bbuf)
-        
-    def _freadline(self):
+    def _sock_call(self, func, *args):
         try:
-            return self._readline()
-            #return self.fp.readline(1024)
+            return func(*args)
         except socket.timeout as err:
             raise Timeout(str(err), E_TIMEOUT)
         except (socket.error, ssl.SSLError) as err:
@@ -383,19 +511,14 @@ class HTTPResponse(object):
                 raise Timeout(str(err), E_TIMEOUT)
             raise Error(str(err), E_UNKNOWN)
         
-    # if size is not given, it reads all the content until EOF.
+    def _freadline(self):
+        return self._sock_call(self.reader.readline, C_BUFSIZE)
+        
+    # if size is not given, it reads what is available now.
     # it may not read string with size 'size', to get safely, use _safe_read().
     # it raises error when timeouts.
     def _fread(self, size=-1):
-        try:
-            return self.sock.recv(size)
-            #return self.fp.read(size)
-        except socket.timeout as err:
-            raise Timeout(str(err), E_TIMEOUT)
-        except (socket.error, ssl.SSLError) as err:
-            if 'timed out' in str(err):
-                raise Timeout(str(err), E_TIMEOUT)
-            raise Error(str(err), E_UNKNOWN)
+        return self._sock_call(self.reader.read, size)
         
     def _read_status(self):
         header = self._freadline().decode('utf8')
@@ -582,8 +705,10 @@ class HTTPResponse(object):
         return content
     
     def _chunked_read(self):
-        chunks = []
-        
+        return b''.join(self._iter_chunks())
+    
+    # Yields each chunk as it is received
+    def _iter_chunks(self):
         while True:
             line = self._freadline()
             
@@ -609,7 +734,7 @@ class HTTPResponse(object):
             chunk = self._safe_read(chunk_size)
             # read CRLF in the end of chunk
             self._safe_read(2)
-            chunks.append(chunk)
+            yield chunk
             
         # read trailers and last CRLF
         # This version, we assume that we don't have any trailer
@@ -625,41 +750,62 @@ class HTTPResponse(object):
             
         # we read whole message
         self.close()
-        return b''.join(chunks)
     
     # it can fail to read all content with size 'size', it could
     # happen when EOF occurs or interrupt is caught. Then it raises error
     # it only returns when all the data has been read
+    # returned content is bytearray
     def _safe_read(self, size=0):
-        #if not self.fp:
-        #    raise SocketClosed('response is closed',
-        #                       E_SOCKET_CLOSED)
-        reads = []
-        while True:
-            read = self._fread(size)
-            if not read:
-                raise IncompleteRead('Incomplete read',
-                                     E_INCOMPLETE_READ)
-            size -= len(read)
-            reads.append(read)
-            if not size:
-                break
-            
-        return b''.join(reads)
+        return self._sock_call(self.reader.readexact, size)
     
-    # it reads all response and decompress texts (gzip)
+    # it yields body in segments as they are received, each chunk for
+    # chunked message, and what is received at once for content-length
+    # response is closed after whole message is read
     # if there is no content-length and response is not chunked,
-    # we don't know the whole message so you should use decompress() method
-    def readDecompress(self):
+    # we don't know the end of message, so it raises error
+    def iterRead(self):
         if self.trsencoding == 'chunked':
-            content = self._chunked_read()
+            yield from self._iter_chunks()
         elif self.length != None:
-            content = self.read()
+            while self.length:
+                segment = self._fread(min(self.length, C_RBUFSIZE))
+                if not segment:
+                    raise IncompleteRead('Incomplete read',
+                                         E_INCOMPLETE_READ)
+                self.length -= len(segment)
+                yield segment
+            self.close()
         else:
             raise InvalidUseException('can\'t read segment of compressed text'
                                       , E_INVALID_USE)
         
-        return self.decompress(content)
+    # it yields decompressed body, each segment is decompressed as soon as
+    # it is received so compressed body is never kept as a whole
+    def iterDecompress(self):
+        decomp = BodyDecompressor(self.encoding)
+        for segment in self.iterRead():
+            content = decomp.decompress(segment)
+            if content:
+                yield content
+        content = decomp.flush()
+        if content:
+            yield content
+    
+    # it reads all response and decompress texts (gzip)
+    # if there is no content-length and response is not chunked,
+    # we don't know the whole message so you should use decompress() method
+    # returned content is bytearray
+    def readDecompress(self):
+        content = bytearray()
+        for segment in self.iterDecompress():
+            content += segment
+        
+        return content
+    
+    # it returns file-like object reading decompressed body, 
+    # which can be given to a parser reading incrementally
+    def getStream(self):
+        return _BodyStream(self.iterDecompress())
         
     # after reading all response, if it is compressed you can use this to
     # decompress
@@ -709,7 +855,69 @@ class HTTPResponse(object):
     def getVersion(self):
         return self.version
    
+# Decompressor of body in content 'encoding', which takes body segment by
+# segment. Body which is not compressed is given back as it is.
+# It's shared by readers of response, e.g. asyncio backend of lolapi.
+class BodyDecompressor(object):
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == 'gzip':
+            self.decomp = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        elif encoding == 'deflate':
+            self.decomp = zlib.decompressobj(-zlib.MAX_WBITS)
+        elif encoding == 'zlib':
+            self.decomp = zlib.decompressobj(zlib.MAX_WBITS)
+        else:
+            self.decomp = None
+            
+    # returns decompressed part of 'segment', may be empty
+    def decompress(self, segment):
+        if self.decomp is None:
+            return segment
+        try:
+            return self.decomp.decompress(segment)
+        except zlib.error as err:
+            raise DecompressFail(str(err), E_DECOMPRESS_FAIL)
+        
+    # returns the rest after the last segment
+    # raises DecompressFail if compressed data is incomplete
+    def flush(self):
+        if self.decomp is None:
+            return b''
+        try:
+            content = self.decomp.flush()
+        except zlib.error as err:
+            raise DecompressFail(str(err), E_DECOMPRESS_FAIL)
+        if not self.decomp.eof:
+            raise DecompressFail('compressed data is incomplete',
+                                 E_DECOMPRESS_FAIL)
+        return content
+    
+# Raw file-like object over segments of response body
+class _BodyStream(io.RawIOBase):
+    def __init__(self, segments):
+        self.segments = segments
+        self.segment = b''
+        self.pos = 0
+        
+    def readable(self):
+        return True
+    
+    def readinto(self, b):
+        while self.pos == len(self.segment):
+            try:
+                self.segment = next(self.segments)
+            except StopIteration:
+                return 0
+            self.pos = 0
+            
+        size = min(len(b), len(self.segment) - self.pos)
+        b[:size] = memoryview(self.segment)[self.pos:self.pos + size]
+        self.pos += size
+        return size
+    
 # SSL wrapper for HTTP connection
+# Server certificate and host name are verified by shared context
 class HTTPS(HTTP):
     def __init__(self, host, port, timeout=None):
         HTTP.__init__(self, host, port, timeout)
@@ -718,10 +926,39 @@ class HTTPS(HTTP):
         # now only ipv4 socket is supported
         HTTP.connect(self)
         
+        context = _get_ssl_context()
+        with _ssl_mutex:
+            saved = _ssl_sessions.get((self.host, self.port))
+        # session can be resumed only by context which made it
+        session = saved[1] if saved and saved[0] is context else None
+        
+        begin = time.time()
         try:
-            self.sock = ssl.wrap_socket(self.sock, None, None)
-        except ssl.SSLError as err:
+            self.sock = context.wrap_socket(self.sock, server_hostname=self.host,
+                                            session=session)
+        except socket.timeout as err:
+            self.sock.close()
+            self.sock = None
+            raise Timeout('handshake timeout', E_TIMEOUT)
+        except (ssl.SSLError, ssl.CertificateError) as err:
+            self.sock.close()
+            self.sock = None
             raise SSLError(str(err), E_SSL_ERROR)
+        _call_timing_hooks(T_HANDSHAKE, self, time.time() - begin)
+        
+    # TLS 1.3 server sends session ticket after handshake, so session is
+    # saved after response has come
+    def getResponse(self):
+        response = HTTP.getResponse(self)
+        self._save_session()
+        return response
+    
+    def _save_session(self):
+        if self.sock is None or self.sock.session is None:
+            return
+        with _ssl_mutex:
+            _ssl_sessions[(self.host, self.port)] = (self.sock.context, 
+                                                     self.sock.session)
         
 '''
 Exceptions
@@ -12,10 +12,16 @@
 # it will initialize automatically.
 #
 # after you do all the things, you must close the connection.
+#
+# If connection pool is on (POOL_ON in config), connections are not owned
+# by LOLAPI object but borrowed from pool shared in the process for each
+# request.
 
 from pentakill.lolapi import http
+from pentakill.lolapi import pool
 from pentakill.lolapi.config import *
 import json
+import time
 
 '''
 states
@@ -33,7 +39,7 @@ H_STATUS = 3
 class LOLAPI(object):
     def __init__(self, host=None, port=None, key=None, region=None, platform=None, timeout=None
                  , static_host=None, static_port=None, status_host=None, status_port=None
-                , season=None):
+                , season=None, pooled=None):
         
         self.key = key or KEY
         self.region = region or REGION
@@ -56,6 +62,16 @@ class LOLAPI(object):
         
         self.season = season or SEASON
         
+        # connection pools by type when connection pool is on
+        self.pooled = POOL_ON if pooled is None else pooled
+        self.pools = {}
+        
+        # tuple (status tuple, headers) of last response
+        # header names are in lower case
+        self.last_response = None
+        # time in second last request waited for connection of pool
+        self.last_pool_wait = 0.0
+        
         self.debugMode = 0
         
         self.states = {H_MAIN:S_IDLE,
@@ -67,8 +83,11 @@ class LOLAPI(object):
             raise NotClosed('close connection before you do init', E_NOT_CLOSED)
         
         try:
-            if not self.main_conn:
-                self.main_conn = http.HTTPS(self.host, self.port, timeout=self.timeout)
+            cls, host, port = self._get_endpoint(H_MAIN)
+            if self.pooled:
+                self.pools[H_MAIN] = pool.get_pool(cls, host, port, self.timeout)
+            elif not self.main_conn:
+                self.main_conn = cls(host, port, timeout=self.timeout)
         except Exception:
             raise InitializationFail('init failed', E_INITIALIZATION_FAIL)
         
@@ -79,8 +98,11 @@ class LOLAPI(object):
             raise NotClosed('close connection before you do init', E_NOT_CLOSED)
         
         try:
-            if not self.status_conn:
-                self.status_conn = http.HTTP(self.status_host, self.status_port, timeout=self.timeout)
+            cls, host, port = self._get_endpoint(H_STATUS)
+            if self.pooled:
+                self.pools[H_STATUS] = pool.get_pool(cls, host, port, self.timeout)
+            elif not self.status_conn:
+                self.status_conn = cls(host, port, timeout=self.timeout)
         except Exception:
             raise InitializationFail('init failed', E_INITIALIZATION_FAIL)            
         
@@ -91,8 +113,11 @@ class LOLAPI(object):
             raise NotClosed('close connection before you do init', E_NOT_CLOSED)
         
         try:
-            if not self.static_conn:
-                self.static_conn = http.HTTPS(self.static_host, self.static_port, timeout=self.timeout)
+            cls, host, port = self._get_endpoint(H_STATIC)
+            if self.pooled:
+                self.pools[H_STATIC] = pool.get_pool(cls, host, port, self.timeout)
+            elif not self.static_conn:
+                self.static_conn = cls(host, port, timeout=self.timeout)
         except Exception:
             raise InitializationFail('init failed', E_INITIALIZATION_FAIL)            
         
@@ -126,6 +151,17 @@ class LOLAPI(object):
             self.close()
             raise err
         
+    # Returns tuple (connection class, host, port) of connection type 'type'
+    # connection class is http.HTTPS or http.HTTP
+    def _get_endpoint(self, type):
+        if type == H_MAIN:
+            return (http.HTTPS, self.host, self.port)
+        elif type == H_STATIC:
+            return (http.HTTPS, self.static_host, self.static_port)
+        elif type == H_STATUS:
+            return (http.HTTP, self.status_host, self.status_port)
+        raise UnknownType('unknown connection type', E_UNKNOWN_TYPE)
+    
     # get connection of type 'type'
     def _get_conn(self, type):
         if type == H_MAIN:
@@ -151,10 +187,12 @@ class LOLAPI(object):
         except KeyError:
             raise UnknownType('unknown connection type', E_UNKNOWN_TYPE)
         
-    def _set_headers(self, type, method='GET', loc='/'):
+    # conn : connection borrowed from pool, if not given, connection
+    #        of type 'type' is used
+    def _set_headers(self, type, method='GET', loc='/', conn=None):
         self._check_status(type, S_CONNECTED, 'connection not made')
 
-        conn = self._get_conn(type)
+        conn = conn or self._get_conn(type)
         conn.setRequest(method, loc)
         
         # set headers
@@ -176,18 +214,24 @@ class LOLAPI(object):
         if self.main_conn:
             self.main_conn.close()
             self.main_conn = None
+        # shared pool is not closed, just forget it
+        self.pools.pop(H_MAIN, None)
         self.states[H_MAIN] = S_IDLE
         
     def close_static(self):
         if self.static_conn:
             self.static_conn.close()
             self.static_conn = None
+        # shared pool is not closed, just forget it
+        self.pools.pop(H_STATIC, None)
         self.states[H_STATIC] = S_IDLE
         
     def close_status(self):
         if self.status_conn:
             self.status_conn.close()
             self.status_conn = None
+        # shared pool is not closed, just forget it
+        self.pools.pop(H_STATUS, None)
         self.states[H_STATUS] = S_IDLE
         
     def close(self):
@@ -210,33 +254,67 @@ class LOLAPI(object):
         if self.debugMode:
             print('Debug mode (%s): %s' % (name, msg))
         
+    # Returns tuple (status tuple, headers) of last response, e.g. to read
+    # rate limit headers. Header names are in lower case.
+    # Returns None if last request did not get response
+    def get_last_response(self):
+        return self.last_response
+    
+    # Returns time in second last request waited for connection of pool,
+    # which is not time taken by server
+    def get_last_pool_wait(self):
+        return self.last_pool_wait
+        
     def _send_request(self, type, loc):
         self._debug_print('Reuqest path', loc)
-            
-        conn = self._get_conn(type)
-        if self.states[type] != S_CONNECTED or conn == None:
-            self._close_type(type)
-            self._init_type(type)
-            
-        self._set_headers(type=type, loc=loc)
+        self.last_response = None
+        self.last_pool_wait = 0.0
+        
+        conn_pool = self.pools.get(type) if self.pooled else None
+        if conn_pool is None:
+            conn = self._get_conn(type)
+            if self.states[type] != S_CONNECTED or conn == None:
+                self._close_type(type)
+                self._init_type(type)
+                conn = self._get_conn(type)
+                conn_pool = self.pools.get(type)
+        
+        if conn_pool is None:
+            self._set_headers(type=type, loc=loc)
+        else:
+            conn = None
         try:
+            if conn_pool is not None:
+                begin = time.time()
+                try:
+                    conn = conn_pool.acquire()
+                finally:
+                    self.last_pool_wait = time.time() - begin
+                self._set_headers(type=type, loc=loc, conn=conn)
             conn.sendRequest()
             
             msg = conn.getResponse()
             status = msg.getStatus()
+            headers = msg.getHeaders()
+            self.last_response = (status, dict((key.lower(), headers[key])
+                                               for key in headers))
         
             try:
-                content = msg.readDecompress().decode('utf8')
+                body = msg.readDecompress()
                 #print msg.getHeaders()
-            # let's parse json string into python dictionary
             except http.InvalidUseException as err:
                 raise HTTPFail(str(err), E_HTTP)
                 
         except Exception as err:
-            # re-initialize faulty connection
-            # it should never raise exception
-            self._close_type(type)
-            self._init_type(type)
+            if conn_pool is not None:
+                # faulty connection is closed by pool
+                if conn is not None:
+                    conn_pool.release(conn, False)
+            else:
+                # re-initialize faulty connection
+                # it should never raise exception
+                self._close_type(type)
+                self._init_type(type)
             
             import traceback
             traceback.print_exc()
@@ -244,20 +322,18 @@ class LOLAPI(object):
             
             try:
                 raise err
+            except pool.PoolExhausted as err:
+                raise PoolExhausted(str(err), E_POOL_EXHAUSTED)
             except http.Timeout as err:
                 raise Timeout(str(err), E_TIMEOUT)
             except http.Error as err:
                 raise HTTPFail(str(err), E_HTTP)
         else:
-            try:
-                if content:
-                    content = json.loads(content)
-            except ValueError:
-                # not json content, just return it
-                #raise JSONParseFail('wrong json string', E_JSON_FAIL)       
-                pass
+            content = parse_content(body)
         # message must be closed
         msg.close()
+        if conn_pool is not None:
+            conn_pool.release(conn)
             
         return (status, content)
     
@@ -478,6 +554,50 @@ class LOLAPI(object):
             args['itemListData'] = item_list_data
         return self._set_and_request(H_STATIC, P_ITEMS, patharg, args)
     
+    # get list of mastery data
+    # Options : 
+    # locale
+    # version
+    # mastery_list_data = Tags to return additional data.
+    def get_static_masteries(self, locale=None, version=None, mastery_list_data=None):
+        patharg = {'region':self.region,
+                   'version':V_STATIC}
+        
+        args = {'api_key':self.key}
+        if locale != None:
+            args['locale'] = locale
+        if version != None:
+            args['version'] = version
+        if mastery_list_data != None:
+            args['masteryListData'] = mastery_list_data
+        return self._set_and_request(H_STATIC, P_MASTERY, patharg, args)
+    
+    # get list of rune data
+    # Options : 
+    # locale
+    # version
+    # rune_list_data = Tags to return additional data.
+    def get_static_runes(self, locale=None, version=None, rune_list_data=None):
+        patharg = {'region':self.region,
+                   'version':V_STATIC}
+        
+        args = {'api_key':self.key}
+        if locale != None:
+            args['locale'] = locale
+        if version != None:
+            args['version'] = version
+        if rune_list_data != None:
+            args['runeListData'] = rune_list_data
+        return self._set_and_request(H_STATIC, P_RUNE, patharg, args)
+    
+    # get list of data dragon versions, the latest one first
+    def get_versions(self):
+        patharg = {'region':self.region,
+                   'version':V_STATIC}
+        
+        args = {'api_key':self.key}
+        return self._set_and_request(H_STATIC, P_VERSIONS, patharg, args)
+    
     # ###############################################################
     #                       LOL-STATUS
     #      Requests to this API do not consume your rate limit
@@ -659,6 +779,20 @@ class LOLAPI(object):
         args = {'api_key':self.key}
         return self._set_and_request(H_MAIN, P_TEAMS_BY_TEAM_IDS, patharg, args)
     
+# Returns content of decompressed response 'body'
+# let's parse json string into python dictionary, other content is
+# returned as string
+def parse_content(body):
+    content = body.decode('utf8')
+    try:
+        if content:
+            content = json.loads(content)
+    except ValueError:
+        # not json content, just return it
+        #raise JSONParseFail('wrong json string', E_JSON_FAIL)
+        pass
+    return content
+
 
 '''
 errno
@@ -672,6 +806,7 @@ E_HTTP = 4
 E_INVALID_USE = 5
 E_UNKNOWN_TYPE = 6
 E_INITIALIZATION_FAIL = 7
+E_POOL_EXHAUSTED = 8
 
 class Error(Exception):
     def __init__(self, msg, errno=None):
@@ -706,6 +841,10 @@ class UnknownType(Error):
 class InitializationFail(Error):
     pass
 
+# No connection of pool is left, request is not sent
+class PoolExhausted(Error):
+    pass
+
 # tests
 if __name__ == '__maing__':
     import time 
@@ -0,0 +1,517 @@
+# Pentakill asyncio fast lol API
+#
+# LOLAsyncAPI is a backend of LOLFastAPI which drives many connections
+# from one asyncio event loop with non-blocking sockets, in place of
+# servant threads each of which blocks on a LOLCore connection.
+# Concurrency is bounded by number of connections (ASYNC_CONNECTIONS in
+# config) rather than number of threads.
+#
+# Requests go through the same priority queue, batching, deduplication
+# and cache of LOLFastAPI, and FastRequest/FastResponse are used in the
+# same way, so it can be used in place of LOLFastAPI. Event loop runs in
+# its own thread, so callers in any thread can use it. Asyncio callers
+# can await results with get_data_async() and get_multiple_data_async().
+#
+# Request paths are made by methods of LOLAPI (or compatible one), only
+# sending is done here. It uses one key, keys other than the first one
+# are not used. Method rate limit buckets (METHOD_LIMITS in config) and
+# circuit breakers are those of LOLAdmin of the key, so they are reported
+# by get_metrics() in the same way.
+
+from pentakill.lolapi import lolapi
+from pentakill.lolapi import lolfastapi
+from pentakill.lolapi import config
+from pentakill.lolapi import http
+from pentakill.lolapi.lolfastapi import (FastRequest, FastResponse, PR_NORMAL,
+                                         FS_OK, FS_TIMEOUT, FS_ERROR,
+                                         FS_SERVICE_UNAVAILABLE, FS_CANCELLED)
+import threading
+import asyncio
+import time
+
+class LOLAsyncAPI(lolfastapi.LOLFastAPI):
+    # connections : maximum number of connections for each host
+    #               (default ASYNC_CONNECTIONS in config)
+    # other arguments are same as LOLFastAPI
+    def __init__(self, connections=None, limit=None, key=None, api=None,
+                 keys=None):
+        lolfastapi.LOLFastAPI.__init__(self, 1, limit, key, 1, api, keys)
+        self.connections = connections or config.ASYNC_CONNECTIONS
+        self.limiter = lolfastapi._RateLimiter(self.spec['limits'])
+        # LOLAdmin of the key, which has method buckets and breakers
+        # Its buckets are guarded by its perm_condition since they may be
+        # read in other threads.
+        self.key_admin = self.admin
+        if isinstance(self.admin, lolfastapi.LOLKeyManager):
+            self.key_admin = self.admin.admins[0]
+        self.per_time = self.limiter.limits[0][1]
+        # permits go by priority class like LOLAdmin
+        self.share = lolfastapi._PriorityShare()
+        self.waiting = [0] * len(self.share.shares)
+        # connections are limited by 'connections', not by servants
+        self.controller = None
+
+        # API object which makes request path of API methods
+        self.builder = _make_builder(self.api, self.key)
+        self.timeout = self.builder.timeout
+
+        self.loop = None
+        self.thread = None
+        # futures of coroutines waiting for permit or request
+        self.permit_waits = []
+        self.idle_workers = []
+        self.workers = []
+        # idle connections and number of connections for each type
+        self.idle = {}
+        self.conn_num = {}
+        self.conn_sema = {}
+
+        self.debug = False
+
+    # Start event loop thread and workers
+    def start_multiple_get_mode(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+        if self.static:
+            self.static.open()
+            self.refresh_static()
+            self._start_static_refresh()
+
+    def close_multiple_get_mode(self):
+        if self.loop is None:
+            return
+        self._stop_static_refresh()
+        asyncio.run_coroutine_threadsafe(self._close(), self.loop).result(60)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(60)
+        self.loop.close()
+        self.loop = None
+        self.thread = None
+
+    async def _start(self):
+        for i in range(self.connections):
+            self.workers.append(self.loop.create_task(self._work()))
+
+    async def _close(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        self.idle_workers = []
+        for type in self.idle:
+            for reader, writer in self.idle[type]:
+                writer.close()
+            self.idle[type] = []
+            self.conn_num[type] = 0
+
+    # Requests are put in queue in event loop thread
+    def _push_requests(self, priority, get_tups):
+        self.loop.call_soon_threadsafe(self._dispatch, priority, get_tups)
+
+    # Queue is used only in event loop thread
+    def _promote(self, flight, priority):
+        self.loop.call_soon_threadsafe(self._move_flight, flight, priority)
+
+    # Requests of bundle are not reserved, they go in order one by one
+    def _push_bundle(self, priority, get_tups, batches):
+        self._push_requests(priority, get_tups)
+        for target, method, args in batches:
+            self.batcher.add(target[0], target[1], method, args, priority)
+
+    def _dispatch(self, priority, get_tups):
+        for get_tup in get_tups:
+            self.queue.push(priority, get_tup)
+            if self.idle_workers:
+                _set_done(self.idle_workers.pop())
+
+    # Worker takes requests from queue like servant
+    async def _work(self):
+        while True:
+            try:
+                get_tup = self.queue.pop(self._is_ready)
+            except IndexError:
+                waiter = self.loop.create_future()
+                self.idle_workers.append(waiter)
+                await waiter
+                continue
+            await self._serve_get(get_tup)
+
+    # Returns False if method bucket of request is known to be full
+    def _is_ready(self, get_tup):
+        try:
+            method = get_tup[1][1][1][0]
+        except (IndexError, TypeError):
+            return True
+        return self.key_admin.is_method_ready(method)
+
+    async def _serve_get(self, get_tup):
+        res, (name, (method, args)), priority = get_tup[1]
+        if self._drop_request(res, name):
+            return
+        try:
+            result = await self._get_data(method, args, priority)
+        except lolapi.Timeout as err:
+            res_tup = (FS_TIMEOUT, str(err))
+        except lolfastapi.CircuitOpenError as err:
+            # only this method is unavailable
+            res_tup = (FS_SERVICE_UNAVAILABLE, str(err))
+        except Exception as err:
+            res_tup = (FS_ERROR, str(err))
+        else:
+            res_tup = (FS_OK, result)
+            if not isinstance(res, lolfastapi._BatchResponse):
+                self._cache_result(method, args, result)
+        res.add_response(name, res_tup)
+
+    # Coroutine returning tuple (status tuple, data) of one request
+    # If circuit breaker of 'method' is open, it raises CircuitOpenError.
+    # Errors count for circuit breaker as in LOLAdmin. Timeout and other
+    # errors of LOLAPI, which core of LOLAdmin raises as TimeoutError and
+    # InternalError, are failures. Request not sent has no result.
+    # Note : it must run in event loop of this object, use get_data_async()
+    #        in other loops
+    async def _get_data(self, method, args, priority=PR_NORMAL):
+        type, loc = method(self.builder, *args)
+        breaker = self.key_admin._get_breaker(method)
+        if breaker is not None and not breaker.allow(time.time()):
+            raise lolfastapi.CircuitOpenError("Circuit of %s is open" %
+                                              (breaker.name,))
+        try:
+            status, content = await self._send_request(method, type, loc,
+                                                       priority)
+        except lolapi.PoolExhausted:
+            # not sent, no result
+            if breaker is not None:
+                breaker.abort()
+            raise
+        except (lolapi.Timeout, lolapi.Error):
+            if breaker is not None:
+                self.key_admin._breaker_fail(breaker)
+            raise
+        except BaseException:
+            # no result, e.g. cancelled on close
+            if breaker is not None:
+                breaker.abort()
+            raise
+        if breaker is not None:
+            if status[0] in config.CONT_ERROR_SET1_TUPLE1_ERRORS:
+                self.key_admin._breaker_fail(breaker)
+            elif breaker.succeed():
+                self._debug_msg('circuit of %s closed' % (breaker.name,))
+        return (status, content)
+
+    # Send request again while limit is exceeded
+    async def _send_request(self, method, type, loc, priority):
+        while True:
+            # bucket may be made by response of retried request
+            bucket = self.key_admin._get_bucket(method)
+            await self._get_permission(priority, bucket)
+            try:
+                status, headers, content = await self._request(type, loc)
+            except BaseException:
+                self._finish_request(method, bucket, None)
+                raise
+            self._finish_request(method, bucket, (status, headers))
+            if status[0] != config.SC_LIMIT_EXCEEDED:
+                return (status, content)
+
+    # Wait for permit of limiter and method 'bucket', higher class goes
+    # first. Request waiting for its bucket does not hold turn of its
+    # class like core of LOLAdmin.
+    async def _get_permission(self, priority, bucket=None):
+        counted = False
+        try:
+            while True:
+                wait = self._get_bucket_wait(bucket)
+                if wait is not None:
+                    if counted:
+                        self.waiting[priority] -= 1
+                        counted = False
+                        self._wake_permit()
+                    await self._wait_permit(wait)
+                    continue
+                if not counted:
+                    self.waiting[priority] += 1
+                    counted = True
+                if not self._is_turn(priority):
+                    await self._wait_permit(self.per_time)
+                    continue
+                if self.limiter.acquire():
+                    if bucket is not None:
+                        with self.key_admin.perm_condition:
+                            bucket.acquire()
+                    self.share.serve(priority)
+                    return
+                wait = self.limiter.get_next_refill()
+                await self._wait_permit(self.per_time if wait is None else wait)
+        finally:
+            if counted:
+                self.waiting[priority] -= 1
+                self._wake_permit()
+
+    # Returns time in second to wait for room in 'bucket', None if it has
+    def _get_bucket_wait(self, bucket):
+        if bucket is None:
+            return None
+        with self.key_admin.perm_condition:
+            if bucket.get_left() > 0:
+                return None
+            wait = bucket.get_next_refill()
+            wait = self.per_time if wait is None else wait
+            bucket.refill_at = time.time() + wait
+            return wait
+
+    def _is_turn(self, priority):
+        classes = [c for c, num in enumerate(self.waiting) if num > 0]
+        return self.share.choose(classes) == priority
+
+    async def _wait_permit(self, timeout):
+        waiter = self.loop.create_future()
+        self.permit_waits.append(waiter)
+        await asyncio.wait([waiter], timeout=timeout)
+        if not waiter.done():
+            self.permit_waits.remove(waiter)
+
+    def _wake_permit(self):
+        waits, self.permit_waits = self.permit_waits, []
+        for waiter in waits:
+            _set_done(waiter)
+
+    # response : tuple (status tuple, headers), or None if no response
+    # Limit exceeded of method type blocks only the bucket of 'method'.
+    def _finish_request(self, method, bucket, response):
+        now = time.time()
+        self.limiter.release(now)
+        if bucket is not None:
+            with self.key_admin.perm_condition:
+                bucket.release(now)
+        if response is not None:
+            status_code, headers = response[0][0], response[1]
+            self.limiter.correct_by_headers(headers, now)
+            with self.key_admin.perm_condition:
+                bucket = self._correct_bucket(method, bucket, headers, now)
+                if status_code == config.SC_LIMIT_EXCEEDED:
+                    limit_type = headers.get('x-rate-limit-type')
+                    if limit_type == 'method' and bucket is not None:
+                        retry = bucket.block_by_headers(headers, now)
+                    else:
+                        retry = self.limiter.block_by_headers(headers, now)
+                    self._debug_msg('limit exceeded (%s), retry after %s sec' %
+                                    (limit_type, retry))
+        self._wake_permit()
+
+    # Correct bucket of 'method' by headers, returns the bucket
+    # Server may tell limits of method not in METHOD_LIMITS, then bucket
+    # is made for it in LOLAdmin of the key.
+    # Note : perm_condition of key_admin must be acquired
+    def _correct_bucket(self, method, bucket, headers, now):
+        if bucket is None:
+            limits = lolfastapi._parse_rate_header(
+                headers.get('x-method-rate-limit'))
+            if not limits:
+                return None
+            bucket = lolfastapi._RateLimiter(limits, 'x-method-rate-limit')
+            self.key_admin.buckets[method.__name__] = bucket
+        bucket.correct_by_headers(headers, now)
+        return bucket
+
+    # Send request and returns tuple (status tuple, headers, content)
+    # Idle connection may have been closed by server, then request is
+    # sent again once with new connection
+    async def _request(self, type, loc):
+        for trial in range(2):
+            conn, reused = await self._acquire(type)
+            try:
+                response = await asyncio.wait_for(
+                    self._send(type, conn, loc), self.timeout)
+            except asyncio.TimeoutError:
+                self._discard(type, conn)
+                raise lolapi.Timeout('request timeout', lolapi.E_TIMEOUT)
+            except (OSError, EOFError, asyncio.IncompleteReadError) as err:
+                self._discard(type, conn)
+                if reused and trial == 0:
+                    continue
+                raise lolapi.HTTPFail(str(err), lolapi.E_HTTP)
+            except Exception:
+                self._discard(type, conn)
+                raise
+            status, headers, content, keep = response
+            if keep:
+                self._release(type, conn)
+            else:
+                self._discard(type, conn)
+            return (status, headers, content)
+
+    async def _send(self, type, conn, loc):
+        reader, writer = conn
+        cls, host, port = self.builder._get_endpoint(type)
+        lines = ['GET %s HTTP/1.1' % (loc,),
+                 'Host: %s' % (host,),
+                 'Connection: %s' % (config.C_CONNECTION or 'keep-alive',),
+                 'Accept: %s' % (config.C_ACCEPT or 'application/json',),
+                 'Accept-Encoding: %s' % (config.C_ACCEPT_ENCODING or 'gzip',)]
+        if config.C_USER_AGENT:
+            lines.append('User-Agent: %s' % (config.C_USER_AGENT,))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('utf8'))
+        await writer.drain()
+        return await _read_response(reader)
+
+    # Returns tuple (connection, reused)
+    async def _acquire(self, type):
+        if not type in self.conn_sema:
+            self.conn_sema[type] = asyncio.Semaphore(self.connections)
+            self.idle[type] = []
+            self.conn_num[type] = 0
+        await self.conn_sema[type].acquire()
+        idle = self.idle[type]
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return ((reader, writer), True)
+            writer.close()
+            self.conn_num[type] -= 1
+        try:
+            cls, host, port = self.builder._get_endpoint(type)
+            ssl = http._get_ssl_context() if issubclass(cls, http.HTTPS) else None
+            conn = await asyncio.wait_for(asyncio.open_connection(
+                host, port, ssl=ssl, server_hostname=host if ssl else None),
+                self.timeout)
+        except Exception as err:
+            self.conn_sema[type].release()
+            if isinstance(err, asyncio.TimeoutError):
+                raise lolapi.Timeout('connect timeout', lolapi.E_TIMEOUT)
+            raise lolapi.HTTPFail(str(err), lolapi.E_HTTP)
+        self.conn_num[type] += 1
+        return (conn, False)
+
+    def _release(self, type, conn):
+        self.idle[type].append(conn)
+        self.conn_sema[type].release()
+
+    def _discard(self, type, conn):
+        conn[1].close()
+        self.conn_num[type] -= 1
+        self.conn_sema[type].release()
+
+    # Coroutine for asyncio callers in any event loop
+    # Returns FastResponse which has got all responses
+    async def get_multiple_data_async(self, fast_req):
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        res = _AwaitableResponse(fast_req.get_request_num(),
+                                 fast_req.get_deadline(), loop, done)
+        self._get_multiple_data(fast_req, res)
+        if res.responded_all():
+            _set_done(done)
+        await done
+        return res
+
+    # Coroutine for asyncio callers in any event loop
+    # Returns tuple (status tuple, data) of one request
+    # Raises TimeoutError or InternalError if request failed
+    async def get_data_async(self, method, args, priority=PR_NORMAL,
+                             deadline=None):
+        req = FastRequest(priority, deadline)
+        req.add_request_name('data', (method, args))
+        res = await self.get_multiple_data_async(req)
+        status, data = res.get_response('data')
+        if status == FS_OK:
+            return data
+        elif status in (FS_TIMEOUT, FS_CANCELLED):
+            raise lolfastapi.TimeoutError(str(data))
+        raise lolfastapi.InternalError(str(data))
+
+    def get_metrics(self):
+        r = lolfastapi.LOLFastAPI.get_metrics(self)
+        r['connections'] = dict(self.conn_num)
+        return r
+
+    def set_debug(self, level):
+        self.debug = level
+
+    def _debug_msg(self, msg):
+        if self.debug:
+            print('debug :', msg)
+
+# FastResponse which completes future of asyncio caller
+# Future may belong to another event loop, so it's done thread-safely
+class _AwaitableResponse(FastResponse):
+    def __init__(self, req_num, deadline, loop, done):
+        FastResponse.__init__(self, req_num, deadline)
+        self.loop = loop
+        self.done = done
+
+    def add_response(self, name, tuple):
+        FastResponse.add_response(self, name, tuple)
+        if self.responded_all():
+            self.loop.call_soon_threadsafe(_set_done, self.done)
+
+def _set_done(future):
+    if not future.done():
+        future.set_result(None)
+
+# Returns API object whose methods return tuple (type, path) of request
+# instead of sending it
+def _make_builder(api, key):
+    class Builder(api):
+        def _send_request(self, type, loc):
+            return (type, loc)
+    builder = Builder(key=key)
+    for type in builder.states:
+        builder.states[type] = lolapi.S_CONNECTED
+    return builder
+
+# Read HTTP response
+# Returns tuple (status tuple, headers, content, keep alive)
+# Header names are in lower case. Content is parsed if it's JSON.
+async def _read_response(reader):
+    line = await reader.readline()
+    if not line:
+        raise EOFError('connection closed')
+    parts = line.decode('latin1').rstrip('\r\n').split(' ', 2)
+    if len(parts) < 2:
+        raise lolapi.HTTPFail('invalid status line', lolapi.E_HTTP)
+    status = (parts[1], parts[2] if len(parts) > 2 else '')
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, sep, value = line.decode('latin1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    keep = headers.get('connection', '').lower() != 'close'
+    # each segment is decompressed as soon as it is received like http
+    decomp = http.BodyDecompressor(headers.get('content-encoding', '').lower())
+    body = bytearray()
+    try:
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    break
+                body += decomp.decompress(await reader.readexactly(size))
+                await reader.readexactly(2)
+            # trailer
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+        elif 'content-length' in headers:
+            left = int(headers['content-length'])
+            while left:
+                segment = await reader.readexactly(min(left, http.C_RBUFSIZE))
+                left -= len(segment)
+                body += decomp.decompress(segment)
+        else:
+            body += decomp.decompress(await reader.read())
+            keep = False
+        body += decomp.flush()
+    except http.DecompressFail as err:
+        raise lolapi.HTTPFail(str(err), lolapi.E_HTTP)
+    except ValueError as err:
+        # invalid size, which http reports as its error too
+        raise lolapi.HTTPFail('invalid response (%s)' % (err,), lolapi.E_HTTP)
+    return (status, headers, lolapi.parse_content(body), keep)
@@ -29,11 +29,18 @@
 
 from pentakill.lolapi import lolapi
 from pentakill.lolapi import config
+from pentakill.lolapi import pool
+from pentakill.lolapi import cache
+from pentakill.lolapi import static_store
 from pentakill.db import connector
 from pentakill.lib import servant
+from pentakill.lib import metric
+from pentakill.lib import scheduler
 import threading
+import itertools
+import math
 import time
-import copy
+import collections
 
 '''
 default API
@@ -71,26 +78,209 @@ substate of S_OK
 There's no specified rule for substate regarding events
 '''
 SS_OK = 0
-SS_SYNCHRONIZING = 1
+
+'''
+Request priority classes
+
+Lower class is served first by servants and by permits of LOLAdmin,
+but each class is guaranteed its minimum share in PRIORITY_SHARES
+of config, so lower ones are never starved completely.
+'''
+PR_INTERACTIVE = 0      # user is waiting for the result
+PR_NORMAL = 1
+PR_BACKGROUND = 2       # bulk crawls, keep alive requests
 
 # LOLKeyManager is in charge of managing multiple keys
-## it is not implemented yet
+# It has one LOLAdmin for each key and provides same interface as LOLAdmin,
+# so it can be used in place of LOLAdmin to get throughput of all keys.
+# Each request goes to the available key with most requests left.
+# If a key gets into service unavailable state (e.g. 401 for expired key),
+# only the key is taken out of rotation and it is checked periodically
+# to come back. It gets into service unavailable state only if all keys are.
 class LOLKeyManager(object):
     # keys : list of key which is represented by string
     # cores : core number which each admin will have
-    def __init__(self, keys, cores=4):
-        self.keys = keys
-        self.core_num = cores
-        if self.core_num <= 0:
-            self.core_num = 1
+    # limit, api : same as LOLAdmin, applied to each admin
+    def __init__(self, keys, cores=None, limit=None, api=None):
+        self.keys = list(keys)
+        if not self.keys:
+            raise InvalidUseError("No key is given")
+        self.admins = [LOLAdmin(limit, key, cores, api) for key in self.keys]
+        self.core_num = self.admins[0].core_num
+        
+        # timer for checking keys out of rotation
+        self.timer = _TimerEventManager()
+        self.debug = False
+        
+    def get_spec(self):
+        specs = [admin.get_spec() for admin in self.admins]
+        r = {}
+        r['key'] = self.keys
+        r['req_num'] = sum(spec['req_num'] for spec in specs)
+        r['per_time'] = specs[0]['per_time']
+        r['limits'] = specs[0]['limits']
+        r['core_num'] = sum(spec['core_num'] for spec in specs)
+        r['key_num'] = len(self.keys)
+        return r
+    
+    # Sum of rate status of available keys
+    def get_rate_status(self):
+        r = {'left': 0, 'next_refill': None, 'inflight': 0, 'available': 0}
+        for admin in self.admins:
+            if not admin.is_available():
+                continue
+            status = admin.get_rate_status()
+            r['available'] += 1
+            r['left'] += status['left']
+            r['inflight'] += status['inflight']
+            refill = status['next_refill']
+            if refill is not None and (r['next_refill'] is None or
+                                       refill < r['next_refill']):
+                r['next_refill'] = refill
+        return r
+    
+    # Status of cores of all keys
+    def get_core_status(self):
+        return [status for admin in self.admins 
+                for status in admin.get_core_status()]
+    
+    # Status of circuit breakers of all keys
+    def get_breaker_status(self):
+        return [status for admin in self.admins 
+                for status in admin.get_breaker_status()]
+    
+    # Status of method rate limit buckets of all keys
+    def get_bucket_status(self):
+        return [status for admin in self.admins 
+                for status in admin.get_bucket_status()]
+    
+    # Sum of load of all keys, rate is of available keys
+    def get_load(self):
+        r = {'permits': 0, 'waited': 0, 'limited': 0, 'latency': (0, 0.0),
+             'rate': 0.0}
+        for admin in self.admins:
+            load = admin.get_load()
+            for name in ('permits', 'waited', 'limited'):
+                r[name] += load[name]
+            r['latency'] = (r['latency'][0] + load['latency'][0],
+                            r['latency'][1] + load['latency'][1])
+            if admin.is_available():
+                r['rate'] += load['rate']
+        return r
+    
+    # Cores of all keys are 'num' in total, they are split evenly among keys
+    # Each key has at least one core
+    def set_core_num(self, num):
+        share, rest = divmod(num, len(self.admins))
+        for i, admin in enumerate(self.admins):
+            admin.set_core_num(share + (1 if i < rest else 0))
+    
+    def init(self):
+        for admin in self.admins:
+            admin.init()
+            
+    # Returns available admins, the one with most requests left first
+    # When no request is left for any key, the one refilled first comes first
+    # Keys whose bucket of 'method' is full go last
+    # Key may get out of rotation by its own timer, so check of keys out
+    # of rotation is reserved whenever one is skipped.
+    def _rank_admins(self, method=None):
+        ranks = []
+        for admin in self.admins:
+            if not admin.is_available():
+                self._call_recheck()
+                continue
+            status = admin.get_rate_status()
+            refill = status['next_refill']
+            ranks.append((not admin.is_method_ready(method), -status['left'], 
+                          refill if refill is not None else admin.per_time,
+                          status['inflight'], admin))
+        ranks.sort(key=lambda rank: rank[:4])
+        return [rank[4] for rank in ranks]
+    
+    # Returns False if bucket of 'method' is known to be full in all keys
+    def is_method_ready(self, method):
+        return any(admin.is_method_ready(method) for admin in self.admins)
+        
+    # Same as get_data of LOLAdmin
+    # If chosen key is not available, it tries next one
+    # Request with reservation goes to the key it's reserved in
+    # It raises ServiceUnavailableError if no key is available
+    def get_data(self, method, args, priority=PR_NORMAL, reservation=None):
+        if reservation is not None:
+            return reservation.admin.get_data(method, args, priority, 
+                                              reservation)
+        for admin in self._rank_admins(method):
+            try:
+                return admin.get_data(method, args, priority)
+            except ServiceUnavailableError:
+                self._debug_msg('key out of rotation : %s' % (admin.key,))
+                self._call_recheck()
+                continue
+        
+        self._call_recheck()
+        raise ServiceUnavailableError("Problem with connection to server for all keys")
+    
+    def get_test_data(self):
+        return self.get_data(lolapi.LOLAPI.get_summoners_by_names, 
+                             (b'\xeb\xa8\xb8\xed\x94\xbc93'.decode('utf8'), ),
+                             PR_BACKGROUND)
+    
+    # Same as reserve of LOLAdmin, all permits are reserved in one key
+    def reserve(self, methods, priority=PR_NORMAL, timeout=None):
+        for admin in self._rank_admins():
+            try:
+                return admin.reserve(methods, priority, timeout)
+            except ServiceUnavailableError:
+                continue
+        raise ServiceUnavailableError("Problem with connection to server for all keys")
+        
+    # Check keys in service unavailable state
+    # Returns True if any key is or comes back to be available
+    def check_service_status(self):
+        ret = False
+        for admin in self.admins:
+            if admin.check_service_status():
+                ret = True
+        return ret
+    
+    def _call_recheck(self):
+        return self.timer.reserve_timer('recheck', self._recheck, 
+                                        config.KEY_RECHECK_INTERVAL)
+    
+    # Check keys out of rotation and reserve next check if any is left
+    def _recheck(self, name, id):
+        if not self.timer.start_timer(name, id):
+            return
+        
+        down = False
+        for admin in self.admins:
+            if not admin.check_service_status():
+                down = True
+        
+        self.timer.end_timer(name)
+        if down:
+            self._call_recheck()
+            
+    def set_debug(self, mode):
+        self.debug = mode
+        for admin in self.admins:
+            admin.set_debug(mode)
+            
+    def _debug_msg(self, msg):
+        if self.debug:
+            print('debug :', msg)
 
 # State machine for event based class with multithreading
+# Events start and end without lock while no state switch is requested.
+# Events processing now are counted by appending to and popping from deque,
+# which are atomic, and state switch waits until it is empty.
 class _StateMachine(object):
     def __init__(self, init_state=None, init_sstate=None):
         self.state = init_state
         self.substate = init_sstate
-        # number of events processing now
-        self.state_event_num = 0
+        # one item for each event processing now
+        self.events = collections.deque()
         # flag for state switch request
         self.state_switch = False
         # state synchronization
@@ -114,10 +304,7 @@ class _StateMachine(object):
     # Used by Type1 events to know that it should not block waiting for 
     # another Type1 event
     def is_switch_started(self):
-        self.state_condition.acquire()
-        ret = self.state_switch
-        self.state_condition.release()
-        return ret
+        return self.state_switch
     
     # Start a event of state in list 'states'
     # If 'wait' is True, when Type2 event is waiting, it does not fail
@@ -128,6 +315,13 @@ class _StateMachine(object):
     # when False second entry 'state' is the state made this call fail
     # third entry 'switch' is true if state_switch was true when called
     def start_event(self, states, wait=False, timeout=None):
+        if not self.state_switch and self.state in states:
+            self.events.append(None)
+            # state switch may have been requested before event is counted
+            state = self.state
+            if not self.state_switch and state in states:
+                return (True, state)
+            self.end_event()
         self.state_condition.acquire()
         if wait:
             if self.state_switch and timeout != None:
@@ -150,18 +344,20 @@ class _StateMachine(object):
             ret = (False, self.state, self.state_switch)
             self.state_condition.release()
             return ret
-        self.state_event_num += 1
+        self.events.append(None)
         ret = (True, self.state)
         self.state_condition.release()
         return ret
         
     # End event started before
+    # Lock is taken only to wake up state switch waiting for events
     def end_event(self):
-        self.state_condition.acquire()
-        self.state_event_num -= 1
-        if self.state_event_num == 0:
-            self.state_condition.notifyAll()
-        self.state_condition.release()
+        self.events.pop()
+        if self.state_switch:
+            self.state_condition.acquire()
+            if not self.events:
+                self.state_condition.notifyAll()
+            self.state_condition.release()
         
     # Start state switch event from state in list 'states'
     # if success, return (True, state), otherwise (False, state, switch)
@@ -182,7 +378,7 @@ class _StateMachine(object):
             self.state_condition.release()
             return ret
         self.state_switch = True
-        if self.state_event_num > 0:
+        while self.events:
             self.state_condition.wait()
         ret = (True, self.state)
         self.state_condition.release()
@@ -198,13 +394,15 @@ class _StateMachine(object):
         
 # Provides timer event reservation and cancellation
 # It can be used together with _StateMachine events
+# Events are run by shared scheduler, not by thread of each event. They
+# wait for state switch, so they are run as blocking events.
 class _TimerEventManager(object):
     def __init__(self):
         # timer events
         self.timer_events = {}
         # mutex
         self.mutex = threading.Lock()
-        
+        self.scheduler = scheduler.get_scheduler()
         
     def _timer_func_factory(self, method, name, id):
         def timer_start():
@@ -221,7 +419,7 @@ class _TimerEventManager(object):
                 # 0th item : timer id
                 # 1th item : is timer event running now?
                 # 2th item : Lock to wait for end of event
-                # 3th item : reserved timer object (not None if reserved or running)
+                # 3th item : reserved scheduler event (not None if reserved or running)
                 self.timer_events[name] = [0, False, threading.Condition(), None]
             meta = self.timer_events[name]
             cond = meta[2]
@@ -232,8 +430,8 @@ class _TimerEventManager(object):
                     break
                 meta[0] += 1
                 timer_func = self._timer_func_factory(method, name, meta[0])
-                meta[3] = threading.Timer(time, timer_func)
-                meta[3].start()
+                meta[3] = self.scheduler.schedule(time, timer_func, 
+                                                  blocking=True)
                 ret = True
                 break
             cond.release()
@@ -308,34 +506,322 @@ class _TimerEventManager(object):
                 ret = True
                 meta[0] += 1
                 if meta[3]:
-                    meta[3].cancel()
+                    self.scheduler.cancel(meta[3])
                     meta[3] = None
                 break
             cond.release()
             break
         return ret
     
+# Rate limiter shared by all cores of an admin
+# It keeps sliding window log for each of multiple limits, e.g. 10 requests
+# per 10 sec and 500 requests per 600 sec, and permits a request only if
+# every window has room. Request permitted but not finished is counted as
+# used, and it is logged when it finishes since server counts it sometime
+# before its response comes.
+# It is not thread-safe, caller must hold perm_condition of admin.
+class _RateLimiter(object):
+    # limits : list of tuple (req number, per time)
+    # header : name of header which tells limits, and with '-count' which
+    #          tells requests counted by server
+    def __init__(self, limits, header='x-app-rate-limit'):
+        self.header = header
+        self.limits = [(int(num), float(per)) for num, per in limits]
+        # times when permitted requests finished for each limit
+        self.logs = [collections.deque() for limit in self.limits]
+        # number of requests permitted but not finished
+        self.inflight = 0
+        # no permit is given until this time
+        self.blocked_until = 0.0
+        # no permit is expected until this time, set when permit is
+        # refused, so that it can be read without lock of user
+        self.refill_at = 0.0
+        
+    def _expire(self, now):
+        for limit, log in zip(self.limits, self.logs):
+            old = now - limit[1]
+            while log and log[0] <= old:
+                log.popleft()
+                
+    # Returns number of requests which can be permitted now
+    def get_left(self, now=None):
+        now = now or time.time()
+        self._expire(now)
+        if now < self.blocked_until:
+            return 0
+        return min(limit[0] - len(log) - self.inflight 
+                   for limit, log in zip(self.limits, self.logs))
+    
+    # Returns time in second until 'num' permits are available, 0 if it's now
+    # Returns None if it waits for in-flight requests to finish
+    def get_next_refill(self, now=None, num=1):
+        now = now or time.time()
+        self._expire(now)
+        wait = max(self.blocked_until - now, 0.0)
+        for limit, log in zip(self.limits, self.logs):
+            # number of logged requests which have to expire
+            need = len(log) + self.inflight - limit[0] + num
+            if need <= 0:
+                continue
+            if need > len(log):
+                return None
+            wait = max(wait, log[need - 1] + limit[1] - now)
+        return wait
+    
+    # Returns False if no permit is expected now, it's just a hint
+    # Note : it's safe to call without lock of user
+    def is_ready(self, now=None):
+        return (now or time.time()) >= self.refill_at
+    
+    # Returns the most permits which can be available at once
+    def get_capacity(self):
+        return min(limit[0] for limit in self.limits)
+    
+    # Take 'num' permits if available, returns True if taken
+    def acquire(self, now=None, num=1):
+        if self.get_left(now) >= num:
+            self.inflight += num
+            return True
+        return False
+    
+    # Give back 'num' permits taken but not used
+    def cancel(self, num=1):
+        self.inflight -= num
+    
+    # Log finish of request permitted before
+    def release(self, now=None):
+        now = now or time.time()
+        self.inflight -= 1
+        for log in self.logs:
+            log.append(now)
+            
+    # Block any permit until time 'until'
+    def block(self, until):
+        self.blocked_until = max(self.blocked_until, until)
+        
+    # Correct windows by what server reported
+    # Counts only raise the log. Responses may arrive out of order, and an
+    # older lower count must not drop requests counted after it.
+    # limits : list of tuple (req number, per time) server applies
+    # counts : list of tuple (count, per time) server counted
+    def correct(self, limits, counts, now=None):
+        now = now or time.time()
+        if limits and sorted(limits, key=lambda l: l[1]) != self.limits:
+            self._set_limits(limits, now)
+        self._expire(now)
+        counted = dict((per, count) for count, per in counts)
+        for limit, log in zip(self.limits, self.logs):
+            count = counted.get(limit[1])
+            if count is None:
+                continue
+            # requests not known to us are taken as finished now
+            while len(log) < count:
+                log.append(now)
+                
+    # Correct by rate limit headers of response
+    # X-App-Rate-Limit(-Count) tells limits of the key and requests counted,
+    # Retry-After tells how long to wait after limit is exceeded.
+    # Returns time in second to wait if limit was exceeded, None otherwise
+    def apply_headers(self, status_code, headers, now=None):
+        now = now or time.time()
+        self.correct_by_headers(headers, now)
+        if status_code != config.SC_LIMIT_EXCEEDED:
+            return None
+        return self.block_by_headers(headers, now)
+    
+    # Correct by limit header of this limiter and its count header
+    def correct_by_headers(self, headers, now=None):
+        limits = _parse_rate_header(headers.get(self.header))
+        counts = _parse_rate_header(headers.get(self.header + '-count'))
+        if counts:
+            self.correct(limits, counts, now)
+            
+    # Block for time Retry-After tells, returns the time
+    def block_by_headers(self, headers, now=None):
+        now = now or time.time()
+        try:
+            retry = float(headers['retry-after'])
+        except (KeyError, ValueError):
+            retry = config.RETRY_AFTER_DEFAULT
+        self.block(now + retry)
+        return retry
+        
+    def _set_limits(self, limits, now):
+        # the longest log has every request logged in the largest window
+        times = max(self.logs, key=len) if self.logs else []
+        self.limits = sorted(((int(num), float(per)) for num, per in limits),
+                             key=lambda l: l[1])
+        self.logs = [collections.deque(t for t in times if t > now - limit[1])
+                     for limit in self.limits]
+    
+# Chooses which priority class to serve next
+# Each class has minimum share of served requests. Among classes which
+# have waiting requests, the one below its share the most is chosen, and
+# if none is below, the highest class is chosen. Served counts decay
+# with every serve so that only recent ones matter.
+# It is not thread-safe, caller must hold lock of its user.
+class _PriorityShare(object):
+    # shares : list of minimum share of each class (default in config)
+    # decay : weight of counts kept for every serve (default in config)
+    def __init__(self, shares=None, decay=None):
+        self.shares = list(config.PRIORITY_SHARES if shares == None else shares)
+        self.decay = config.PRIORITY_SHARE_DECAY if decay == None else decay
+        self.served = [0.0] * len(self.shares)
+        
+    # Returns class to serve next among list of 'classes'
+    def choose(self, classes):
+        total = sum(self.served)
+        chosen = None
+        lowest = 1.0
+        for priority in classes:
+            share = self.shares[priority]
+            if share <= 0 or total <= 0:
+                continue
+            ratio = self.served[priority] / (share * total)
+            if ratio < lowest:
+                chosen = priority
+                lowest = ratio
+        if chosen is None:
+            chosen = min(classes)
+        return chosen
+    
+    # Count a request of class 'priority' served
+    def serve(self, priority):
+        for i in range(len(self.served)):
+            self.served[i] *= self.decay
+        self.served[priority] += 1.0
+        
+# Queue of requests with a lane for each priority class
+# It is not thread-safe, caller must hold lock of its user.
+class _PriorityQueue(object):
+    def __init__(self, shares=None):
+        self.share = _PriorityShare(shares)
+        self.lanes = [collections.deque() for share in self.share.shares]
+        
+    # first : True to put item in front of its class
+    def push(self, priority, item, first=False):
+        if first:
+            self.lanes[priority].appendleft(item)
+        else:
+            self.lanes[priority].append(item)
+        
+    # ready : function which tells if item can be served now, or None
+    #         The first ready item among QUEUE_SCAN_DEPTH items of each
+    #         class is taken then. If no class has one, head is taken.
+    # Raises IndexError if queue is empty
+    def pop(self, ready=None):
+        classes = [priority for priority, lane in enumerate(self.lanes) if lane]
+        if not classes:
+            raise IndexError('pop from an empty queue')
+        found = {}
+        if ready is not None:
+            for priority in classes:
+                index = self._find(self.lanes[priority], ready)
+                if index is not None:
+                    found[priority] = index
+            if found:
+                classes = sorted(found)
+        priority = self.share.choose(classes)
+        self.share.serve(priority)
+        lane = self.lanes[priority]
+        index = found.get(priority, 0)
+        if index == 0:
+            return lane.popleft()
+        item = lane[index]
+        del lane[index]
+        return item
+    
+    def _find(self, lane, ready):
+        for index, item in enumerate(itertools.islice(lane, 
+                                                      config.QUEUE_SCAN_DEPTH)):
+            if ready(item):
+                return index
+        return None
+    
+    def __len__(self):
+        return sum(len(lane) for lane in self.lanes)
+    
+# Permits reserved at once for a bundle of requests by LOLAdmin.reserve
+# Requests of the bundle take permits of it in place of waiting, and 
+# permits not taken are given back when all requests are done.
+class _Reservation(object):
+    # need : Counter of permits by method rate limit bucket (None for
+    #        methods without bucket)
+    def __init__(self, admin, need):
+        self.admin = admin
+        self.left = need
+        # requests of the bundle not done
+        self.pending = sum(need.values())
+        
+    # Take a permit for request of 'bucket', returns True if taken
+    # Note : perm_condition of admin must be acquired
+    def take(self, bucket):
+        if self.left.get(bucket, 0) <= 0:
+            return False
+        self.left[bucket] -= 1
+        return True
+    
+    # Change number of requests not done by 'num'
+    # Requests of the bundle merged into batches are counted by batch which
+    # takes a permit of it, not by request.
+    def add_pending(self, num):
+        self.admin.perm_condition.acquire()
+        self.pending += num
+        self.admin.perm_condition.release()
+    
+    # Log one request of the bundle done, whether it's sent or not
+    def done(self):
+        self.admin._end_reservation(self)
+        
 # LOLAdmin is in charge of managing one key.
 class LOLAdmin(object):
     # key : your API key
     # limit : tuple (req number, second) so that
     #         req number / second is req per sec
     #         'req number' of request is possible for 'second' sec
+    #         or list of such tuples which are applied at the same time
+    #         (default LIMITS in config)
     # core : number of cores (default in config)
     # api : API to use (default in config)
     def __init__(self, limit=None, key=None, cores=None, api=None):
-        limit = config.LIMIT if limit == None else limit
+        limit = config.LIMITS if limit == None else limit
+        limits = [limit] if not isinstance(limit, list) else limit
         cores = config.CORE_NUM if cores == None else cores
         api = LOLAPI if api == None else api
         self.api = api
         self.key = config.KEY if key == None else key
-        self.req_num = limit[0]
-        self.per_time = limit[1]
+        self.limits = limits
+        # the first limit is the shortest one
+        self.req_num = limits[0][0]
+        self.per_time = limits[0][1]
         self.core_num = cores
         if self.core_num <= 0:
             self.core_num = 1
         self.cores = []
-        self.core_req_num = self.req_num/self.core_num
+        
+        # permits are shared by all cores
+        self.limiter = _RateLimiter(limits)
+        # method rate limit bucket by method name, methods may share one
+        self.buckets = {}
+        named = {}
+        for name, (bucket, method_limits) in config.METHOD_LIMITS.items():
+            if bucket not in named:
+                named[bucket] = _RateLimiter(method_limits, 
+                                             'x-method-rate-limit')
+            self.buckets[name] = named[bucket]
+        # permits go to waiting cores by priority class of their requests
+        self.share = _PriorityShare()
+        # number of cores waiting for permit in each class
+        self.waiting = [0] * len(self.share.shares)
+        # reservations waiting for permits, list of [priority, sequence]
+        self.reserving = []
+        self.reserve_seq = itertools.count()
+        # permits granted and those granted after waiting, guarded by 
+        # perm_condition
+        self.permits = 0
+        self.waited_permits = 0
+        # responses with status 429
+        self.limited = metric.Counter()
         
         # timer event function
         self.timer = _TimerEventManager()
@@ -343,17 +829,16 @@ class LOLAdmin(object):
         # LOLAdmin is an state machine
         self.state = _StateMachine(S_IDLE)
         
-        # index to next core to dispatch request
-        self.next_core = 0
-        
-        # miss counted requests when synchronizes
-        self.sync_miss = 0
-        self.sync_miss_time = 0  # time when response to miss req is got 
-        self.sync_miss_mutex = threading.Lock()
-        self.sync_last = 0       # time when last successful synchronization is done
+        # counts dispatched requests to choose next core without lock
+        # and to start looking for least loaded core at different core
+        self.next_core = itertools.count()
         
         # policy for service unavailable
-        self.policy = _ServiceUnavailablePolicy()
+        # errors in a row open circuit breaker of method instead if it's on
+        self.policy = _ServiceUnavailablePolicy(not config.BREAKER_ON)
+        # circuit breaker by method name
+        self.breakers = {}
+        self.breaker_mutex = threading.Lock()
         
         # debug
         self.debug = False
@@ -369,14 +854,8 @@ class LOLAdmin(object):
         
         # semaphores for mutual exclusion
         
-        # Make sure that timer doesn't work when synchronizing
+        # Make sure that only one checks service status at a time
         self.sync_mutex = threading.Semaphore(1)    
-        # when sync happens, it's possible that a successful request before
-        # limit exceed is counted in miss req, this will make
-        # early reqs get into result processing phase probably earlier 
-        # in _get_data in LOLCore
-        self.global_after_req_mutex = threading.Semaphore(1)
-        self.get_data_mutex = threading.Semaphore(1)
         
     # Get information of admin
     def get_spec(self):
@@ -384,9 +863,29 @@ class LOLAdmin(object):
         r['key'] = self.key
         r['req_num'] = self.req_num
         r['per_time'] = self.per_time
+        r['limits'] = self.limits
         r['core_num'] = self.core_num
         return r
     
+    # Get status of rate limit
+    # 'left' : number of requests can be sent now
+    # 'next_refill' : time in second until next permit, None if it's
+    #                 unknown until in-flight requests finish
+    # 'inflight' : number of requests sent but not finished
+    def get_rate_status(self):
+        self.perm_condition.acquire()
+        now = time.time()
+        r = {}
+        r['left'] = max(self.limiter.get_left(now), 0)
+        r['next_refill'] = self.limiter.get_next_refill(now)
+        r['inflight'] = self.limiter.inflight
+        self.perm_condition.release()
+        return r
+    
+    # Returns True if admin is in OK state
+    def is_available(self):
+        return self.state.state == S_OK
+    
     # Initializes cores
     def init(self):
         start = self.state.start_state_switch((S_IDLE,))
@@ -395,7 +894,7 @@ class LOLAdmin(object):
         
         # initialize cores
         for i in range(self.core_num):
-            core = LOLCore(self, (self.core_req_num, self.per_time))
+            core = LOLCore(self)
             self.cores.append(core)
             
         self.state.switch_state(S_OK, SS_OK)
@@ -405,126 +904,6 @@ class LOLAdmin(object):
     def _test_request(self, api):
         return api.get_summoners_by_names(b'\xeb\xa8\xb8\xed\x94\xbc93'.decode('utf8'))
     
-    def _call_synchronize(self):
-        # to SS_SYNCHRONIZING substate
-        # in this state, if get_permission found no more request left,
-        # it will return False
-        self.state.switch_substate(SS_SYNCHRONIZING)
-        return self.timer.reserve_timer('synchronize', self._synchronize, 0.0)
-    
-    def _synchronize(self, name, id):
-        # All synchronization must follow this order
-        # sync_mutex -> perm_condition -> req_condition -> sync_miss_mutex
-        # otherwise, deadlock may occur
-        
-        start = self.timer.start_timer(name, id)
-        if not start:
-            return
-        
-        start = self.state.start_event([S_OK])
-        if not start[0]:
-            self.timer.end_timer(name)
-            return
-        
-        # Sync mutex with reset thread
-        self.sync_mutex.acquire()        
-        # Block any permission
-        self.perm_condition.acquire()
-        # Wait for currently executing cores till method is done
-        for i in range(self.core_num):
-            self.cores[i].req_condition.acquire()
-        # cancel timer if it's set
-        self._cancel_reset_timer()
-            
-        api = self.cores[0].api
-        self._debug_msg('sync')
-            
-        begin = time.time()
-        
-        success = False
-        while 1:
-            # assume api is initialized and not closed
-            # test request
-            try:
-                content = self._test_request(api)
-            except lolapi.Error as err:
-                try:
-                    raise err
-                except lolapi.Timeout as err:
-                    if not self.policy.push_timeout():
-                        break
-                    continue
-                except lolapi.Error as err:
-                    if not self.policy.push_error():
-                        break
-                    continue
-                
-            status_code = content[0][0]
-            if status_code == config.SC_LIMIT_EXCEEDED:
-                time.sleep(0.05)
-                end = time.time()
-                time_thresh = self.per_time * 1.5
-                # check if per_time is elapsed from start
-                if end-begin > time_thresh:
-                    break
-                continue
-            else:
-                if self.policy.push_status_code(status_code):
-                    success = True
-                break
-        
-        # common codes
-        self.sync_miss_time = 0
-        
-        if success:
-            self._debug_msg('sync success')
-            # set new timer
-            # If miss request is got, timer in server is already set before
-            # sync. To fix, calculate delayed time 
-            delay = time.time() - self.sync_miss_time if self.sync_miss_time else 0
-            timing = self.per_time - delay if self.per_time > delay else 0
-            #print 'Delay', delay
-            self.sync_last = time.time() - delay
-            self._call_reset_timer(timing)
-            
-            self._reset_rate_for_each_cores()
-            
-            self.state.switch_substate(SS_OK)
-            
-            # fix count miss by misses and 1 request to server 
-            self.sync_miss_mutex.acquire()
-            miss_cnt = self.sync_miss + 1
-            if miss_cnt:
-                miss_for_one = miss_cnt / self.core_num
-                miss_remainder = miss_cnt % self.core_num
-                for core in self.cores:
-                    core.left -= miss_for_one
-                for r in range(miss_remainder):
-                    self.cores[r].left -= 1
-            self.sync_miss = 0
-            time.sleep(0.1)
-            self.sync_miss_mutex.release()
-            
-            # debug - show left for each core
-            if self._is_debug():
-                for cor in self.cores:
-                    print('core : ', cor.left)
-                
-        else:
-            self._debug_msg('sync failed')
-            self._call_service_unavailable()
-
-        # release locks
-        for i in range(self.core_num):
-            # tell the blocked limit exceeded threads that sync is completed
-            self.cores[i].req_condition.notifyAll()
-            self.cores[i].req_condition.release()
-        self.perm_condition.release()
-        self.sync_mutex.release()
-        
-        self.state.end_event()
-        self.timer.end_timer(name)
-        
     def _call_service_unavailable(self):
         return self.timer.reserve_timer('service_unavailable', self._service_unavailable, 0.0)
         
@@ -541,8 +920,6 @@ class LOLAdmin(object):
             
         self._debug_msg('service unavailable called')
             
-        self._cancel_reset_timer()
-            
         self.state.switch_state(S_SERVICE_UNAVAILABLE)
         
         self.state.end_state_switch()
@@ -571,6 +948,13 @@ class LOLAdmin(object):
                 except Exception:
                     break
                 else:
+                    # test request also uses quota
+                    response = core.api.get_last_response()
+                    if response is not None:
+                        self.perm_condition.acquire()
+                        self._apply_rate_headers(response[0][0], response[1], 
+                                                 time.time())
+                        self.perm_condition.release()
                     status_code = content[0]
                     if status_code[0] == config.SC_OK:
                         self._call_service_available()
@@ -598,66 +982,201 @@ class LOLAdmin(object):
         
         self.state.switch_state(S_OK, SS_OK)
         self.policy.reset()
-        self._clear_rate_for_each_cores()
         
         self.state.end_state_switch()
         self.timer.end_timer(name)
         
-        # start new timer
-        self._call_reset_timer(0.0)
-            
-    # sets timer for rate reset
-    # time : time untile timer is called in sec, if time is not given, self.per_time is used
-    def _call_reset_timer(self, time=None):
-        time = time if time != None else self.per_time
-        ret = self.timer.reserve_timer('reset', self._reset_rate, time)
-        if ret:
-            self._debug_msg('set timer')
-        return ret
-        
-    def _cancel_reset_timer(self):
-        return self.timer.cancel_timer('reset')
+    # Log finish of request permitted to a core
+    # response : tuple (status tuple, headers) of the request, or None
+    #            if no response has come
+    # method : lolapi method of the request
+    # bucket : method rate limit bucket permit of the request was taken from
+    # sent : False if request did not go out, then its permit is given back
+    #        instead of being counted
+    # Cores waiting for permit are woken up to see the limiter again
+    # Note : This must be called after core released its req_condition
+    def _finish_request(self, response=None, method=None, bucket=None, 
+                        sent=True):
+        self.perm_condition.acquire()
+        now = time.time()
+        if not sent:
+            self.limiter.cancel()
+            if bucket is not None:
+                bucket.cancel()
+        else:
+            self.limiter.release(now)
+            if bucket is not None:
+                bucket.release(now)
+        if response is not None:
+            self._apply_rate_headers(response[0][0], response[1], now, method)
+        self.perm_condition.notifyAll()
+        self.perm_condition.release()
         
-    # synchronized rate reset
-    def _reset_rate(self, name, id):
-        start = self.timer.start_timer(name, id)
-        if not start:
+    # Returns method rate limit bucket of lolapi 'method', None if it has none
+    def _get_bucket(self, method):
+        return self.buckets.get(getattr(method, '__name__', None))
+    
+    # Returns False if bucket of 'method' is known to be full now
+    def is_method_ready(self, method):
+        bucket = self._get_bucket(method)
+        return bucket is None or bucket.is_ready()
+        
+    # Correct limiter and bucket of 'method' by rate limit headers of response
+    # Limit exceeded of method type blocks only the bucket.
+    # Note : perm_condition must be acquired
+    def _apply_rate_headers(self, status_code, headers, now, method=None):
+        self.limiter.correct_by_headers(headers, now)
+        self.limits = self.limiter.limits
+        bucket = self._get_bucket(method)
+        if bucket is None and method is not None:
+            # server tells limits of method not in METHOD_LIMITS
+            limits = _parse_rate_header(headers.get('x-method-rate-limit'))
+            if limits:
+                bucket = _RateLimiter(limits, 'x-method-rate-limit')
+                self.buckets[method.__name__] = bucket
+        if bucket is not None:
+            bucket.correct_by_headers(headers, now)
+        if status_code != config.SC_LIMIT_EXCEEDED:
             return
+        limit_type = headers.get('x-rate-limit-type')
+        if limit_type == 'method' and bucket is not None:
+            retry = bucket.block_by_headers(headers, now)
+        else:
+            retry = self.limiter.block_by_headers(headers, now)
+        self._debug_msg('limit exceeded (%s), retry after %s sec' % 
+                        (limit_type, retry))
+    
+    # Returns list of status of method rate limit buckets
+    def get_bucket_status(self):
+        self.perm_condition.acquire()
+        now = time.time()
+        r = [{'name': name,
+              'left': max(bucket.get_left(now), 0),
+              'inflight': bucket.inflight,
+              'limits': list(bucket.limits)}
+             for name, bucket in sorted(self.buckets.items())]
+        self.perm_condition.release()
+        return r
+            
+    # Returns True if core waiting with request of class 'priority' 
+    # can take next permit
+    # Note : perm_condition must be acquired
+    def _is_turn(self, priority):
+        classes = [c for c, num in enumerate(self.waiting) if num > 0]
+        return self.share.choose(classes) == priority
+    
+    # Returns True if request of class 'priority' has to wait for 
+    # reservation of the same or higher class
+    # Note : perm_condition must be acquired
+    def _is_held(self, priority):
+        return bool(self.reserving) and min(self.reserving)[0] <= priority
+    
+    # Reserve permits for requests of all 'methods' at once, so that the
+    # requests are sent together and not left half done when quota runs 
+    # out. Reservations are served in order of class and arrival, and 
+    # requests of the same or lower class wait for them.
+    # methods : list of lolapi method of each request
+    # timeout : time in second to wait for permits, None for no limit
+    # Returns _Reservation whose permits go to get_data of the requests,
+    # None if timeout expired or state is switching.
+    # It raises InvalidUseError if rate limit can never give the permits.
+    def reserve(self, methods, priority=PR_NORMAL, timeout=None):
+        need = collections.Counter(self._get_bucket(method) for method in methods)
+        num = sum(need.values())
+        if (num > self.limiter.get_capacity() or 
+            any(bucket is not None and count > bucket.get_capacity()
+                for bucket, count in need.items())):
+            raise InvalidUseError("Bundle is larger than rate limit")
         
-        start = self.state.start_event([S_OK])
+        start = self.state.start_event([S_OK], True)
         if not start[0]:
-            self.timer.end_timer(name)
-            return
+            if start[1] == S_IDLE:
+                raise InvalidUseError("Please initailize before")
+            raise ServiceUnavailableError("Problem with connection to server")
         
-        self.sync_mutex.acquire()
+        end = None if timeout is None else time.time() + timeout
+        entry = [priority, next(self.reserve_seq)]
         self.perm_condition.acquire()
-        self._debug_msg('timer start')
-        self._reset_rate_for_each_cores()
-        # wake up all cores waiting for reset
-        self.perm_condition.notifyAll()
+        self.reserving.append(entry)
+        self.waiting[priority] += 1
+        try:
+            while True:
+                if self.state.is_switch_started():
+                    return None
+                now = time.time()
+                if end is not None and now >= end:
+                    return None
+                wait = self.per_time
+                if min(self.reserving) is entry and self._is_turn(priority):
+                    reservation = self._take_reservation(need, priority, now)
+                    if reservation is not None:
+                        return reservation
+                    wait = self._get_reservation_wait(need, now)
+                if end is not None:
+                    wait = min(wait, end - now)
+                self.perm_condition.wait(wait)
+        finally:
+            self.reserving.remove(entry)
+            self.waiting[priority] -= 1
+            self.perm_condition.notifyAll()
+            self.perm_condition.release()
+            self.state.end_event()
+            
+    # Take permits of 'need' if all are available, returns _Reservation
+    # Note : perm_condition must be acquired
+    def _take_reservation(self, need, priority, now):
+        num = sum(need.values())
+        if self.limiter.get_left(now) < num:
+            return None
+        for bucket, count in need.items():
+            if bucket is not None and bucket.get_left(now) < count:
+                return None
+        self.limiter.acquire(now, num)
+        for bucket, count in need.items():
+            if bucket is not None:
+                bucket.acquire(now, count)
+        for i in range(num):
+            self.share.serve(priority)
+        self.permits += num
+        return _Reservation(self, need)
+    
+    # Returns time in second until permits of 'need' are available
+    # Note : perm_condition must be acquired
+    def _get_reservation_wait(self, need, now):
+        waits = [self.limiter.get_next_refill(now, sum(need.values()))]
+        waits.extend(bucket.get_next_refill(now, count) 
+                     for bucket, count in need.items() if bucket is not None)
+        if None in waits:
+            # woken up when in-flight requests finish
+            return self.per_time
+        return min(max(waits), self.per_time)
+    
+    # Give back permits of 'reservation' not taken when its requests are 
+    # all done
+    def _end_reservation(self, reservation):
+        self.perm_condition.acquire()
+        reservation.pending -= 1
+        if reservation.pending <= 0:
+            for bucket, count in reservation.left.items():
+                if count <= 0:
+                    continue
+                self.limiter.cancel(count)
+                if bucket is not None:
+                    bucket.cancel(count)
+            reservation.left.clear()
+            self.perm_condition.notifyAll()
         self.perm_condition.release()
-        self.sync_mutex.release()
-        
-        self.state.end_event()
-        self.timer.end_timer(name)
-        
-    # clear rates for each cores
-    def _clear_rate_for_each_cores(self):
-        for core in self.cores:
-            core.left = 0
-        
-    # reset rates for each cores
-    def _reset_rate_for_each_cores(self):
-        for core in self.cores:
-            core.left = self.core_req_num
         
     # Get data from lol api and returns response
     # method : lolapi method
     # args : tuple of arguments to 'method'
+    # priority : priority class of request, one of PR_* value
     # If some errors occur, LOLAdmin may get into S_SERVICE_UNAVAILABLE state. 
     # In this state, all cores does not work and any call to this method just
     # raises ServiceUnavailableError.
-    def get_data(self, method, args):
+    # If circuit breaker of 'method' is open, it raises CircuitOpenError.
+    # reservation : _Reservation the request takes its permit from, if any
+    def get_data(self, method, args, priority=PR_NORMAL, reservation=None):
         start = self.state.start_event([S_OK], True)
         if not start[0]:
             if start[1] == S_IDLE:
@@ -666,26 +1185,125 @@ class LOLAdmin(object):
                 # only movable state is service unavailable
                 raise ServiceUnavailableError("Problem with connection to server")
             
-        self.get_data_mutex.acquire()
-        
-        core = self.cores[self.next_core]
-        self.next_core = (self.next_core + 1) % self.core_num
-        
-        self.get_data_mutex.release()
+        breaker = self._get_breaker(method)
+        if breaker is not None and not breaker.allow(time.time()):
+            self.state.end_event()
+            raise CircuitOpenError("Circuit of %s is open" % (breaker.name,))
+            
+        core = self._choose_core()
+        core.assigned.append(None)
         
         try:
-            data = core._get_data(method, args)
-        except PermissionFailError as err:
-            raise err
+            data = core._get_data(method, args, priority, reservation)
+        except (TimeoutError, InternalError):
+            if breaker is not None:
+                self._breaker_fail(breaker)
+            raise
+        except Exception:
+            # no result, e.g. permission failed
+            if breaker is not None:
+                breaker.abort()
+            raise
+        else:
+            if breaker is not None:
+                if data[0][0] in config.CONT_ERROR_SET1_TUPLE1_ERRORS:
+                    self._breaker_fail(breaker)
+                elif breaker.succeed():
+                    self._debug_msg('circuit of %s closed' % (breaker.name,))
         finally:
+            core.assigned.pop()
             self.state.end_event()
         
         return data
     
+    # Returns circuit breaker of 'method', None if breakers are off
+    def _get_breaker(self, method):
+        if not config.BREAKER_ON:
+            return None
+        name = getattr(method, '__name__', str(method))
+        breaker = self.breakers.get(name)
+        if breaker is None:
+            with self.breaker_mutex:
+                breaker = self.breakers.setdefault(name, _CircuitBreaker(name))
+        return breaker
+    
+    # Count failure of request
+    # No probe is reserved when circuit is opened, the first request of the
+    # method after backoff is let through by breaker as probe, so it has
+    # priority, deadline and arguments of a real request.
+    def _breaker_fail(self, breaker):
+        backoff = breaker.fail(time.time())
+        if backoff is not None:
+            self._debug_msg('circuit of %s open for %.1f sec' % 
+                            (breaker.name, backoff))
+    
+    # Returns list of status of circuit breakers
+    def get_breaker_status(self):
+        with self.breaker_mutex:
+            breakers = list(self.breakers.values())
+        r = []
+        for breaker in breakers:
+            status = breaker.get_status()
+            status['name'] = breaker.name
+            r.append(status)
+        return r
+    
+    # Returns core to dispatch request by CORE_DISPATCH of config
+    # Concurrent callers may choose the same core, then the later one 
+    # just waits for the core as in round robin.
+    def _choose_core(self):
+        start = next(self.next_core)
+        if config.CORE_DISPATCH != config.D_LEAST_LOADED:
+            return self.cores[start % self.core_num]
+        
+        now = time.time()
+        best = None
+        for i in range(self.core_num):
+            core = self.cores[(start + i) % self.core_num]
+            if not core.assigned:
+                return core
+            estimate = (core.get_estimate(now), len(core.assigned))
+            if best is None or estimate < best[0]:
+                best = (estimate, core)
+        return best[1]
+    
+    # Returns list of status of cores
+    # 'assigned' : number of requests dispatched to core and not finished
+    # 'latency' : moving average of latency of core
+    def get_core_status(self):
+        return [{'assigned': len(core.assigned), 
+                 'latency': core.latency.get_ewma()} for core in self.cores]
+    
+    # Returns counters of load since start, caller takes difference
+    # 'permits' : permits granted, 'waited' : permits granted after waiting
+    # 'limited' : responses with status 429
+    # 'latency' : tuple (count, total time) of requests of cores
+    # 'rate' : requests per second the shortest limit allows
+    def get_load(self):
+        count, total = 0, 0.0
+        for core in self.cores:
+            latency = core.latency.get()
+            count += latency['count']
+            total += latency['total']
+        return {'permits': self.permits,
+                'waited': self.waited_permits,
+                'limited': self.limited.get(),
+                'latency': (count, total),
+                'rate': float(self.req_num) / self.per_time}
+    
+    # Change number of cores requests are dispatched to
+    # New cores are made if needed, cores not used keep their connections
+    def set_core_num(self, num):
+        num = max(num, 1)
+        while len(self.cores) < num:
+            self.cores.append(LOLCore(self))
+        self.core_num = num
+    
     # request test data
     def get_test_data(self):
         #self._debug_msg('request test data')
-        td = self.get_data(lolapi.LOLAPI.get_summoners_by_names, (b'\xeb\xa8\xb8\xed\x94\xbc93'.decode('utf8'), ))
+        td = self.get_data(lolapi.LOLAPI.get_summoners_by_names, (b'\xeb\xa8\xb8\xed\x94\xbc93'.decode('utf8'), ),
+                           PR_BACKGROUND)
         return td
     
     # if 'mode' is true, set to debug mode
@@ -702,14 +1320,13 @@ class LOLAdmin(object):
         return self.debug
             
 class LOLCore(object):
-    def __init__(self, admin, limit):
+    def __init__(self, admin):
         # Administrator of this core
         self.admin = admin
-        self.req_num = limit[0]
-        self.per_time = limit[1]
+        self.per_time = admin.per_time
         
-        # Left request counts before reset
-        self.left = self.req_num
+        # Rate limiter shared by cores
+        self.limiter = self.admin.limiter
         self.key = self.admin.key
         self.api = None
         
@@ -719,9 +1336,14 @@ class LOLCore(object):
         # Condition for mutual exclusive requesting data
         self.req_condition = threading.Condition()
         
+        # one item for each request dispatched and not finished
+        self.assigned = collections.deque()
+        # latency of requests, and start time of current one
+        self.latency = metric.Average()
+        self.started = None
+        
         # Get synchronizations from admin
         self.perm_condition = self.admin.perm_condition
-        self.global_after_req_mutex = self.admin.global_after_req_mutex
             
         # Initialize LOL API
         self._init_api()
@@ -730,14 +1352,13 @@ class LOLCore(object):
     def _close(self):
         self._close_api()
         self.admin = None
-        self.req_num = None
         self.per_time = None
-        self.left = None
+        self.limiter = None
         self.key = None        
         
     def _init_api(self):
         if not self.api:
-            self.api = self.admin.api()
+            self.api = self.admin.api(key=self.key)
             # Disable debug for production mode
             self.api.set_debug_mode(0)
         try:
@@ -755,21 +1376,66 @@ class LOLCore(object):
             self.api = None
             
     # Get permission for sending one request to server
-    # It blocks if request count is 0 until timer or sync wakes up blocking.
+    # It blocks if no request is left until next permit is available
+    # or finishing request or sync wakes up blocking.
     # If state switching is started during getting permission, it will fail.
+    # Cores with requests of higher priority class get permit first.
+    # bucket : method rate limit bucket of request, None if it has none
+    #          Permit is given only if the bucket has room too. While it's
+    #          full, core is not counted as waiting so that requests of
+    #          the other methods go on.
+    # reservation : _Reservation of bundle of request, its permit is taken
+    #               without waiting. The other requests wait while 
+    #               reservation of the same or higher class waits.
     # Note : This function must be called when self.perm_condition is acquired
     # @return true if successful, false otherwise
-    def _get_permission(self):
-        while True:
-            if self.state.is_switch_started():
-                return False
-            if self.left > 0:
-                self.left -= 1
-                #print 'get perm' + str(self)
-                return True
-            else:
-                #print 'get perm fail' + str(self)
-                self.perm_condition.wait(self.admin.per_time)
+    def _get_permission(self, priority=PR_NORMAL, bucket=None, 
+                        reservation=None):
+        if reservation is not None and reservation.take(bucket):
+            return True
+        counted = False
+        waited = False
+        try:
+            while True:
+                if self.state.is_switch_started():
+                    return False
+                held = self.admin._is_held(priority)
+                if held or (bucket is not None and bucket.get_left() <= 0):
+                    if counted:
+                        self.admin.waiting[priority] -= 1
+                        counted = False
+                        self.perm_condition.notifyAll()
+                    wait = self.per_time
+                    if not held:
+                        wait = bucket.get_next_refill()
+                        wait = self.per_time if wait is None else wait
+                        bucket.refill_at = time.time() + wait
+                    self.perm_condition.wait(wait)
+                    continue
+                if not counted:
+                    self.admin.waiting[priority] += 1
+                    counted = True
+                if not self.admin._is_turn(priority):
+                    # woken up when waiting cores change
+                    waited = True
+                    self.perm_condition.wait(self.per_time)
+                    continue
+                if self.limiter.acquire():
+                    if bucket is not None:
+                        bucket.acquire()
+                    self.admin.share.serve(priority)
+                    self.admin.permits += 1
+                    if waited:
+                        self.admin.waited_permits += 1
+                    return True
+                waited = True
+                wait = self.limiter.get_next_refill()
+                self.perm_condition.wait(self.per_time if wait is None else wait)
+        finally:
+            if counted:
+                self.admin.waiting[priority] -= 1
+                # core of another class may have its turn now
+                self.perm_condition.notifyAll()
             
     # Basic routine for retrieving data from lol api
     # method : lolapi request method, must be class's method
@@ -778,90 +1444,121 @@ class LOLCore(object):
     # data is either jason data parsed to python obejct or just raw string.
     # When lolapi timeout or error exception raises, it raises timeout or internal exeception
     # respectively
-    def _get_data(self, method, args):
+    # reservation : _Reservation the first try takes its permit from
+    def _get_data(self, method, args, priority=PR_NORMAL, reservation=None):
         while True:
+            # bucket may be made by response of retried request
+            bucket = self.admin._get_bucket(method)
             self.perm_condition.acquire()
             # get permission
-            if not self._get_permission():
+            if not self._get_permission(priority, bucket, reservation):
                 self.perm_condition.release()
                 raise PermissionFailError("Failed to get permission")
+            self.perm_condition.release()
+            reservation = None
             
             # only one call to this method works at a moment for each core
+            # perm_condition is released before, so waiting for busy core
+            # does not block permits of the other cores
             self.req_condition.acquire()
-            self.perm_condition.release()
             
+            sent = True
+            try:
+                result = self._request(method, args)
+            except PoolExhaustedError:
+                sent = False
+                raise
+            finally:
+                response = self.api.get_last_response() if self.api else None
+                self.admin._finish_request(response, method, bucket, sent)
+            if result is not None:
+                break
+                
+        return result
+    
+    # Returns estimated time in second until requests dispatched to this
+    # core finish
+    def get_estimate(self, now):
+        latency = self.latency.get_ewma() or 0.0
+        estimate = len(self.assigned) * latency
+        started = self.started
+        if started is not None:
+            # current request is slower than usual
+            estimate += max(now - started - latency, 0.0)
+        return estimate
+    
+    # Send one request permitted, req_condition must be acquired
+    # It releases req_condition before return
+    # Returns None if it should be tried again
+    def _request(self, method, args):
+        try:
+            #print 'method call'
+            self.started = time.time()
             try:
-                #print 'method call'
                 result = method(self.api, *args)
-                self.global_after_req_mutex.acquire()
-                status = result[0]
-            except lolapi.Error as err:
-                self.global_after_req_mutex.release()
+            finally:
+                # waiting for connection of pool is not latency of server
+                self.latency.observe(time.time() - self.started - 
+                                     self.api.get_last_pool_wait())
+                self.started = None
+            status = result[0]
+        except lolapi.Error as err:
+            try:
+                raise err
+            except lolapi.PoolExhausted as err:
+                # not an error of server, policy does not count it
+                raise PoolExhaustedError(str(err))
+            except lolapi.Timeout as err:
+                if not self.policy.push_timeout():
+                    self.admin._call_service_unavailable()
+                raise TimeoutError('Timeout')
+            except (lolapi.InitializationFail, lolapi.InvalidUse) as err:
+                # currently, there's no case would come to here
+                if not self.policy.push_error():
+                    self.admin._call_service_unavailable()
+                self._close_api()
                 try:
-                    raise err
-                except lolapi.Timeout as err:
-                    if not self.policy.push_timeout():
-                        self.admin._call_service_unavailable()
-                    raise TimeoutError('Timeout')
-                except (lolapi.InitializationFail, lolapi.InvalidUse) as err:
-                    # currently, there's no case would come to here
-                    if not self.policy.push_error():
-                        self.admin._call_service_unavailable()
-                    self._close_api()
-                    try:
-                        self._init_api()
-                    except lolapi.InitializationFail as err:
-                        raise InternalError(str(err))
-                    raise InternalError(str(err))
-                except lolapi.Error as err:
-                    if not self.policy.push_error():
-                        self.admin._call_service_unavailable()
+                    self._init_api()
+                except lolapi.InitializationFail as err:
                     raise InternalError(str(err))
-                finally:
-                    self.req_condition.release()
-                    
-            else:
-                status_code = status[0]
-                if status_code == config.SC_OK:
-                    # possibly, successful requests after rate exceed respond
-                    # may be counted after rate reset. so it increases gap between here
-                    # and server
-                    if self.state.get_substate() == SS_SYNCHRONIZING:
-                        self.admin.sync_miss += 1
-                        if not self.admin.sync_miss_time:
-                            self.admin.sync_miss_time = time.time()
-                    
-                    # start timing for rate reset
-                    self.admin._call_reset_timer()
-                    # release locks
-                    self.global_after_req_mutex.release()
-                    self.req_condition.release()
-                    
-                    break
-                elif status_code == config.SC_LIMIT_EXCEEDED:
-                    # synchronize and do it again
-                    
-                    # call synchonization process, only one call will be accepted.
-                    self.admin._call_synchronize()
-                    
-                    # release locks
-                    self.global_after_req_mutex.release()
-                    # wait until synchronization is completed
-                    self.req_condition.wait(self.per_time)
-                    self.req_condition.release()
-                    #print 'start again'
-                    # start again
-                    continue
-                else:
-                    if not self.policy.push_status_code(status_code):
-                        self.admin._call_service_unavailable()
-                    self.admin._call_reset_timer()
-                    self.global_after_req_mutex.release()
-                    self.req_condition.release()
-                    break
+                raise InternalError(str(err))
+            except lolapi.Error as err:
+                if not self.policy.push_error():
+                    self.admin._call_service_unavailable()
+                raise InternalError(str(err))
+            finally:
+                self.req_condition.release()
                 
+        else:
+            status_code = status[0]
+            if status_code == config.SC_OK:
+                self.req_condition.release()
+            elif status_code == config.SC_LIMIT_EXCEEDED:
+                # do it again, limiter blocks permit for time
+                # server asked by headers of the response
+                self.admin.limited.add()
+                self.req_condition.release()
+                return None
+            else:
+                # policy and timer events are thread-safe
+                if not self.policy.push_status_code(status_code):
+                    self.admin._call_service_unavailable()
+                self.req_condition.release()
+            
         return result
         
+# Parse rate limit header value such as '100:1,1000:10' into 
+# list of tuple (number, per time)
+# Returns empty list if header is not given or invalid
+def _parse_rate_header(value):
+    if not value:
+        return []
+    try:
+        return [(int(num), float(per)) for num, per in 
+                (pair.split(':') for pair in value.split(','))]
+    except ValueError:
+        return []
+
 # Action command got by pushing errors or status codes
 P_PASS = 1
 P_SERVICE_UNAVAILABLE = 0
@@ -877,7 +1574,10 @@ class _ServiceUnavailablePolicy(object):
         def reset(self):
             self.cnt = 0
         
-    def __init__(self):
+    # continuous : if False, errors in a row do not make it go to s-u 
+    #              state, only critical errors do
+    def __init__(self, continuous=True):
+        self.continuous = continuous
         # critical error policy
         self.critical_sets = {}
         # multiple error in a row policy
@@ -997,15 +1697,21 @@ class _ServiceUnavailablePolicy(object):
         return ret
     
     def push_timeout(self):
+        if not self.continuous:
+            return P_PASS
         return self._cont_push_error(self.cont_set2_name, 'timeout')
     
     def push_error(self):
+        if not self.continuous:
+            return P_PASS
         return self._cont_push_error(self.cont_set2_name, 'error')
     
     # For status codes, apply critical policy and cont policy
     def push_status_code(self, code):
         if not self._critical_push_error(self.critical_set1_name, code):
             return P_SERVICE_UNAVAILABLE
+        if not self.continuous:
+            return P_PASS
         return self._cont_push_error(self.cont_set1_name, code)
     
     # reset all counters of all tuples of all sets
@@ -1021,28 +1727,460 @@ class _ServiceUnavailablePolicy(object):
         self.exception_mutex.release()
 
 
+# Circuit breaker states
+CB_CLOSED = 0       # requests pass
+CB_OPEN = 1         # requests fail fast until backoff passes
+CB_HALF_OPEN = 2    # one probe request passes
+
+# Circuit breaker of one method (endpoint) of API
+# After 'threshold' failures in a row, requests of the method fail fast
+# for 'backoff' sec, then one request is let through as probe. If probe
+# fails, backoff is doubled up to 'max_backoff', if it succeeds requests
+# pass again. Failure of one method does not stop the others.
+class _CircuitBreaker(object):
+    def __init__(self, name, threshold=None, backoff=None, max_backoff=None):
+        self.name = name
+        self.threshold = config.BREAKER_THRESHOLD if threshold == None else threshold
+        self.min_backoff = config.BREAKER_BACKOFF if backoff == None else backoff
+        self.max_backoff = (config.BREAKER_MAX_BACKOFF if max_backoff == None 
+                            else max_backoff)
+        self.state = CB_CLOSED
+        self.failures = 0
+        self.backoff = self.min_backoff
+        self.retry_at = None
+        self.mutex = threading.Lock()
+        
+        self.opened = metric.Counter()
+        self.rejected = metric.Counter()
+        
+    # Returns True if request may be sent now
+    # Request passed in half open state is probe, its result must be 
+    # given by succeed, fail or abort
+    def allow(self, now):
+        if self.state == CB_CLOSED:
+            return True
+        with self.mutex:
+            if self.state == CB_CLOSED:
+                return True
+            if self.state == CB_OPEN and now >= self.retry_at:
+                self.state = CB_HALF_OPEN
+                return True
+        self.rejected.add()
+        return False
+    
+    # Returns True if circuit is closed by this success
+    def succeed(self):
+        if self.state == CB_CLOSED and not self.failures:
+            return False
+        with self.mutex:
+            self.failures = 0
+            if self.state == CB_CLOSED:
+                return False
+            self.state = CB_CLOSED
+            self.backoff = self.min_backoff
+            return True
+        
+    # Returns backoff time if circuit is opened by this failure, else None
+    def fail(self, now):
+        with self.mutex:
+            if self.state == CB_HALF_OPEN:
+                self.backoff = min(self.backoff * 2, self.max_backoff)
+            elif self.state == CB_CLOSED:
+                self.failures += 1
+                if self.failures < self.threshold:
+                    return None
+            else:
+                return None
+            self.state = CB_OPEN
+            self.retry_at = now + self.backoff
+            self.opened.add()
+            return self.backoff
+        
+    # Probe got no result, e.g. no permit, so next request probes again
+    def abort(self):
+        with self.mutex:
+            if self.state == CB_HALF_OPEN:
+                self.state = CB_OPEN
+                
+    def get_status(self):
+        return {'state': self.state,
+                'failures': self.failures,
+                'backoff': self.backoff,
+                'opened': self.opened.get(),
+                'rejected': self.rejected.get()}
+
+# Merges single id requests into one request with comma separated ids
+# Requests of a method are pending for 'window' sec from the first one or
+# until maximum number of ids in BATCH_MAX_IDS of config, then the batch
+# is put in the queue of master as one request. Its response is split
+# into response of each request by _BatchResponse.
+class _Batcher(object):
+    def __init__(self, master, window=None, max_ids=None):
+        self.master = master
+        self.window = config.BATCH_WINDOW if window == None else window
+        self.max_ids = config.BATCH_MAX_IDS if max_ids == None else max_ids
+        # pending batch for each method name
+        self.batches = {}
+        # scheduler event to flush each pending batch
+        self.flushes = {}
+        self.mutex = threading.Lock()
+        self.scheduler = scheduler.get_scheduler()
+        
+        self.batches_sent = metric.Counter()
+        self.batched_requests = metric.Counter()
+        
+    # Returns True if request can be merged with others
+    def is_batchable(self, method, args):
+        return (getattr(method, '__name__', None) in self.max_ids and
+                len(args) == 1 and not ',' in str(args[0]))
+    
+    # Add request which is_batchable
+    # res : FastResponse of request
+    # name : request name in 'res'
+    # reservation : _Reservation of bundle of request, if any
+    def add(self, res, name, method, args, priority, reservation=None):
+        key = method.__name__
+        full = None
+        self.mutex.acquire()
+        batch = self.batches.get(key)
+        if batch is None:
+            batch = _BatchResponse(self.master, method)
+            self.batches[key] = batch
+            self.flushes[key] = self.scheduler.schedule(self.window, 
+                                                        self._flush, (key, batch))
+        batch.add(res, name, args, priority, reservation)
+        if len(batch.ids) >= self.max_ids[key]:
+            del self.batches[key]
+            self.scheduler.cancel(self.flushes.pop(key))
+            full = batch
+        self.mutex.release()
+        
+        if full:
+            self._send(full)
+        
+    # Send batch of method 'key' if it is still pending
+    def _flush(self, key, batch):
+        self.mutex.acquire()
+        if self.batches.get(key) is not batch:
+            self.mutex.release()
+            return
+        del self.batches[key]
+        del self.flushes[key]
+        self.mutex.release()
+        self._send(batch)
+        
+    # Batch with reserved permit goes in front of queue like requests of
+    # bundle
+    def _send(self, batch):
+        self.batches_sent.add()
+        self.batched_requests.add(len(batch.entries))
+        args = (','.join(batch.ids),)
+        cmd_arg = (batch, ('batch', (batch.method, args)), batch.priority)
+        if batch.reservation is None:
+            self.master._push_request(batch.priority, 
+                                      (LOLFastAPI.FCMD_GET, cmd_arg))
+        else:
+            self.master._push_reserved(batch.priority, 
+                (LOLFastAPI.FCMD_GET, cmd_arg + (batch.reservation,)))
+    
+    # Returns method of each batch which requests in 'batches' make at 
+    # least, list of tuple (target, method, arguments)
+    def get_batch_methods(self, batches):
+        count = collections.Counter(method for target, method, args in batches)
+        return [method for method, num in count.items()
+                for i in range(int(math.ceil(float(num) / 
+                                             self.max_ids[method.__name__])))]
+        
+# Response of batched request, which passes split responses to 
+# FastResponse of each request in batch
+# Servants see it as FastResponse with one request.
+# Split responses are cached as if they were requested alone.
+class _BatchResponse(object):
+    def __init__(self, master, method):
+        self.master = master
+        self.method = method
+        # tuple (FastResponse, request name, id, arguments)
+        self.entries = []
+        # ids in order, without duplicates
+        self.ids = []
+        self.priority = None
+        # _Reservation of the first request of bundle, batch takes one
+        # permit of it for all requests
+        self.reservation = None
+        
+    # Note : mutex of batcher must be acquired
+    def add(self, res, name, args, priority, reservation=None):
+        id = str(args[0])
+        if not id in self.ids:
+            self.ids.append(id)
+        self.entries.append((res, name, id, args))
+        if self.priority is None or priority < self.priority:
+            self.priority = priority
+        if reservation is not None and self.reservation is None:
+            reservation.add_pending(1)
+            self.reservation = reservation
+            
+    # Cancelled or expired only if every request in batch is
+    def is_cancelled(self):
+        return all(entry[0].is_cancelled() for entry in self.entries)
+    
+    def is_expired(self):
+        return all(entry[0].is_expired() for entry in self.entries)
+    
+    # Split response of batch
+    # Data of successful response is dictionary keyed by id, each request
+    # gets the entry of its id, or not found if there's no such entry
+    # like it were requested alone. Other responses go to all as they are.
+    def add_response(self, name, tuple):
+        if tuple[0] != FS_OK or tuple[1][0][0] != config.SC_OK:
+            for res, name, id, args in self.entries:
+                res.add_response(name, tuple)
+            return
+        
+        status, data = tuple[1]
+        for res, name, id, args in self.entries:
+            if isinstance(data, dict) and id in data:
+                result = (status, {id: data[id]})
+                self.master._cache_result(self.method, args, result)
+                res.add_response(name, (FS_OK, result))
+            else:
+                res.add_response(name, (FS_OK, ((config.SC_NOT_FOUND, 'Not Found'), 
+                                                {})))
+                
+# Response of request nobody waits for, such as revalidation of cache
+class _NullResponse(object):
+    def is_cancelled(self):
+        return False
+    
+    def is_expired(self):
+        return False
+    
+    def add_response(self, name, tuple):
+        pass
+    
+# Target of request revalidating stale response of cache
+# Successful response is put in cache by servant or batch, and if it
+# fails, stale response is revalidated again by next get.
+class _Revalidation(_NullResponse):
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        
+    def add_response(self, name, tuple):
+        if tuple[0] != FS_OK or tuple[1][0][0] != config.SC_OK:
+            self.cache.fail_revalidate(self.key)
+    
+# Request in flight shared by identical requests
+# Response is passed to FastResponse of every request attached to it.
+# Servants see it as FastResponse with one request.
+# Note : response data is shared by all requests, do not modify it
+class _Flight(object):
+    def __init__(self, master, key, priority):
+        self.master = master
+        self.key = key
+        # tuple (FastResponse, request name)
+        self.entries = []
+        # priority class it's queued with, the highest of attached requests
+        # once it's promoted
+        self.priority = priority
+        # command in queue of servants, None if it's batched
+        self.get_tup = None
+        
+    # Returns True if request of class 'priority' is higher than flight
+    # Note : flight_mutex of master must be acquired
+    def attach(self, res, name, priority):
+        self.entries.append((res, name))
+        return priority < self.priority
+        
+    # Cancelled or expired only if every request attached is
+    def is_cancelled(self):
+        return all(entry[0].is_cancelled() for entry in self.entries)
+    
+    def is_expired(self):
+        return all(entry[0].is_expired() for entry in self.entries)
+    
+    def add_response(self, name, tuple):
+        # no more request can be attached after landing
+        self.master.flight_mutex.acquire()
+        if self.master.flights.get(self.key) is self:
+            del self.master.flights[self.key]
+        entries = list(self.entries)
+        self.master.flight_mutex.release()
+        
+        for res, name in entries:
+            res.add_response(name, tuple)
+            
+# Changes number of active servants and cores of LOLFastAPI by AIMD
+# Every interval it compares load of admin with the previous one and
+# decides by rules described in config (CONCURRENCY_*). Decisions are
+# kept in 'decisions' and printed in debug mode.
+class _ConcurrencyController(object):
+    def __init__(self, master, limit):
+        self.master = master
+        self.admin = master.admin
+        self.min = config.CONCURRENCY_MIN
+        self.max = max(config.CONCURRENCY_MAX, self.min)
+        if config.POOL_ON:
+            # servants more than connections of pool only wait for them
+            self.max = max(min(self.max, config.POOL_MAX_SIZE), self.min)
+        self.limit = min(max(limit, self.min), self.max)
+        self.interval = config.CONCURRENCY_INTERVAL
+        # number needed to use quota, None until latency is known
+        self.needed = None
+        self.last = None
+        self.event = None
+        self.mutex = threading.Lock()
+        
+        self.increases = metric.Counter()
+        self.decreases = metric.Counter()
+        # recent decisions, tuple (time, old limit, new limit, reason)
+        self.decisions = collections.deque(maxlen=20)
+        
+    def start(self):
+        self.last = self.admin.get_load()
+        self._schedule()
+        
+    def stop(self):
+        with self.mutex:
+            event, self.event = self.event, None
+        if event is not None:
+            scheduler.get_scheduler().cancel(event)
+        
+    def _schedule(self):
+        with self.mutex:
+            self.event = scheduler.get_scheduler().schedule(
+                self.interval, self._tick, blocking=True)
+        
+    def _tick(self):
+        try:
+            self.adjust()
+        finally:
+            with self.mutex:
+                stopped = self.event is None
+            if not stopped:
+                self._schedule()
+        
+    # Decide new limit by load in last interval and apply it
+    def adjust(self):
+        load = self.admin.get_load()
+        last, self.last = self.last, load
+        permits = load['permits'] - last['permits']
+        waited = load['waited'] - last['waited']
+        count = load['latency'][0] - last['latency'][0]
+        limited = load['limited'] - last['limited']
+        if count > 0:
+            latency = (load['latency'][1] - last['latency'][1]) / count
+            self.needed = int(math.ceil(load['rate'] * latency * 
+                                        config.CONCURRENCY_HEADROOM))
+        backlog = len(self.master.queue)
+        
+        limit, reason = self.limit, None
+        if count > 0 and limited > count * config.CONCURRENCY_LIMITED_RATIO:
+            limit = int(limit * config.CONCURRENCY_DECREASE)
+            reason = '429 %d of %d' % (limited, count)
+        elif (permits > 0 and waited > permits * config.CONCURRENCY_GATE_RATIO
+              and self.needed is not None and limit > self.needed):
+            limit -= 1
+            reason = 'permit gate %d of %d' % (waited, permits)
+        elif backlog > 0 and (self.needed is None or limit < self.needed):
+            # half of the gap at once when needed number is known
+            limit += max((self.needed or 0) - limit, 2) // 2
+            reason = 'backlog %d' % (backlog,)
+        limit = min(max(limit, self.min), self.max)
+        if limit == self.limit:
+            return
+        
+        (self.increases if limit > self.limit else self.decreases).add()
+        self.decisions.append((time.time(), self.limit, limit, reason))
+        self.admin._debug_msg('concurrency %d -> %d (%s, needed %s)' % 
+                              (self.limit, limit, reason, self.needed))
+        self.limit = limit
+        self.master.set_servant_num(limit)
+        self.admin.set_core_num(limit)
+        
+    def get_metrics(self):
+        return {'limit': self.limit,
+                'needed': self.needed,
+                'increases': self.increases.get(),
+                'decreases': self.decreases.get(),
+                'decisions': list(self.decisions)}
+        
 # LOL API with fast multiple request object  
 # This provides functionality that one thread can send multiple request
 # at once.
 # Possible commands and arguments are
 # FCMD_DIE, argument is not used
-# FCMD_GET, arg is (fastResponse, tuple returned by fastRequest iterator)
+# FCMD_GET, arg is (fastResponse, tuple returned by fastRequest iterator,
+#                   priority class)
+# FCMD_GET commands are put in a queue shared by all servants, so any idle
+# servant takes the next one and higher priority class goes first.
+# Request whose response is cancelled or whose deadline has passed is
+# dropped by servant before it asks for permit, so it does not use quota.
 class LOLFastAPI(object):
-    def __init__(self, servants=None, limit=None, key=None, cores=None, api=None):
-        self.admin = LOLAdmin(limit, key, cores, api)
+    # keys : list of keys, if more than one key is given (or in config KEYS
+    #        when neither key nor keys is given), LOLKeyManager is used
+    #        instead of LOLAdmin
+    def __init__(self, servants=None, limit=None, key=None, cores=None, api=None,
+                 keys=None):
+        if keys is None:
+            keys = [key] if key is not None else config.KEYS
+        if len(keys) > 1:
+            self.admin = LOLKeyManager(keys, cores, limit, api)
+        else:
+            self.admin = LOLAdmin(limit, keys[0], cores, api)
+        self.api = LOLAPI if api == None else api
+        self.key = keys[0]
         self.servant_num = servants if servants else config.SERVANT_NUM
         self.servants = []                          # list of servant thread objects
-        self.servant_idx = 0                        # next servant index
+        # changes servant_num and core number, None if it's off
+        self.controller = None
+        if config.CONCURRENCY_ON:
+            self.controller = _ConcurrencyController(self, self.servant_num)
         self.state = _StateMachine(LOLFastAPI.S_OK) # state of servants
         
-        self.get_mutex = threading.Lock()
+        # requests shared by servants, servants wait on queue_cond
+        self.queue = _PriorityQueue()
+        self.queue_cond = threading.Condition()
+        # bundles of requests waiting for reservation, one servant at a 
+        # time reserves permits for a bundle, and only when requests of 
+        # reserved bundles are all taken from queue
+        self.bundle_queue = _PriorityQueue()
+        self.reserving = False
+        self.reserved_queued = 0
+        self.reserved_bundles = metric.Counter()
+        # merges single id requests, None if batching is off
+        self.batcher = _Batcher(self) if config.BATCH_ON else None
+        # requests in flight keyed by (method, args)
+        self.dedup = config.DEDUP_ON
+        self.flights = {}
+        self.flight_mutex = threading.Lock()
+        self.dedup_hits = metric.Counter()
+        self.dedup_misses = metric.Counter()
+        # responses of slowly changing data, None if cache is off
+        self.cache = None
+        if config.CACHE_ON:
+            self.cache = cache.ResponseCache(config.CACHE_MAX_BYTES, 
+                                             config.CACHE_STALE_TIME)
+        # static data shared by processes, None if store is off
+        self.static = None
+        if config.STATIC_STORE_ON:
+            self.static = static_store.StaticStore()
+        # scheduled check of new static version, None if not scheduled
+        self.static_event = None
+        self.static_mutex = threading.Lock()
         
         self.keep_alive_on = config.KEEP_ALIVE_ON
+        self.keep_alive_mode = config.KEEP_ALIVE_MODE
+        # number of requests sent just to keep connection alive
+        self.keep_alive_requests = metric.Counter()
+        # number of requests dropped for cancel or deadline
+        self.skipped_requests = metric.Counter()
         self.spec = self.admin.get_spec()
     
     # Commands master can give to servant
     FCMD_DIE = 0    # stop routine and return
     FCMD_GET = 1    # get api data
+    FCMD_BUNDLE = 2 # reserve permits for bundle and get its api data
     
     # Servants state
     S_OK = 0        # OK
@@ -1053,6 +2191,8 @@ class LOLFastAPI(object):
             self.master = master
             self.admin = master.admin
             self.id = id
+            # all servants wait for requests in queue of master
+            self.cond = master.queue_cond
             
             # servant is state machine
             self.state = self.master.state
@@ -1069,6 +2209,46 @@ class LOLFastAPI(object):
                 self.state.end_state_switch()
             else:
                 self.state.end_event()
+                
+        # Commands to this servant are given through shared condition,
+        # so every servant is woken up to find its own
+        def order(self, tup):
+            self.cond.acquire()
+            self.requests.append(tup)
+            self.cond.notifyAll()
+            self.cond.release()
+            
+        # Servants over servant_num of master are parked, they only take
+        # commands to them
+        def _is_active(self):
+            return self.id < self.master.servant_num
+            
+        # Commands to this servant go first, then requests in queue
+        # Requests of method whose rate limit bucket is full are skipped
+        # while there are the others.
+        # Note : self.cond must be acquired
+        def _pop_request(self):
+            if self.requests:
+                return self.requests.popleft()
+            if not self._is_active():
+                raise IndexError('servant is parked')
+            if self.master._can_reserve():
+                self.master.reserving = True
+                return self.master.bundle_queue.pop()
+            tup = self.master.queue.pop(self._is_ready)
+            if len(tup[1]) > 3:
+                self.master.reserved_queued -= 1
+            return tup
+        
+        def _is_ready(self, tup):
+            try:
+                if len(tup[1]) > 3:
+                    # permit is reserved
+                    return True
+                method = tup[1][1][1][0]
+            except (IndexError, TypeError):
+                return True
+            return self.admin.is_method_ready(method)
             
         def routine(self):
             while True:
@@ -1080,7 +2260,7 @@ class LOLFastAPI(object):
                         #print 'LOOP START (' + str(self.id) + ')'
                         if loop < 2:
                             loop += 1
-                            tup = self.requests.popleft()
+                            tup = self._pop_request()
                             first = True
                             break                                
                         else:
@@ -1091,9 +2271,13 @@ class LOLFastAPI(object):
                     except IndexError:
                         self.cond.release()
                         if self.state.start_event([LOLFastAPI.S_OK])[0]:
-                            if not first and self.master.keep_alive_on:
+                            # in other modes, pool keeps connections alive
+                            if (not first and self.master.keep_alive_on and
+                                self.master.keep_alive_mode == config.KA_REQUEST
+                                and self._is_active()):
                                 try:
                                     #print 'test data'
+                                    self.master.keep_alive_requests.add()
                                     self.admin.get_test_data()
                                     #print 'test data end'
                                 except Exception:
@@ -1103,15 +2287,64 @@ class LOLFastAPI(object):
                             self._check_status()
                         first = False
                         self.cond.acquire()
-                        self.cond.wait(config.KEEP_ALIVE_INTERVAL)
+                        # request may have come while cond is released
+                        if not self.requests and (not self._is_active() or
+                            not (self.master.queue or self.master._can_reserve())):
+                            self.cond.wait(config.KEEP_ALIVE_INTERVAL)
                 self.cond.release()
                 
                 cmd = tup[0]
                 if cmd == LOLFastAPI.FCMD_DIE:
                     break
                 elif cmd == LOLFastAPI.FCMD_GET:
-                    self._serve_get(tup)
+                    try:
+                        self._serve_get(tup)
+                    finally:
+                        if len(tup[1]) > 3:
+                            tup[1][3].done()
+                elif cmd == LOLFastAPI.FCMD_BUNDLE:
+                    self._serve_bundle(tup)
                     
+        # Reserve permits for all requests of bundle at once, then they are
+        # put in front of queue. If it fails, they are sent one by one.
+        # Batchable requests go to batcher, one permit is reserved for each
+        # batch they make.
+        def _serve_bundle(self, tup):
+            get_tups, priority, batches = tup[1]
+            reservation = None
+            try:
+                get_tups = [get_tup for get_tup in get_tups if not 
+                            self.master._drop_request(get_tup[1][0], 
+                                                      get_tup[1][1][0])]
+                batches = [batch for batch in batches if not
+                           self.master._drop_request(*batch[0])]
+                if ((get_tups or batches) and 
+                    self.state.start_event([LOLFastAPI.S_OK])[0]):
+                    methods = [get_tup[1][1][1][0] for get_tup in get_tups]
+                    if batches:
+                        methods.extend(
+                            self.master.batcher.get_batch_methods(batches))
+                    responses = ([get_tup[1][0] for get_tup in get_tups] + 
+                                 [batch[0][0] for batch in batches])
+                    try:
+                        reservation = self.admin.reserve(
+                            methods, priority, self._get_timeout(responses))
+                    except Error:
+                        pass
+                    finally:
+                        self.state.end_event()
+            finally:
+                self.master._end_bundle(priority, get_tups, reservation, 
+                                        batches)
+        
+        # Returns time in second until the earliest deadline of responses
+        def _get_timeout(self, responses):
+            deadlines = [getattr(res, 'deadline', None) for res in responses]
+            deadlines = [deadline for deadline in deadlines if deadline]
+            if not deadlines:
+                return None
+            return max(min(deadlines) - time.time(), 0.0)
+            
         def _serve_get(self, tup):
             try:
                 cmd_arg = tup[1]
@@ -1121,19 +2354,28 @@ class LOLFastAPI(object):
                 method = req_tup[0]
                 args = req_tup[1]
                 res = cmd_arg[0]
+                priority = cmd_arg[2]
+                reservation = cmd_arg[3] if len(cmd_arg) > 3 else None
             except Exception as err:
                 res_tup = (FS_ERROR, str(err))
                 res.add_response(req_name, res_tup)
                 return
             
+            if self.master._drop_request(res, req_name):
+                return
+            
             if self.state.start_event([LOLFastAPI.S_OK])[0]:
                 do_end = True
                 try:
                     #print '\nget data' + str(self.id) + '\n'
-                    result = self.admin.get_data(method, args)
+                    result = self.admin.get_data(method, args, priority,
+                                                 reservation)
                     #print '\n' + req_name +' get data end\n'
                 except TimeoutError as err:
                     res_tup = (FS_TIMEOUT, str(err))
+                except CircuitOpenError as err:
+                    # only this method is unavailable
+                    res_tup = (FS_SERVICE_UNAVAILABLE, str(err))
                 except ServiceUnavailableError as err:
                     res_tup = (FS_SERVICE_UNAVAILABLE, str(err))
                     # Go to service unavailable state
@@ -1146,6 +2388,9 @@ class LOLFastAPI(object):
                     res_tup = (FS_ERROR, str(err))
                 else:
                     res_tup = (FS_OK, result)
+                    # batch caches its split responses
+                    if not isinstance(res, _BatchResponse):
+                        self.master._cache_result(method, args, result)
                     
                 if do_end:
                     self.state.end_event()
@@ -1159,13 +2404,38 @@ class LOLFastAPI(object):
     # Initialize serving threads
     def start_multiple_get_mode(self):
         self.admin.init()
+        self._set_pool_keep_alive()
+        if self.static:
+            self.static.open()
+            self.refresh_static()
+            self._start_static_refresh()
         for i in range(self.servant_num):
-            servant = self._servant(self, i)
-            self.servants.append(servant)
-            servant.daemon = True
-            servant.start()
+            self._start_servant()
+        if self.controller:
+            self.controller.start()
+            
+    def _start_servant(self):
+        servant = self._servant(self, len(self.servants))
+        self.servants.append(servant)
+        servant.daemon = True
+        servant.start()
+        
+    # Change number of active servants
+    # New servants are started if needed, the others are parked
+    def set_servant_num(self, num):
+        num = max(num, 1)
+        self.queue_cond.acquire()
+        self.servant_num = num
+        # parked servants may take requests now
+        self.queue_cond.notifyAll()
+        self.queue_cond.release()
+        while len(self.servants) < num:
+            self._start_servant()
     
     def close_multiple_get_mode(self):
+        self._stop_static_refresh()
+        if self.controller:
+            self.controller.stop()
         die_tup = (self.FCMD_DIE, None)
         for servant in self.servants:
             servant.order(die_tup)
@@ -1174,27 +2444,307 @@ class LOLFastAPI(object):
             servant.join(60)
             
         self.servants = []
-        self.servant_idx = 0
     
     # Returns fastResponse object which will get responses
     # from servants
     # fast_req : fastRequest object containing caller's requests
     def get_multiple_data(self, fast_req):
-        self.get_mutex.acquire()
-        req_num = fast_req.get_request_num()
-        res = FastResponse(req_num)
-        for req_tup in fast_req:
-            get_tup = (self.FCMD_GET, (res, req_tup))
-            servant = self.servants[self.servant_idx]
-            servant.order(get_tup)
-            self.servant_idx += 1
-            self.servant_idx %= self.servant_num
-        #print 'adddddded'
-        self.get_mutex.release()
+        res = FastResponse(fast_req.get_request_num(), fast_req.get_deadline())
+        self._get_multiple_data(fast_req, res)
         return res
     
+    # Send requests in 'fast_req' whose responses go to 'res'
+    def _get_multiple_data(self, fast_req, res):
+        priority = fast_req.get_priority()
+        bundle = fast_req.is_bundle()
+        gets = []
+        batches = []
+        for name, (method, args) in fast_req:
+            if self.cache and self._serve_cached(res, name, method, args):
+                continue
+            target = (res, name)
+            if self.dedup:
+                target = self._take_off(res, name, method, args, priority)
+                if target is None:
+                    # attached to identical request in flight
+                    continue
+            if self.batcher and self.batcher.is_batchable(method, args):
+                batches.append((target, method, args))
+            else:
+                get_tup = (self.FCMD_GET, 
+                           (target[0], (target[1], (method, args)), priority))
+                if isinstance(target[0], _Flight):
+                    target[0].get_tup = get_tup
+                gets.append(get_tup)
+                
+        if bundle and len(gets) + len(batches) > 1:
+            self._push_bundle(priority, gets, batches)
+            return
+        self._push_requests(priority, gets)
+        for target, method, args in batches:
+            self.batcher.add(target[0], target[1], method, args, priority)
+    
+    # Returns TTL of response of 'method', None if it's not cached
+    def _get_cache_ttl(self, method):
+        name = getattr(method, '__name__', '')
+        if name in config.CACHE_TTL:
+            return config.CACHE_TTL[name]
+        if name.startswith('get_static_'):
+            return config.CACHE_STATIC_TTL
+        return None
+    
+    # Respond with cached response if there is, returns True if responded
+    # Stale response is requested again in background
+    def _serve_cached(self, res, name, method, args):
+        if self._get_cache_ttl(method) is None:
+            return False
+        cached = self.cache.get((method, args))
+        if cached is None:
+            return False
+        result, revalidate = cached
+        res.add_response(name, (FS_OK, result))
+        if revalidate:
+            target = _Revalidation(self.cache, (method, args))
+            if self.batcher and self.batcher.is_batchable(method, args):
+                self.batcher.add(target, 'revalidate', method, args, PR_BACKGROUND)
+            else:
+                self._push_request(PR_BACKGROUND, (self.FCMD_GET, 
+                    (target, ('revalidate', (method, args)), PR_BACKGROUND)))
+        return True
+    
+    # Cache successful response of cached method
+    def _cache_result(self, method, args, result):
+        if not self.cache or result[0][0] != config.SC_OK:
+            return
+        ttl = self._get_cache_ttl(method)
+        if ttl is not None:
+            self.cache.put((method, args), result, ttl)
+            
+    # Attach request to identical one in flight and returns None, or
+    # returns tuple (response, request name) to send it with.
+    # New request is sent as flight other ones can be attached to.
+    # Flight waiting in queue is promoted to class of request attached if 
+    # it's higher, so that request does not wait in lower class.
+    def _take_off(self, res, name, method, args, priority=PR_NORMAL):
+        key = (method, args)
+        self.flight_mutex.acquire()
+        try:
+            flight = self.flights.get(key)
+        except TypeError:
+            # unhashable arguments, cannot be compared
+            self.flight_mutex.release()
+            return (res, name)
+        if flight is not None:
+            higher = flight.attach(res, name, priority)
+            self.flight_mutex.release()
+            self.dedup_hits.add()
+            if higher:
+                self._promote(flight, priority)
+            return None
+        flight = _Flight(self, key, priority)
+        flight.attach(res, name, priority)
+        self.flights[key] = flight
+        self.flight_mutex.release()
+        self.dedup_misses.add()
+        return (flight, 'flight')
+    
+    # Put commands in queue of servants
+    def _push_requests(self, priority, get_tups):
+        self.queue_cond.acquire()
+        # parked servant may be woken up instead of active one
+        parked = len(self.servants) > self.servant_num
+        for get_tup in get_tups:
+            self.queue.push(priority, get_tup)
+            if not parked:
+                self.queue_cond.notify()
+        if parked:
+            self.queue_cond.notifyAll()
+        self.queue_cond.release()
+        
+    def _push_request(self, priority, get_tup):
+        self._push_requests(priority, [get_tup])
+        
+    def _promote(self, flight, priority):
+        self.queue_cond.acquire()
+        self._move_flight(flight, priority)
+        self.queue_cond.notify()
+        self.queue_cond.release()
+        
+    # Move flight in queue to lane of class 'priority' if it's higher
+    # Flight taken by servant or batched is left as it is.
+    # Note : queue must be guarded
+    def _move_flight(self, flight, priority):
+        get_tup = flight.get_tup
+        if get_tup is None or priority >= flight.priority:
+            return
+        try:
+            self.queue.lanes[flight.priority].remove(get_tup)
+        except ValueError:
+            return
+        cmd, (res, req_tup, old) = get_tup
+        flight.get_tup = (cmd, (res, req_tup, priority))
+        flight.priority = priority
+        self.queue.push(priority, flight.get_tup)
+        
+    # Put requests of bundle in queue of servants as one command
+    # batches : list of tuple (target, method, arguments) of requests to 
+    #           be batched
+    def _push_bundle(self, priority, get_tups, batches):
+        self.queue_cond.acquire()
+        self.bundle_queue.push(priority, 
+                               (self.FCMD_BUNDLE, (get_tups, priority, batches)))
+        self.queue_cond.notifyAll()
+        self.queue_cond.release()
+        
+    # Returns True if servant can take bundle to reserve permits for
+    # Note : queue_cond must be acquired
+    def _can_reserve(self):
+        return (len(self.bundle_queue) > 0 and not self.reserving and 
+                self.reserved_queued <= 0)
+    
+    # Put requests of bundle in front of queue with 'reservation', or at
+    # the end if it's None, and let next bundle be taken
+    # Requests in 'batches' go to batcher with 'reservation'. It's held 
+    # until they are added, and then permits not taken by their batches 
+    # are given back when the other requests are done.
+    def _end_bundle(self, priority, get_tups, reservation, batches=()):
+        first = reservation is not None
+        if first:
+            self.reserved_bundles.add()
+            get_tups = [(cmd, cmd_arg + (reservation,)) 
+                        for cmd, cmd_arg in reversed(get_tups)]
+            if batches:
+                reservation.add_pending(
+                    1 - len(self.batcher.get_batch_methods(batches)))
+        self.queue_cond.acquire()
+        self.reserving = False
+        for get_tup in get_tups:
+            self.queue.push(priority, get_tup, first)
+        if first:
+            self.reserved_queued += len(get_tups)
+        self.queue_cond.notifyAll()
+        self.queue_cond.release()
+        if not batches:
+            return
+        for target, method, args in batches:
+            self.batcher.add(target[0], target[1], method, args, priority,
+                             reservation)
+        if first:
+            reservation.done()
+        
+    # Put command with reserved permit in front of queue
+    def _push_reserved(self, priority, get_tup):
+        self.queue_cond.acquire()
+        self.queue.push(priority, get_tup, True)
+        self.reserved_queued += 1
+        self.queue_cond.notifyAll()
+        self.queue_cond.release()
+        
+    # Respond to request nobody will read and returns True, so that it's
+    # not sent and does not spend quota
+    def _drop_request(self, res, name):
+        if res.is_cancelled():
+            self.skipped_requests.add()
+            res.add_response(name, (FS_CANCELLED, "Request cancelled"))
+            return True
+        if res.is_expired():
+            self.skipped_requests.add()
+            res.add_response(name, (FS_TIMEOUT, "Deadline expired"))
+            return True
+        return False
+    
+    # Write static data again if new version is out
+    # Static data API does not use quota, so it's requested directly
+    # Returns True if written, False if not or failed
+    def refresh_static(self):
+        if not self.static:
+            return False
+        api = self.api(key=self.key)
+        api.set_debug_mode(0)
+        try:
+            api.init_static()
+            return self.static.refresh(api)
+        except Exception as err:
+            self.admin._debug_msg('static data refresh failed : %s' % (err,))
+            return False
+        finally:
+            api.close()
+            
+    # Check new version of static data every STATIC_REFRESH_INTERVAL sec
+    # in worker of scheduler until multiple get mode is closed
+    def _start_static_refresh(self):
+        if config.STATIC_REFRESH_INTERVAL:
+            self._schedule_static_refresh()
+            
+    def _stop_static_refresh(self):
+        with self.static_mutex:
+            event, self.static_event = self.static_event, None
+        if event is not None:
+            scheduler.get_scheduler().cancel(event)
+            
+    def _schedule_static_refresh(self):
+        with self.static_mutex:
+            self.static_event = scheduler.get_scheduler().schedule(
+                config.STATIC_REFRESH_INTERVAL, self._static_refresh_tick,
+                blocking=True)
+            
+    def _static_refresh_tick(self):
+        try:
+            self.refresh_static()
+        finally:
+            with self.static_mutex:
+                stopped = self.static_event is None
+            if not stopped:
+                self._schedule_static_refresh()
+            
+    # Returns static data of 'kind' ('champion', 'item', 'rune', 'mastery')
+    # with 'id', None if not found or store is off
+    def get_static(self, kind, id):
+        if not self.static:
+            return None
+        return self.static.get(kind, id)
+    
     def set_keep_alive(self, level):
         self.keep_alive_on = level
+        self._set_pool_keep_alive()
+        
+    def _set_pool_keep_alive(self):
+        if self.keep_alive_on and self.keep_alive_mode == config.KA_RECONNECT:
+            pool.set_min_idle(config.KEEP_ALIVE_MIN_IDLE)
+        else:
+            pool.set_min_idle(0)
+            
+    # Returns metrics of fast api
+    # 'keep_alive_requests' is number of requests (quota) used for keep alive
+    # 'skipped_requests' is number of requests dropped for cancel or deadline
+    # 'reserved_bundles' is number of bundles sent with reserved permits
+    def get_metrics(self):
+        r = {}
+        r['keep_alive_mode'] = self.keep_alive_mode
+        r['keep_alive_requests'] = self.keep_alive_requests.get()
+        r['skipped_requests'] = self.skipped_requests.get()
+        r['reserved_bundles'] = self.reserved_bundles.get()
+        if self.batcher:
+            # requests merged into 'batches' requests
+            r['batched_requests'] = self.batcher.batched_requests.get()
+            r['batches'] = self.batcher.batches_sent.get()
+        r['dedup_hits'] = self.dedup_hits.get()
+        r['dedup_misses'] = self.dedup_misses.get()
+        if self.cache:
+            r['cache'] = self.cache.get_metrics()
+        # timer events and batch flushes
+        r['scheduler'] = scheduler.get_scheduler().get_metrics()
+        r['cores'] = self.admin.get_core_status()
+        r['breakers'] = self.admin.get_breaker_status()
+        r['buckets'] = self.admin.get_bucket_status()
+        if self.controller:
+            r['concurrency'] = self.controller.get_metrics()
+        self.queue_cond.acquire()
+        r['queued'] = [len(lane) for lane in self.queue.lanes]
+        r['queued_bundles'] = [len(lane) for lane in self.bundle_queue.lanes]
+        self.queue_cond.release()
+        r['pool'] = pool.get_metrics()
+        return r
         
     def set_debug(self, level):
         self.admin.set_debug(level)
@@ -1207,107 +2757,162 @@ FS_OK = 0
 FS_TIMEOUT = 1
 FS_ERROR = 2
 FS_SERVICE_UNAVAILABLE = 3
+FS_CANCELLED = 4
 
+# Wait modes of FastResponse.wait
+W_ANY = 0       # until any of target requests is responded
+W_ALL = 1       # until all of target requests are responded
+
+# Response of each request is completed once by add_response, like future.
+# Threads wait only on requests they are interested in, so a response 
+# wakes up threads waiting for it, or for any or all of responses, and 
+# waiters are removed when they return.
 class FastResponse(object):
-    def __init__(self, req_num):
+    # deadline : absolute time (as time.time()) after which requests not 
+    #            sent yet are dropped, None for no deadline
+    def __init__(self, req_num, deadline=None):
         self.req_num = req_num
         self.response_num = 0
         self.read_num = 0
+        # response by request name
         self.responses = {}
-        self.cond = threading.Condition()
-        
-        self.waits = []
+        # names of responses in order of response, and names already read
+        # read ones are skipped when reached
+        self.unread = collections.deque()
+        self.read = set()
+        self.mutex = threading.Lock()
+        # conditions of threads waiting for each request name
+        self.waiters = {}
+        # conditions of threads waiting for any or all requests
+        self.any_waiters = []
+        self.all_waiters = []
+        self.deadline = deadline
+        self.cancelled = False
         
     class _iterator(object):
         def __init__(self, response):
             self.response = response
-            self.responses = self.response.responses
-            self.cond = self.response.cond
-            self.cond.acquire()
-            self.iter = self.responses.__iter__()
+            
+        def __iter__(self):
+            return self
             
         def __next__(self):
-            while True:
-                try:
-                    name = next(self.iter)
-                    if not self.responses[name][1]:
-                        continue
-                    self.responses[name][1] = False
-                    self.response.read_num += 1
-                    return (name, self.responses[name][0])
-                except StopIteration:
-                    self.cond.release()
-                    raise StopIteration()
+            result = self.response.next_response()
+            if result is None:
+                raise StopIteration()
+            return result
             
         def close(self):
-            while True:
-                try:
-                    next(self.iter)
-                except StopIteration:
-                    break
-            self.cond.release()
+            pass
             
     # return iterator object for responses
     # it iterates through only non-read new responses
     def __iter__(self):
         return self._iterator(self)
-        
+    
+    # Mark response read and returns tuple (request name, response)
+    # Lock must be held
+    def _read(self, name):
+        self.read.add(name)
+        self.read_num += 1
+        return (name, self.responses[name])
+    
+    # Returns name of the first unread response among 'names', or of 
+    # the first unread one if 'names' is None. None if there's no such one
+    # Lock must be held
+    def _next_unread(self, names):
+        if names is None:
+            while self.unread:
+                name = self.unread.popleft()
+                if name not in self.read:
+                    return name
+            return None
+        for name in names:
+            if name in self.responses and name not in self.read:
+                return name
+        return None
+    
+    # Lock must be held
+    def _is_done(self, names, mode):
+        if names is None:
+            if mode == W_ALL:
+                return self.response_num >= self.req_num
+            return self.response_num > 0
+        if mode == W_ALL:
+            return all(name in self.responses for name in names)
+        return any(name in self.responses for name in names)
+    
+    # Lock must be held
+    def _add_waiter(self, waiter, names, mode):
+        if names is None:
+            (self.all_waiters if mode == W_ALL else self.any_waiters).append(waiter)
+        else:
+            for name in names:
+                self.waiters.setdefault(name, []).append(waiter)
+                
+    # Lock must be held
+    def _remove_waiter(self, waiter, names, mode):
+        if names is None:
+            (self.all_waiters if mode == W_ALL else self.any_waiters).remove(waiter)
+        else:
+            for name in names:
+                waiters = self.waiters[name]
+                waiters.remove(waiter)
+                if not waiters:
+                    del self.waiters[name]
+                
     # Add response
     # If multiple responses with same name are added,
     # only first response is added and the others are ignored.
-    # If all requests are served, it notifies requester
+    # Threads waiting for it are notified
     # name: name of request in request dictionary
     # tuple : tuple (status_code, data)
     #         'status code' is one of FS_* value
     #         'data' is returned data from API or error message
     def add_response(self, name, tuple):
-        self.cond.acquire()
-        if name in self.responses:
-            self.cond.release()
-            return
-        self.responses[name] = [tuple, True] # data, unread(True)
-        self.response_num += 1
-        # notify requestor
-        if self.response_num >= self.req_num:
-            self.cond.notifyAll()
-            
-        for wait in self.waits:
-            cond = wait[0]
-            found = True
-            if wait[1]:
-                if not name in wait[1]:
-                    found = False
-            if found:
-                cond.acquire()
-                cond.notify()
-                cond.release()
-        self.cond.release()
-        
+        with self.mutex:
+            if name in self.responses:
+                return
+            self.responses[name] = tuple
+            self.unread.append(name)
+            self.response_num += 1
+            waiters = self.waiters.get(name)
+            if waiters:
+                for waiter in waiters:
+                    waiter.notify()
+            for waiter in self.any_waiters:
+                waiter.notify()
+            if self.all_waiters and self.response_num >= self.req_num:
+                for waiter in self.all_waiters:
+                    waiter.notify()
+                    
+    # Wait until requests in 'names' (all requests if None) are responded 
+    # mode : W_ALL to wait for all of them, W_ANY to wait for any of them
+    # Returns False if 'timeout' expires, True otherwise
+    def wait(self, names=None, mode=W_ALL, timeout=None):
+        end = None if timeout is None else time.time() + timeout
+        waiter = None
+        with self.mutex:
+            try:
+                while not self._is_done(names, mode):
+                    if waiter is None:
+                        waiter = threading.Condition(self.mutex)
+                        self._add_waiter(waiter, names, mode)
+                    left = None if end is None else end - time.time()
+                    if left is not None and left <= 0:
+                        return False
+                    waiter.wait(left)
+                return True
+            finally:
+                if waiter is not None:
+                    self._remove_waiter(waiter, names, mode)
+                    
     # Wait for responses
     # If 'timeout' is specified, if not all request have gotten
     # response until timeout, it returns False
     # If all response is got, return True
     def wait_response(self, timeout=None):
-        ret = True
-        first = True
-        left = timeout
-        self.cond.acquire()
-        while True:
-            if self.req_num <= self.response_num:
-                break
-            if first:
-                begin = time.time()
-                first = False
-            self.cond.wait(left)
-            end = time.time()
-            if left is not None:
-                elapsed = end - begin
-                left -= elapsed
-                if left <= 0:
-                    ret = False
-                    break
-        self.cond.release()
-        return ret
+        return self.wait(None, W_ALL, timeout)
     
     # If target reponses are responded and unread, returns response immediately
     # If not, it waits until responded.
@@ -1318,101 +2923,96 @@ class FastResponse(object):
     # If 'list' is not None, 'list' should contain strings of request name
     # returned value is tuple (request name, response) if it's not None
     def wait_target_response(self, list=None, timeout=None):
-        ret = None
-        first = True
-        left = timeout
-        to = False
-        list = copy.copy(list) if list else None
-        self.cond.acquire()
+        names = list or None
+        end = None
+        waiter = None
+        with self.mutex:
+            try:
+                while True:
+                    name = self._next_unread(names)
+                    if name is not None:
+                        return self._read(name)
+                    if self.response_num >= self.req_num:
+                        return None
+                    if names is not None and self._is_done(names, W_ALL):
+                        return None
+                    if waiter is None:
+                        waiter = threading.Condition(self.mutex)
+                        self._add_waiter(waiter, names, W_ANY)
+                        if timeout is not None:
+                            end = time.time() + timeout
+                    left = None if end is None else end - time.time()
+                    if left is not None and left <= 0:
+                        raise TimeoutError('response wait timeout')
+                    waiter.wait(left)
+            finally:
+                if waiter is not None:
+                    self._remove_waiter(waiter, names, W_ANY)
+                    
+    # Generator of unread responses among 'names' (all if None) in order 
+    # of response, which yields tuple (request name, response) as each 
+    # request is responded
+    # If 'timeout' expires before all are responded, raises TimeoutError
+    def as_completed(self, names=None, timeout=None):
+        end = None if timeout is None else time.time() + timeout
         while True:
-            found = False
-            if list:
-                for name in list:
-                    try:
-                        res = self.responses[name]
-                    except KeyError:
-                        continue
-                    else:
-                        if res[1]:
-                            res[1] = False
-                            ret = (name, res[0])
-                            found = True
-                            break
-                if found:
-                    break
-            else:
-                for name in self.responses:
-                    if self.responses[name][1]:
-                        self.responses[name][1] = False
-                        ret = (name, self.responses[name][0])
-                        found = True
-                        break
-                if found:
-                    break
-            if self.req_num <= self.response_num:
-                break
-            if first:
-                begin = time.time()
-                first = False
-                wait = threading.Condition()
-                self.waits.append((wait, list))
-            wait.acquire()
-            self.cond.release()
-            wait.wait(left)
-            end = time.time()
-            wait.release()
-            self.cond.acquire()
-            if left is not None:
-                elapsed = end - begin
-                left -= elapsed
-                if left <= 0:
-                    ret = False
-                    to = True
-                    break
-        self.cond.release()
-        if to:
-            raise TimeoutError('response wait timeout')
-        return ret
+            left = None if end is None else max(end - time.time(), 0.0)
+            result = self.wait_target_response(names, left)
+            if result is None:
+                return
+            yield result
             
     # If responded, it will return tuple
     # If not responded, return None
     def get_response(self, name):
-        self.cond.acquire()
-        if name in self.responses:
-            self.responses[name][1] = False
-            self.read_num += 1
-            ret = self.responses[name][0]
-            self.cond.release()
-            return ret
-        self.cond.release()
-        return None
+        with self.mutex:
+            if name not in self.responses:
+                return None
+            return self._read(name)[1]
     
     # returns next unread response
     # if no new reponse, return None
     def next_response(self):
-        iter = self.__iter__()
-        try:
-            result = next(iter)
-            iter.close()
-            return result
-        except StopIteration:
-            return None
+        with self.mutex:
+            name = self._next_unread(None)
+            if name is None:
+                return None
+            return self._read(name)
         
     # returns true if all requests are responded,
     # false otherwise.
     def responded_all(self):
-        self.cond.acquire()
-        result = self.req_num <= self.response_num
-        self.cond.release()
-        return result
+        return self.response_num >= self.req_num
+    
+    # Cancel requests which are not sent yet
+    # They get response with FS_CANCELLED status. Requests being sent
+    # already get their responses as usual.
+    def cancel(self):
+        self.cancelled = True
+        
+    def is_cancelled(self):
+        return self.cancelled
+    
+    # returns true if deadline has passed
+    def is_expired(self):
+        return self.deadline is not None and time.time() >= self.deadline
         
+
 # request is not thread safe
 class FastRequest(object):
-    def __init__(self):
+    # priority : priority class of all requests, one of PR_* value
+    # deadline : absolute time (as time.time()) after which requests not
+    #            sent yet are dropped with FS_TIMEOUT, None for no deadline
+    def __init__(self, priority=PR_NORMAL, deadline=None):
+        if not 0 <= priority < len(config.PRIORITY_SHARES):
+            raise InvalidUseError("Unknown priority class")
         # list of tuple (method, arg)
         self.req_num = 0
         self.counter = 0
         self.reqs = {}
+        self.priority = priority
+        self.deadline = deadline
+        self.bundle = False
         
     # it is actually not redundant
     class _iterator(object):
@@ -1453,6 +3053,25 @@ class FastRequest(object):
         
     def get_request_num(self):
         return self.req_num
+    
+    def get_priority(self):
+        return self.priority
+    
+    def set_deadline(self, deadline):
+        self.deadline = deadline
+        
+    def get_deadline(self):
+        return self.deadline
+    
+    # If 'bundle' is True, permits for all requests are reserved at once
+    # before any is sent, and bundles reserved before are finished first.
+    # Batchable requests of bundle are still batched, and one permit is 
+    # reserved for each batch they make.
+    def set_bundle(self, bundle=True):
+        self.bundle = bundle
+        
+    def is_bundle(self):
+        return self.bundle
 
 '''
 errno
@@ -1466,6 +3085,8 @@ E_INITIALIZE_ERROR = 4
 E_TIMEOUT_ERROR = 5
 E_INVALID_USE = 6
 E_POLICY_FAILED = 7
+E_CIRCUIT_OPEN = 8
+E_POOL_EXHAUSTED = 9
     
 class Error(Exception):
     def __init__(self, msg, errno=None):
@@ -1507,6 +3128,16 @@ class PolicyFailedError(Error):
     def __init__(self, msg):
         Error.__init__(self, msg, E_POLICY_FAILED)    
         
+class CircuitOpenError(Error):
+    def __init__(self, msg):
+        Error.__init__(self, msg, E_CIRCUIT_OPEN)    
+        
+# No connection of pool was left for request, it was not sent and its 
+# permit was given back
+class PoolExhaustedError(Error):
+    def __init__(self, msg):
+        Error.__init__(self, msg, E_POOL_EXHAUSTED)    
+        
 # tests
 if __name__ == '__mafin__':
     print('keep alive test')
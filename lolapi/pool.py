@@ -0,0 +1,259 @@
+# Pentakill connection pool 1.0
+#
+# Keep-alive connections to hosts of LOL API are shared by all LOLAPI
+# objects in a process. LOLAPI borrows a connection for each request and
+# gives it back after reading response, so connection made by one core
+# can be used by any other core or servant.
+#
+# Idle connection is checked whether server has closed it before it is
+# handed out, and idle connections are closed by reaper thread after
+# POOL_IDLE_TIMEOUT. Time taken to connect (TCP and TLS handshakes) is
+# reported by get_metrics().
+#
+# For keep alive without requests (KEEP_ALIVE_MODE in config), sockets
+# have TCP keep-alive option, and the reaper keeps 'min_idle' connections
+# ready by making new ones in place of closed ones.
+
+from pentakill.lolapi import http
+from pentakill.lolapi import config
+from pentakill.lib import metric
+import threading
+import collections
+import select
+import socket
+import time
+
+class ConnectionPool(object):
+    # cls : connection class (http.HTTP or http.HTTPS)
+    # max_size : maximum number of connections including borrowed ones
+    # idle_timeout : idle connection older than this is closed
+    def __init__(self, cls, host, port, timeout=None, max_size=None,
+                 idle_timeout=None):
+        self.cls = cls
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.max_size = max_size or config.POOL_MAX_SIZE
+        self.idle_timeout = idle_timeout or config.POOL_IDLE_TIMEOUT
+        # number of idle connections reaper keeps ready
+        self.min_idle = _min_idle
+
+        # idle connections in tuple (connection, time when released)
+        # the most recently used one is at the right end
+        self.idle = collections.deque()
+        # number of connections, both idle and borrowed
+        self.size = 0
+        self.cond = threading.Condition()
+
+        self.created = metric.Counter()
+        self.reused = metric.Counter()
+        self.discarded = metric.Counter()
+        self.warmed = metric.Counter()
+        self.connect_time = metric.Average()
+
+    # Borrow connection which is connected to host
+    # If all connections are borrowed, it waits until one is released
+    # When 'timeout' elapses, raises PoolExhausted. It is not a timeout of
+    # server, request has not been sent.
+    def acquire(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while True:
+                while self.idle:
+                    conn, released = self.idle.pop()
+                    if self._is_alive(conn, released):
+                        self.reused.add()
+                        return conn
+                    self._discard(conn)
+
+                if self.size < self.max_size:
+                    self.size += 1
+                    break
+
+                if deadline is None:
+                    self.cond.wait()
+                else:
+                    left = deadline - time.time()
+                    if left <= 0:
+                        raise PoolExhausted('no connection available in pool',
+                                            http.E_CONN_FAILURE)
+                    self.cond.wait(left)
+
+        # connect outside of lock
+        try:
+            conn = self.cls(self.host, self.port, timeout=self.timeout)
+            self._connect(conn)
+        except Exception:
+            with self.cond:
+                self.size -= 1
+                self.cond.notify()
+            raise
+
+        self.created.add()
+        return conn
+
+    # Give back connection
+    # If 'reuse' is False or connection is in the middle of request,
+    # it is closed.
+    def release(self, conn, reuse=True):
+        with self.cond:
+            if reuse and conn.sock is not None and conn.state == http.S_IDLE:
+                self.idle.append((conn, time.time()))
+            else:
+                self._discard(conn)
+            self.cond.notify()
+
+    # Close idle connections which are not used for idle timeout
+    # and make new ones to keep 'min_idle' connections ready
+    def reap(self):
+        now = time.time()
+        with self.cond:
+            # oldest ones are at the left end
+            while self.idle and now - self.idle[0][1] >= self.idle_timeout:
+                conn, released = self.idle.popleft()
+                self._discard(conn)
+        self._warm()
+        
+    # Only pool which has been used is kept warm
+    def _warm(self):
+        while True:
+            with self.cond:
+                if not self.created.get():
+                    return
+                if len(self.idle) >= self.min_idle or self.size >= self.max_size:
+                    return
+                self.size += 1
+            try:
+                conn = self.cls(self.host, self.port, timeout=self.timeout)
+                self._connect(conn)
+            except Exception:
+                with self.cond:
+                    self.size -= 1
+                    self.cond.notify()
+                return
+            self.warmed.add()
+            self.release(conn)
+
+    # Close all idle connections
+    # Borrowed connections are closed when they are released
+    def close(self):
+        with self.cond:
+            while self.idle:
+                self._discard(self.idle.pop()[0])
+
+    def get_metrics(self):
+        with self.cond:
+            idle, size = len(self.idle), self.size
+        return {'size': size,
+                'idle': idle,
+                'created': self.created.get(),
+                'reused': self.reused.get(),
+                'discarded': self.discarded.get(),
+                'warmed': self.warmed.get(),
+                'connect_time': self.connect_time.get()}
+
+    def _connect(self, conn):
+        begin = time.time()
+        conn.connect()
+        self.connect_time.observe(time.time() - begin)
+        if config.KEEP_ALIVE_MODE in (config.KA_TCP, config.KA_RECONNECT):
+            _set_tcp_keep_alive(conn.sock)
+
+    # Lock must be held
+    def _discard(self, conn):
+        conn.close()
+        self.size -= 1
+        self.discarded.add()
+
+    # Idle connection is alive if it is not too old and socket is not
+    # readable. Readable idle socket means server closed connection or
+    # sent unexpected data, neither of which can be used for next request
+    def _is_alive(self, conn, released):
+        if time.time() - released >= self.idle_timeout:
+            return False
+        sock = conn.sock
+        if sock is None or sock.fileno() < 0:
+            return False
+        if conn.reader.end != conn.reader.start:
+            return False
+        try:
+            readable, writable, error = select.select([sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+# Reaper thread closes idle connections of all pools periodically
+class _Reaper(threading.Thread):
+    def __init__(self, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            for pool in _get_pools():
+                pool.reap()
+
+# Turn on TCP keep-alive probes sent after KEEP_ALIVE_INTERVAL idle
+# Options other than SO_KEEPALIVE are not available on every platform
+def _set_tcp_keep_alive(sock):
+    interval = max(int(config.KEEP_ALIVE_INTERVAL), 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, interval)
+    if hasattr(socket, 'TCP_KEEPINTVL'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+
+_pools = {}
+_pools_mutex = threading.Lock()
+_reaper = None
+# min_idle of pools
+_min_idle = 0
+
+def _get_pools():
+    with _pools_mutex:
+        return list(_pools.values())
+
+# Returns pool shared in the process for the host
+def get_pool(cls, host, port, timeout=None):
+    global _reaper
+    key = (cls, host, port, timeout)
+    with _pools_mutex:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(cls, host, port, timeout)
+            _pools[key] = pool
+        if _reaper is None:
+            _reaper = _Reaper(config.POOL_REAP_INTERVAL)
+            _reaper.start()
+    return pool
+
+# Set number of idle connections kept ready for all pools
+# 0 turns off keeping connections ready
+def set_min_idle(num):
+    global _min_idle
+    with _pools_mutex:
+        _min_idle = num
+    for pool in _get_pools():
+        pool.min_idle = num
+
+# Close idle connections of all pools
+def close_all():
+    for pool in _get_pools():
+        pool.close()
+
+# Returns metrics of all pools, keyed by 'cls host:port timeout' as pools
+# of the same host may differ in connection class or timeout
+def get_metrics():
+    metrics = {}
+    for pool in _get_pools():
+        name = '%s %s:%s %s' % (pool.cls.__name__, pool.host, pool.port, 
+                                pool.timeout)
+        metrics[name] = pool.get_metrics()
+    return metrics
+
+# All connections of pool are borrowed, nothing is sent to server
+class PoolExhausted(http.Error):
+    pass
@@ -0,0 +1,195 @@
+# Pentakill static data store 1.0
+#
+# Static data (champions, items, runes, masteries) of one data dragon
+# version is kept in a file so that every process loads it without
+# fetching or parsing it again. File is written once per version and
+# memory-mapped by readers.
+#
+# File format is JSON lines. Each line is data of one id, and the last
+# line but trailer is index of all lines in a JSON object
+#   {"version": version, "kinds": {kind: {id: [offset, length]}}}
+# Trailer is offset of index line in fixed width, so reader parses only
+# index at startup and each lookup decodes just one line.
+#
+# 'CURRENT' file in store directory has name of the latest data file.
+# Files are written to temporary file and renamed, so readers in other
+# processes never see partial file. Data files of older versions are
+# removed after new one is written, and mapping of older file is closed
+# when new one is mapped.
+
+from pentakill.lolapi import lolapi
+from pentakill.lolapi import config
+import threading
+import tempfile
+import mmap
+import json
+import os
+
+# kinds of static data and methods to fetch them
+KINDS = {'champion': ('get_static_champions', {'data_by_id': 'true'}),
+         'item': ('get_static_items', {}),
+         'rune': ('get_static_runes', {}),
+         'mastery': ('get_static_masteries', {})}
+
+C_TRAILER_SIZE = 16
+C_CURRENT = 'CURRENT'
+
+class StaticStore(object):
+    # path : directory of data files (default STATIC_STORE_DIR in config)
+    def __init__(self, path=None):
+        path = path or config.STATIC_STORE_DIR
+        if path is None:
+            path = os.path.join(tempfile.gettempdir(), 'pentakill-static')
+        self.path = path
+        # tuple (mmap, index) of current file, replaced at once on refresh
+        self.current = None
+        # name of current file
+        self.name = None
+        # decoded data by (kind, id)
+        self.decoded = {}
+        self.mutex = threading.Lock()
+
+    # Map the latest data file, returns False if there's no data yet
+    # Previous mapping is closed, readers slice it only under mutex.
+    def open(self):
+        try:
+            with open(os.path.join(self.path, C_CURRENT)) as f:
+                name = f.read().strip()
+            if name == self.name and self.current is not None:
+                return True
+            current = _map_file(os.path.join(self.path, name))
+        except (IOError, OSError, ValueError):
+            return False
+        with self.mutex:
+            old, self.current = self.current, current
+            self.name = name
+            self.decoded = {}
+            if old is not None:
+                old[0].close()
+        return True
+
+    def close(self):
+        with self.mutex:
+            old, self.current = self.current, None
+            self.name = None
+            self.decoded = {}
+            if old is not None:
+                old[0].close()
+
+    # Returns data dragon version of data, None if not opened
+    def get_version(self):
+        current = self.current
+        return current[1]['version'] if current else None
+
+    # Returns data of 'kind' (e.g. 'champion') with 'id', None if not found
+    def get(self, kind, id):
+        key = (kind, str(id))
+        data = self.decoded.get(key)
+        if data is not None:
+            return data
+        with self.mutex:
+            current = self.current
+            if current is None:
+                return None
+            mm, index = current
+            loc = index['kinds'].get(kind, {}).get(key[1])
+            if loc is None:
+                return None
+            line = mm[loc[0]:loc[0] + loc[1]]
+        data = json.loads(line.decode('utf8'))
+        with self.mutex:
+            if self.current is current:
+                self.decoded[key] = data
+        return data
+
+    # Returns list of ids of 'kind'
+    def get_ids(self, kind):
+        current = self.current
+        if current is None:
+            return []
+        return list(current[1]['kinds'].get(kind, {}))
+
+    # Write data of 'version' and map it
+    # data : dictionary of kind to dictionary of id to data
+    def write(self, version, data):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        name = 'static-%s.jsonl' % (version,)
+        index = {'version': version, 'kinds': {}}
+        fd, tmp = tempfile.mkstemp(dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                offset = 0
+                for kind in data:
+                    locs = index['kinds'][kind] = {}
+                    for id in data[kind]:
+                        line = json.dumps(data[kind][id]).encode('utf8')
+                        f.write(line + b'\n')
+                        locs[str(id)] = [offset, len(line)]
+                        offset += len(line) + 1
+                f.write(json.dumps(index).encode('utf8') + b'\n')
+                f.write(('%0*d\n' % (C_TRAILER_SIZE - 1, offset)).encode('ascii'))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, os.path.join(self.path, name))
+            _write_atomic(os.path.join(self.path, C_CURRENT), name)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self.open()
+        self._remove_old(name)
+
+    # Remove data files other than 'name'
+    # Processes which mapped them keep their mapping, and file which 
+    # can't be removed now (e.g. mapped on Windows) is left for next time
+    def _remove_old(self, name):
+        for old in os.listdir(self.path):
+            if (old != name and old.startswith('static-') and 
+                old.endswith('.jsonl')):
+                try:
+                    os.remove(os.path.join(self.path, old))
+                except OSError:
+                    pass
+
+    # Write data again if 'api' reports new version, returns True if written
+    # api : LOLAPI object whose static connection is initialized
+    # Raises StaticStoreError if data can't be fetched
+    def refresh(self, api):
+        status, versions = api.get_versions()
+        if status[0] != config.SC_OK or not versions:
+            raise StaticStoreError('cannot get versions (%s)' % (status[0],),
+                                   lolapi.E_HTTP)
+        version = versions[0]
+        if self.get_version() == version or (self.open() and
+                                             self.get_version() == version):
+            return False
+
+        data = {}
+        for kind in KINDS:
+            method, options = KINDS[kind]
+            status, content = getattr(api, method)(version=version, **options)
+            if status[0] != config.SC_OK:
+                raise StaticStoreError('cannot get %s data (%s)' %
+                                       (kind, status[0]), lolapi.E_HTTP)
+            data[kind] = content['data']
+        self.write(version, data)
+        return True
+
+# Returns tuple (mmap, index) of data file
+def _map_file(path):
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    offset = int(mm[-C_TRAILER_SIZE:])
+    index = json.loads(mm[offset:-C_TRAILER_SIZE].decode('utf8'))
+    return (mm, index)
+
+def _write_atomic(path, text):
+    dir = os.path.dirname(path)
+    fd, tmp = tempfile.mkstemp(dir=dir)
+    with os.fdopen(fd, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+class StaticStoreError(lolapi.Error):
+    pass
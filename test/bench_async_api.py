@@ -0,0 +1,54 @@
+# Benchmark for asyncio backend of fast API
+# Compares threaded servants of LOLFastAPI with LOLAsyncAPI against local
+# fake API server which answers each request after fixed latency
+if __name__ == '__main__':
+    import asyncio, time, json
+    from pentakill.lolapi import lolapi, lolfastapi, lolasyncapi, config
+    from local_api import setup_config, start_server, make_server_api
+
+    REQUEST_NUM = 2000
+    LATENCY = 0.02
+    LIMIT = [(100000, 1.0)]
+
+    # cache, batching and deduplication would hide requests
+    setup_config()
+
+    async def respond(path):
+        await asyncio.sleep(LATENCY)
+        return ('200 OK', {}, json.dumps({'path': path}).encode())
+
+    # LOLAPI connecting to fake server in plain HTTP
+    ServerAPI = make_server_api(start_server(respond))
+
+    def bench(name, api):
+        api.set_keep_alive(False)
+        api.start_multiple_get_mode()
+        req = lolfastapi.FastRequest()
+        for i in range(REQUEST_NUM):
+            req.add_request((lolapi.LOLAPI.get_summoners_by_ids, (i,)))
+        begin = time.time()
+        res = api.get_multiple_data(req)
+        assert res.wait_response(120)
+        elapsed = time.time() - begin
+        ok = sum(1 for r in res if r[1][0] == lolfastapi.FS_OK)
+        api.close_multiple_get_mode()
+        print('%-10s %8.0f req/s %5d ok of %d' %
+              (name, REQUEST_NUM / elapsed, ok, REQUEST_NUM))
+
+    bench('threaded', lolfastapi.LOLFastAPI(limit=LIMIT, api=ServerAPI))
+    bench('asyncio', lolasyncapi.LOLAsyncAPI(limit=LIMIT, api=ServerAPI))
+
+    # awaitable results for asyncio callers
+    api = lolasyncapi.LOLAsyncAPI(limit=LIMIT, api=ServerAPI)
+    api.set_keep_alive(False)
+    api.start_multiple_get_mode()
+    async def callers():
+        return await asyncio.gather(*[
+            api.get_data_async(lolapi.LOLAPI.get_recent_games, (i,))
+            for i in range(100)])
+    begin = time.time()
+    results = asyncio.run(callers())
+    print('%-10s %8.0f req/s %5d ok of %d' %
+          ('awaited', 100 / (time.time() - begin),
+           sum(1 for r in results if r[0][0] == config.SC_OK), 100))
+    api.close_multiple_get_mode()
@@ -0,0 +1,76 @@
+# Benchmark for bundles of requests with reserved permits
+# Summoner updates arrive faster than quota allows. Each update gets
+# summoner first and then its 4 other requests, and fails if all are not
+# responded before its deadline. Compares updates fully done and quota
+# spent for each of them without bundle for the 4 requests, with bundle,
+# and with bundle whose league entries are batched.
+if __name__ == '__main__':
+    import threading, time
+    from pentakill.lolapi import lolapi, lolfastapi, config
+    from local_api import LocalAPI, setup_config
+
+    QUOTA = 20
+    LIMIT = [(QUOTA, 1.0)]
+    SERVANTS = 10
+    LATENCY = 0.05
+    # updates per second, about 1.5 times of quota
+    ARRIVAL = 6.0
+    DURATION = 15.0
+    # time given to each update
+    WAIT = 4.0
+
+    setup_config()
+    LocalAPI.latency = LATENCY
+
+    def wait(api, req, deadline):
+        res = api.get_multiple_data(req)
+        if not res.wait_response(max(deadline - time.time(), 0.0)):
+            res.cancel()
+            return False
+        return all(r[1][0] == lolfastapi.FS_OK for r in res)
+
+    def update(api, i, bundle, done):
+        deadline = time.time() + WAIT
+        req = lolfastapi.FastRequest(lolfastapi.PR_NORMAL, deadline)
+        req.add_request_name('summoner',
+            (lolapi.LOLAPI.get_summoners_by_names, ('s%d' % i,)))
+        if not wait(api, req, deadline):
+            return
+        req = lolfastapi.FastRequest(lolfastapi.PR_NORMAL, deadline)
+        req.set_bundle(bundle)
+        req.add_request_name('leagues', (lolapi.LOLAPI.get_league_entries, (i,)))
+        req.add_request_name('games', (lolapi.LOLAPI.get_recent_games, (i,)))
+        req.add_request_name('stats', (lolapi.LOLAPI.get_stats_summary, (i,)))
+        req.add_request_name('rank', (lolapi.LOLAPI.get_rank_stats, (i,)))
+        if wait(api, req, deadline):
+            done.append(i)
+
+    def bench(label, bundle):
+        api = lolfastapi.LOLFastAPI(servants=SERVANTS, limit=LIMIT,
+                                    cores=SERVANTS, api=LocalAPI)
+        api.set_keep_alive(False)
+        api.start_multiple_get_mode()
+        LocalAPI.reset_sent()
+        done = []
+        threads = []
+        begin = time.time()
+        i = 0
+        while time.time() - begin < DURATION:
+            thread = threading.Thread(target=update, args=(api, i, bundle, done))
+            thread.start()
+            threads.append(thread)
+            i += 1
+            time.sleep(1.0 / ARRIVAL)
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - begin
+        api.close_multiple_get_mode()
+        print('%-12s %3d of %3d updates done %5.2f/s, %4d requests sent, '
+              '%5.2f per update done' %
+              (label, len(done), i, len(done) / elapsed, LocalAPI.sent,
+               float(LocalAPI.sent) / max(len(done), 1)))
+
+    bench('single', False)
+    bench('bundle', True)
+    config.BATCH_ON = True
+    bench('bundle+batch', True)
@@ -0,0 +1,54 @@
+# Benchmark for adaptive concurrency of LOLFastAPI
+# Fake API gets slow in the middle of run. With fixed number of servants,
+# quota is not used while it's slow. Compares throughput of each phase
+# with CONCURRENCY_ON off and on, and prints decisions of controller.
+if __name__ == '__main__':
+    import threading, time
+    from pentakill.lolapi import lolapi, lolfastapi, config
+    from local_api import LocalAPI, setup_config
+
+    QUOTA = 50
+    LIMIT = [(QUOTA, 1.0)]
+    SERVANTS = 2
+    # (latency, duration) of phases
+    PHASES = [(0.02, 4.0), (0.3, 6.0), (0.02, 4.0)]
+
+    setup_config(CONCURRENCY_INTERVAL=0.25)
+
+    def bench(on):
+        config.CONCURRENCY_ON = on
+        api = lolfastapi.LOLFastAPI(servants=SERVANTS, limit=LIMIT,
+                                    cores=SERVANTS, api=LocalAPI)
+        api.set_keep_alive(False)
+        api.start_multiple_get_mode()
+        # keep backlog of requests
+        req = lolfastapi.FastRequest()
+        for i in range(int(QUOTA * sum(p[1] for p in PHASES) * 1.5)):
+            req.add_request((lolapi.LOLAPI.get_recent_games, (i,)))
+        res = api.get_multiple_data(req)
+        done = []
+        for phase_latency, duration in PHASES:
+            LocalAPI.latency = phase_latency
+            begin = time.time()
+            count = 0
+            while time.time() - begin < duration:
+                try:
+                    if res.wait_target_response(None, begin + duration -
+                                                time.time()) is None:
+                        break
+                except lolfastapi.TimeoutError:
+                    break
+                count += 1
+            done.append(count / duration)
+        metrics = api.get_metrics()
+        res.cancel()
+        api.close_multiple_get_mode()
+        print('%-8s %s req/s (quota %d)' %
+              ('adaptive' if on else 'fixed',
+               ' '.join('%5.1f' % rate for rate in done), QUOTA))
+        if on:
+            for when, old, new, reason in metrics['concurrency']['decisions']:
+                print('    %2d -> %2d  %s' % (old, new, reason))
+
+    bench(False)
+    bench(True)
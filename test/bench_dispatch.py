@@ -0,0 +1,50 @@
+# Benchmark for dispatch of requests to cores
+# Fake API answers match requests slowly and the others fast. Compares
+# completion time of requests of get_multiple_data with round robin and
+# least loaded dispatch of LOLAdmin.
+if __name__ == '__main__':
+    import time
+    from pentakill.lolapi import lolapi, lolfastapi, config
+    import local_api
+
+    REQUEST_NUM = 400
+    SLOW_EVERY = 7
+    SLOW_LATENCY = 0.3
+    FAST_LATENCY = 0.01
+    SERVANTS = 10
+    CORES = 5
+    LIMIT = [(10 ** 6, 1.0)]
+
+    # requests should reach cores
+    local_api.setup_config()
+
+    class LocalAPI(local_api.LocalAPI):
+        def get_latency(self, loc):
+            return SLOW_LATENCY if '/match/' in loc else FAST_LATENCY
+
+    def percentile(values, p):
+        values = sorted(values)
+        return values[min(int(len(values) * p), len(values) - 1)]
+
+    def bench(dispatch):
+        config.CORE_DISPATCH = dispatch
+        api = lolfastapi.LOLFastAPI(servants=SERVANTS, limit=LIMIT,
+                                    cores=CORES, api=LocalAPI)
+        api.set_keep_alive(False)
+        api.start_multiple_get_mode()
+        req = lolfastapi.FastRequest()
+        for i in range(REQUEST_NUM):
+            if i % SLOW_EVERY == 0:
+                req.add_request((lolapi.LOLAPI.get_match, (i,)))
+            else:
+                req.add_request((lolapi.LOLAPI.get_recent_games, (i,)))
+        begin = time.time()
+        res = api.get_multiple_data(req)
+        done = [time.time() - begin for r in res.as_completed(timeout=120)]
+        api.close_multiple_get_mode()
+        print('%-12s p50 %5.3fs  p99 %5.3fs  max %5.3fs' %
+              (dispatch, percentile(done, 0.5), percentile(done, 0.99),
+               max(done)))
+
+    bench(config.D_ROUND_ROBIN)
+    bench(config.D_LEAST_LOADED)
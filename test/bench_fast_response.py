@@ -0,0 +1,159 @@
+# Benchmark for FastResponse
+# Updator waits on 5-10 named requests with wait_target_response while
+# servants add responses. Compares future-based FastResponse with previous
+# one, which made condition for every waiter and never removed it.
+if __name__ == '__main__':
+    import threading, time, copy
+    from pentakill.lolapi import lolfastapi
+
+    ROUNDS = 300
+    TARGETS = (5, 10)
+    OTHERS = 90
+    TimeoutError = lolfastapi.TimeoutError
+
+    # previous FastResponse, only methods used here
+    class LegacyResponse(object):
+        # deadline : absolute time (as time.time()) after which requests not 
+        #            sent yet are dropped, None for no deadline
+        def __init__(self, req_num, deadline=None):
+            self.req_num = req_num
+            self.response_num = 0
+            self.read_num = 0
+            self.responses = {}
+            self.cond = threading.Condition()
+            self.deadline = deadline
+            self.cancelled = False
+
+            self.waits = []
+
+        # Add response
+        # If multiple responses with same name are added,
+        # only first response is added and the others are ignored.
+        # If all requests are served, it notifies requester
+        # name: name of request in request dictionary
+        # tuple : tuple (status_code, data)
+        #         'status code' is one of FS_* value
+        #         'data' is returned data from API or error message
+        def add_response(self, name, tuple):
+            self.cond.acquire()
+            if name in self.responses:
+                self.cond.release()
+                return
+            self.responses[name] = [tuple, True] # data, unread(True)
+            self.response_num += 1
+            # notify requestor
+            if self.response_num >= self.req_num:
+                self.cond.notifyAll()
+
+            for wait in self.waits:
+                cond = wait[0]
+                found = True
+                if wait[1]:
+                    if not name in wait[1]:
+                        found = False
+                if found:
+                    cond.acquire()
+                    cond.notify()
+                    cond.release()
+            self.cond.release()
+
+
+        def wait_target_response(self, list=None, timeout=None):
+            ret = None
+            first = True
+            left = timeout
+            to = False
+            list = copy.copy(list) if list else None
+            self.cond.acquire()
+            while True:
+                found = False
+                if list:
+                    for name in list:
+                        try:
+                            res = self.responses[name]
+                        except KeyError:
+                            continue
+                        else:
+                            if res[1]:
+                                res[1] = False
+                                ret = (name, res[0])
+                                found = True
+                                break
+                    if found:
+                        break
+                else:
+                    for name in self.responses:
+                        if self.responses[name][1]:
+                            self.responses[name][1] = False
+                            ret = (name, self.responses[name][0])
+                            found = True
+                            break
+                    if found:
+                        break
+                if self.req_num <= self.response_num:
+                    break
+                if first:
+                    begin = time.time()
+                    first = False
+                    wait = threading.Condition()
+                    self.waits.append((wait, list))
+                wait.acquire()
+                self.cond.release()
+                wait.wait(left)
+                end = time.time()
+                wait.release()
+                self.cond.acquire()
+                if left is not None:
+                    elapsed = end - begin
+                    left -= elapsed
+                    if left <= 0:
+                        ret = False
+                        to = True
+                        break
+            self.cond.release()
+            if to:
+                raise TimeoutError('response wait timeout')
+            return ret
+
+    # per round, 'target' names the consumer waits on one by one as updator
+    # does, each after OTHERS // target responses nobody waits for
+    # producer hands over next target only after previous one is read, so
+    # the consumer blocks in every wait. Time of add_response is measured.
+    def bench(cls, target):
+        names = ['t%d' % i for i in range(target)]
+        others = ['o%d' % i for i in range(OTHERS)]
+        chunk = OTHERS // target
+        read = [threading.Event() for i in range(target)]
+        clock = time.perf_counter
+        result = []
+        def produce(res):
+            spent = 0.0
+            for i in range(target):
+                for other in others[i * chunk:(i + 1) * chunk]:
+                    begin = clock()
+                    res.add_response(other, (lolfastapi.FS_OK, other))
+                    spent += clock() - begin
+                begin = clock()
+                res.add_response(names[i], (lolfastapi.FS_OK, i))
+                spent += clock() - begin
+                read[i].wait()
+            result.append(spent)
+        total = 0
+        for r in range(ROUNDS):
+            for event in read:
+                event.clear()
+            res = cls(target + chunk * target)
+            producer = threading.Thread(target=produce, args=(res,))
+            producer.start()
+            for i in range(target):
+                assert res.wait_target_response([names[i]], 10)[0] == names[i]
+                read[i].set()
+            producer.join()
+            total += target + chunk * target
+        return sum(result) * 1e6 / total
+
+    for target in TARGETS:
+        old = min(bench(LegacyResponse, target) for i in range(3))
+        new = min(bench(lolfastapi.FastResponse, target) for i in range(3))
+        print('%2d targets  legacy %5.2f us/response  futures %5.2f us/response'
+              '  (%.1fx)' % (target, old, new, old / new))
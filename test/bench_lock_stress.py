@@ -0,0 +1,90 @@
+# Stress test for locks on request path of LOLFastAPI
+# Locks of admin, cores, state machines and error policy are replaced by
+# counting proxies, and fake API answers at once, so that the cost is in
+# locking. Reports lock acquisitions per request and throughput as number
+# of servants grows.
+if __name__ == '__main__':
+    import threading, time, collections
+    from pentakill.lolapi import lolapi, lolfastapi
+    from local_api import LocalAPI, setup_config
+
+    REQUEST_NUM = 4000
+    SERVANTS = (1, 4, 16, 64)
+    LIMIT = [(10 ** 6, 1.0)]
+
+    # requests should reach cores
+    setup_config()
+
+    counts = collections.Counter()
+    count_mutex = threading.Lock()
+
+    # Lock, Semaphore or Condition which counts acquisitions
+    class Counting(object):
+        def __init__(self, name, lock):
+            self.name = name
+            self.lock = lock
+
+        def acquire(self, *args, **kwargs):
+            with count_mutex:
+                counts[self.name] += 1
+            return self.lock.acquire(*args, **kwargs)
+
+        def release(self):
+            self.lock.release()
+
+        def __enter__(self):
+            self.acquire()
+            return self
+
+        def __exit__(self, *args):
+            self.release()
+
+        def __getattr__(self, name):
+            return getattr(self.lock, name)
+
+    # locks on request path, those not in this tree are skipped
+    def install(api):
+        admin = api.admin
+        targets = [(admin, 'perm_condition'), (admin, 'get_data_mutex'),
+                   (admin, 'global_after_req_mutex'),
+                   (admin.state, 'state_condition'),
+                   (admin.policy, 'exception_mutex'),
+                   (api.state, 'state_condition'),
+                   (api, 'queue_cond')]
+        for obj, name in targets:
+            if hasattr(obj, name):
+                setattr(obj, name, Counting(name, getattr(obj, name)))
+
+    def install_cores(api):
+        for core in api.admin.cores:
+            core.perm_condition = api.admin.perm_condition
+            core.req_condition = Counting('req_condition', core.req_condition)
+            if hasattr(core, 'global_after_req_mutex'):
+                core.global_after_req_mutex = api.admin.global_after_req_mutex
+        for servant in api.servants:
+            servant.cond = api.queue_cond
+
+    def bench(servant_num):
+        api = lolfastapi.LOLFastAPI(servants=servant_num, limit=LIMIT,
+                                    cores=servant_num, api=LocalAPI)
+        api.set_keep_alive(False)
+        install(api)
+        api.start_multiple_get_mode()
+        install_cores(api)
+        counts.clear()
+        req = lolfastapi.FastRequest()
+        for i in range(REQUEST_NUM):
+            req.add_request((lolapi.LOLAPI.get_recent_games, (i,)))
+        begin = time.time()
+        res = api.get_multiple_data(req)
+        assert res.wait_response(120)
+        elapsed = time.time() - begin
+        api.close_multiple_get_mode()
+        print('%3d servants %8.0f req/s %6.2f locks/request  %s' %
+              (servant_num, REQUEST_NUM / elapsed,
+               float(sum(counts.values())) / REQUEST_NUM,
+               ' '.join('%s=%.2f' % (name, float(num) / REQUEST_NUM)
+                        for name, num in sorted(counts.items()))))
+
+    for servant_num in SERVANTS:
+        bench(servant_num)
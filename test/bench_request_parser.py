@@ -0,0 +1,101 @@
+# Benchmark for request parser of update server
+# Compares per-byte reading parser with buffered parser by number of
+# recv system calls and parsed requests per second
+if __name__ == '__main__':
+    import socket, threading, time
+    from pentakill.update import server
+    from pentakill.update.server import ParseError
+
+    REQUEST_NUM = 20000
+    REQUESTS = [
+        (b'GET /summoner?name=hide%20on%20bush HTTP/1.1\r\n'
+         b'Host: localhost\r\n'
+         b'User-Agent: bench\r\n'
+         b'Accept: */*\r\n'
+         b'Connection: keep-alive\r\n\r\n'),
+        (b'POST /match HTTP/1.1\r\n'
+         b'Host: localhost\r\n'
+         b'Content-Type: text/json\r\n'
+         b'Content-Length: 31\r\n\r\n'
+         b'{"match_id": 1234567890, "a":1}'),
+        (b'POST /runes HTTP/1.1\r\n'
+         b'Host: localhost\r\n'
+         b'Transfer-Encoding: chunked\r\n\r\n'
+         b'a\r\n{"id": 123\r\n1\r\n}\r\n0\r\n\r\n'),
+    ]
+
+    # Parser before buffering, reads request line by one byte
+    class LegacyParser(server.Server._RequestParser):
+        def _readline(self):
+            size = server.LINE_MAX_SIZE
+            array = []
+            cnt = 0
+            while True:
+                c = self.conn.recv(1)
+                if not c:
+                    break
+                array.append(c)
+                cnt += 1
+                if cnt == size or c == b'\n':
+                    break
+
+            return b''.join(array)
+
+        def _safe_read(self, size):
+            array = []
+            cnt = 0
+            left = size
+            while True:
+                cs = self.conn.recv(left)
+                read = len(cs)
+                if read == 0:
+                    raise ParseError('connection closed while '
+                                     'expected bytes are left')
+                array.append(cs)
+                cnt += read
+                left -= read
+                if left == 0:
+                    break
+
+            return b''.join(array)
+
+    # Socket wrapper counting receive calls
+    class CountingSocket(object):
+        def __init__(self, sock):
+            self.sock = sock
+            self.calls = 0
+
+        def recv(self, size):
+            self.calls += 1
+            return self.sock.recv(size)
+
+        def recv_into(self, buf):
+            self.calls += 1
+            return self.sock.recv_into(buf)
+
+    def client(sock):
+        data = b''.join(REQUESTS[i % len(REQUESTS)]
+                        for i in range(REQUEST_NUM))
+        sock.sendall(data)
+        sock.shutdown(socket.SHUT_WR)
+
+    def bench(parser_class):
+        a, b = socket.socketpair()
+        thread = threading.Thread(target=client, args=(a,))
+        thread.start()
+        conn = CountingSocket(b)
+        parser = parser_class(conn)
+        begin = time.time()
+        for i in range(REQUEST_NUM):
+            parser.parse_request()
+            assert parser.get_request()[0] in ('GET', 'POST')
+        elapsed = time.time() - begin
+        thread.join()
+        a.close()
+        b.close()
+        print('%-16s %8.0f req/s %8.2f recv/req' %
+              (parser_class.__name__, REQUEST_NUM / elapsed,
+               conn.calls / REQUEST_NUM))
+
+    bench(LegacyParser)
+    bench(server.Server._RequestParser)
@@ -0,0 +1,93 @@
+# Fake API and settings shared by tests and benchmarks of lolapi
+# Scripts in this directory import it as
+#     from local_api import LocalAPI, setup_config
+import threading, asyncio, time
+from pentakill.lolapi import lolapi, config, http
+
+# features which answer or hold requests before they reach cores
+OFF = ('CACHE_ON', 'BATCH_ON', 'DEDUP_ON', 'STATIC_STORE_ON',
+       'CONCURRENCY_ON', 'STATUS_INIT', 'STATIC_INIT')
+
+# Turn off features in OFF and then set given values of config
+def setup_config(**values):
+    for name in OFF:
+        setattr(config, name, False)
+    for name, value in values.items():
+        setattr(config, name, value)
+
+# LOLAPI answering every request in process after latency
+# LOLFastAPI makes API objects itself, so latency and status are class
+# attributes that callers change or override by subclass.
+class LocalAPI(lolapi.LOLAPI):
+    # seconds before response
+    latency = 0.0
+    # status of response
+    status = ('200', 'OK')
+    # number of requests answered by all objects
+    sent = 0
+    sent_mutex = threading.Lock()
+
+    def _send_request(self, type, loc):
+        latency = self.get_latency(loc)
+        if latency:
+            time.sleep(latency)
+        with LocalAPI.sent_mutex:
+            LocalAPI.sent += 1
+        self.last_response = (self.get_status(loc), {})
+        return self.last_response
+
+    def get_latency(self, loc):
+        return self.latency
+
+    def get_status(self, loc):
+        return self.status
+
+    @staticmethod
+    def reset_sent():
+        with LocalAPI.sent_mutex:
+            LocalAPI.sent = 0
+
+# Start local HTTP server in its own thread, returns its port
+# respond : coroutine function of request path which returns tuple
+#           (status line, dict of headers, body bytes)
+def start_server(respond):
+    async def handle(reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                while (await reader.readline()) not in (b'\r\n', b''):
+                    pass
+                status, headers, body = await respond(line.split()[1].decode())
+                lines = ['HTTP/1.1 %s' % (status,),
+                         'Content-Type: application/json',
+                         'Content-Length: %d' % (len(body),)]
+                lines.extend('%s: %s' % item for item in headers.items())
+                writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + body)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    def serve(ready):
+        loop = asyncio.new_event_loop()
+        server = loop.run_until_complete(
+            asyncio.start_server(handle, '127.0.0.1', 0, backlog=1024))
+        ready.append(server.sockets[0].getsockname()[1])
+        loop.run_forever()
+
+    ready = []
+    thread = threading.Thread(target=serve, args=(ready,))
+    thread.daemon = True
+    thread.start()
+    while not ready:
+        time.sleep(0.01)
+    return ready[0]
+
+# Returns LOLAPI class connecting to local server of 'port' in plain HTTP
+def make_server_api(port):
+    class ServerAPI(lolapi.LOLAPI):
+        def _get_endpoint(self, type):
+            return (http.HTTP, '127.0.0.1', port)
+    return ServerAPI
@@ -0,0 +1,117 @@
+# Test for method rate limits and circuit breakers of LOLAsyncAPI
+# Local server answers requests. Bucket of METHOD_LIMITS holds requests
+# of its method only, limit exceeded of method type blocks only its
+# bucket, and errors and timeouts in a row open circuit of the method.
+if __name__ == '__main__':
+    import asyncio, time, collections
+    from pentakill.lolapi import lolapi, lolfastapi, lolasyncapi
+    import local_api
+
+    local_api.setup_config(BREAKER_ON=True, BREAKER_THRESHOLD=3,
+                           BREAKER_BACKOFF=10.0,
+                           METHOD_LIMITS={'get_match': ('match', [(3, 1.0)])})
+
+    arrivals = collections.defaultdict(list)
+    limited = []
+
+    async def respond(path):
+        now = time.time()
+        if '/match/' in path:
+            arrivals['match'].append(now)
+        elif '/matchlist/' in path:
+            arrivals['matchlist'].append(now)
+            if not limited:
+                limited.append(now)
+                return ('429 Too Many Requests',
+                        {'X-Rate-Limit-Type': 'method', 'Retry-After': '1',
+                         'X-Method-Rate-Limit': '100:10',
+                         'X-Method-Rate-Limit-Count': '1:10'}, b'{}')
+        elif '/league/' in path:
+            arrivals['league'].append(now)
+            return ('500 Internal Server Error', {}, b'{}')
+        elif '/stats/' in path:
+            arrivals['stats'].append(now)
+            await asyncio.sleep(0.5)
+        else:
+            arrivals['games'].append(now)
+        return ('200 OK', {}, b'{}')
+
+    ServerAPI = local_api.make_server_api(local_api.start_server(respond))
+    api = lolasyncapi.LOLAsyncAPI(connections=8, limit=[(1000, 1.0)],
+                                  api=ServerAPI)
+    api.set_keep_alive(False)
+    api.start_multiple_get_mode()
+
+    # bucket holds match requests, the others go at once
+    begin = time.time()
+    req = lolfastapi.FastRequest()
+    for i in range(6):
+        req.add_request_name(('match', i), (lolapi.LOLAPI.get_match, (i,)))
+    for i in range(6):
+        req.add_request_name(('games', i),
+                             (lolapi.LOLAPI.get_recent_games, (i,)))
+    res = api.get_multiple_data(req)
+    assert res.wait_response(10)
+    assert all(r[1][0] == lolfastapi.FS_OK for r in res)
+    match = sorted(t - begin for t in arrivals['match'])
+    assert len(match) == 6
+    assert match[2] < 0.5, match
+    assert match[3] >= 0.9, match
+    assert max(arrivals['games']) - begin < 0.5
+    status = api.get_metrics()['buckets']
+    assert [s['name'] for s in status] == ['get_match'], status
+
+    # limit exceeded of method type blocks its bucket, not application
+    begin = time.time()
+    req = lolfastapi.FastRequest()
+    req.add_request_name('matchlist',
+                         (lolapi.LOLAPI.get_match_history, (1,)))
+    res = api.get_multiple_data(req)
+    time.sleep(0.2)
+    req = lolfastapi.FastRequest()
+    for i in range(5):
+        req.add_request((lolapi.LOLAPI.get_recent_games, (10 + i,)))
+    games = api.get_multiple_data(req)
+    assert games.wait_response(0.5)
+    assert res.wait_response(5)
+    assert res.get_response('matchlist')[0] == lolfastapi.FS_OK
+    assert arrivals['matchlist'][1] - arrivals['matchlist'][0] >= 0.9
+    # bucket is made by header of server
+    names = [s['name'] for s in api.get_metrics()['buckets']]
+    assert names == ['get_match', 'get_match_history'], names
+
+    # errors in a row open circuit of the method
+    for i in range(5):
+        req = lolfastapi.FastRequest()
+        req.add_request_name('league', (lolapi.LOLAPI.get_league_entries,
+                                        (i,)))
+        res = api.get_multiple_data(req)
+        assert res.wait_response(5)
+        status, data = res.get_response('league')
+        if i < 3:
+            assert status == lolfastapi.FS_OK and data[0][0] == '500'
+        else:
+            assert status == lolfastapi.FS_SERVICE_UNAVAILABLE, status
+            assert 'open' in data, data
+    assert len(arrivals['league']) == 3
+    breakers = dict((s['name'], s) for s in api.get_metrics()['breakers'])
+    assert breakers['get_league_entries']['state'] == lolfastapi.CB_OPEN
+
+    # so do timeouts
+    api.timeout = 0.2
+    for i in range(4):
+        req = lolfastapi.FastRequest()
+        req.add_request_name('stats', (lolapi.LOLAPI.get_stats_summary, (i,)))
+        res = api.get_multiple_data(req)
+        assert res.wait_response(5)
+        status, data = res.get_response('stats')
+        if i < 3:
+            assert status == lolfastapi.FS_TIMEOUT, (status, data)
+        else:
+            assert status == lolfastapi.FS_SERVICE_UNAVAILABLE, status
+    assert len(arrivals['stats']) == 3
+    breakers = dict((s['name'], s) for s in api.get_metrics()['breakers'])
+    assert breakers['get_stats_summary']['state'] == lolfastapi.CB_OPEN
+
+    api.close_multiple_get_mode()
+    print('OK')
@@ -0,0 +1,89 @@
+# Test for batching of single id requests of LOLFastAPI
+# Requests made at about the same time are merged up to maximum number of
+# ids of the method, and each request gets the entry of its id or not
+# found, as if it were requested alone.
+if __name__ == '__main__':
+    import re, threading
+    from pentakill.lolapi import lolapi, lolfastapi, config
+    import local_api
+
+    local_api.setup_config(BATCH_ON=True, BATCH_WINDOW=0.1)
+
+    sent = []
+    sent_mutex = threading.Lock()
+    failing = []
+
+    # answers entries of ids not divisible by 7
+    class LocalAPI(local_api.LocalAPI):
+        def _send_request(self, type, loc):
+            ids = re.search(r'/(summoner|by-summoner)/([0-9,]+)', loc).group(2)
+            ids = ids.split(',')
+            with sent_mutex:
+                sent.append(ids)
+            if failing:
+                self.last_response = (('500', 'Internal Server Error'), {})
+                return (self.last_response[0], {})
+            self.last_response = (('200', 'OK'), {})
+            return (self.last_response[0],
+                    dict((id, {'id': int(id)}) for id in ids if int(id) % 7))
+
+    api = lolfastapi.LOLFastAPI(servants=4, limit=[(1000, 1.0)], cores=4,
+                                api=LocalAPI)
+    api.set_keep_alive(False)
+    api.start_multiple_get_mode()
+    by_ids = lolapi.LOLAPI.get_summoners_by_ids
+
+    # merged up to maximum ids of method
+    req = lolfastapi.FastRequest()
+    for i in range(1, 46):
+        req.add_request_name(i, (by_ids, (i,)))
+    # the same id is asked once
+    req.add_request_name('again', (by_ids, (42,)))
+    # request of many ids is not batched
+    req.add_request_name('many', (by_ids, ('100,101',)))
+    res = api.get_multiple_data(req)
+    assert res.wait_response(10)
+    batched = sorted(len(ids) for ids in sent if '100' not in ids)
+    assert batched == [5, 40], batched
+    assert ['100', '101'] in sent
+    for i in range(1, 46):
+        status, data = res.get_response(i)
+        assert status == lolfastapi.FS_OK
+        if i % 7:
+            assert data == (('200', 'OK'), {str(i): {'id': i}}), data
+        else:
+            assert data[0][0] == config.SC_NOT_FOUND and data[1] == {}
+    assert res.get_response('again') == res.get_response(42)
+    assert res.get_response('many')[1][1] == {'100': {'id': 100},
+                                              '101': {'id': 101}}
+    metrics = api.get_metrics()
+    assert metrics['batches'] == 2 and metrics['batched_requests'] == 46
+
+    # requests from callers in other threads are merged too
+    del sent[:]
+    responses = []
+    def call(i):
+        req = lolfastapi.FastRequest()
+        req.add_request_name('league', (lolapi.LOLAPI.get_league_entries,
+                                        (i,)))
+        responses.append(api.get_multiple_data(req))
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(1, 21)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for res in responses:
+        assert res.wait_response(10)
+    assert sorted(len(ids) for ids in sent) == [10, 10], sent
+
+    # error response goes to every request
+    failing.append(True)
+    req = lolfastapi.FastRequest()
+    for i in range(1, 4):
+        req.add_request_name(i, (by_ids, (i,)))
+    res = api.get_multiple_data(req)
+    assert res.wait_response(10)
+    assert all(r[1][1][0][0] == '500' for r in res)
+
+    api.close_multiple_get_mode()
+    print('OK')
@@ -0,0 +1,55 @@
+# Test for bundles of requests with reserved permits of LOLFastAPI
+# Batchable requests of bundles are still merged into batches, each batch
+# takes one reserved permit, and permits not taken are given back.
+if __name__ == '__main__':
+    import time
+    from pentakill.lolapi import lolapi, lolfastapi
+    import local_api
+
+    BUNDLES = 8
+    QUOTA = 20
+
+    local_api.setup_config(BATCH_ON=True, BATCH_WINDOW=0.2)
+    local_api.LocalAPI.latency = 0.01
+
+    api = lolfastapi.LOLFastAPI(servants=4, limit=[(QUOTA, 1.0)], cores=4,
+                                api=local_api.LocalAPI)
+    api.set_keep_alive(False)
+    api.start_multiple_get_mode()
+
+    responses = []
+    for i in range(BUNDLES):
+        req = lolfastapi.FastRequest()
+        req.set_bundle()
+        req.add_request_name('leagues', (lolapi.LOLAPI.get_league_entries, (i,)))
+        req.add_request_name('games', (lolapi.LOLAPI.get_recent_games, (i,)))
+        req.add_request_name('stats', (lolapi.LOLAPI.get_stats_summary, (i,)))
+        responses.append(api.get_multiple_data(req))
+    for res in responses:
+        assert res.wait_response(20)
+        assert all(r[1][0] == lolfastapi.FS_OK for r in res)
+
+    metrics = api.get_metrics()
+    assert metrics['reserved_bundles'] == BUNDLES
+    assert metrics['batched_requests'] == BUNDLES
+    # league entries of bundles are merged
+    assert metrics['batches'] < BUNDLES, metrics['batches']
+    assert local_api.LocalAPI.sent == BUNDLES * 2 + metrics['batches']
+    # permits not taken by batches are given back
+    assert api.admin.limiter.inflight == 0
+    assert api.reserved_queued == 0
+
+    # bundle of only batchable requests
+    req = lolfastapi.FastRequest()
+    req.set_bundle()
+    for i in range(3):
+        req.add_request_name(i, (lolapi.LOLAPI.get_league_entries, (100 + i,)))
+    res = api.get_multiple_data(req)
+    assert res.wait_response(20)
+    metrics = api.get_metrics()
+    assert metrics['reserved_bundles'] == BUNDLES + 1
+    assert metrics['batched_requests'] == BUNDLES + 3
+    assert api.admin.limiter.inflight == 0
+
+    api.close_multiple_get_mode()
+    print('OK')
@@ -0,0 +1,67 @@
+# Test for response cache of lolapi
+# TTL expiry, stale-while-revalidate and LRU eviction bounded by bytes,
+# driven by 'now' instead of real time.
+if __name__ == '__main__':
+    import json
+    from pentakill.lolapi import cache
+
+    # TTL expiry without stale time
+    c = cache.ResponseCache(10 ** 6)
+    c.put('a', {'v': 1}, 10.0, now=100.0)
+    assert c.get('a', now=105.0) == ({'v': 1}, False)
+    assert c.get('a', now=110.0) is None
+    assert c.get_metrics()['entries'] == 0
+    assert c.get('b', now=100.0) is None
+    assert c.get_metrics()['misses'] == 2
+
+    # stale value is served, and only the first get in stale window
+    # revalidates
+    c = cache.ResponseCache(10 ** 6, stale_time=5.0)
+    c.put('a', {'v': 1}, 10.0, now=100.0)
+    assert c.get('a', now=111.0) == ({'v': 1}, True)
+    assert c.get('a', now=112.0) == ({'v': 1}, False)
+    assert c.get('a', now=113.0) == ({'v': 1}, False)
+    # revalidated value is fresh again
+    c.put('a', {'v': 2}, 10.0, now=113.0)
+    assert c.get('a', now=114.0) == ({'v': 2}, False)
+    assert c.get('a', now=124.0) == ({'v': 2}, True)
+    # too old even for stale
+    assert c.get('a', now=128.0) is None
+
+    # failed revalidation lets next get revalidate again
+    c.put('a', {'v': 3}, 10.0, now=200.0)
+    assert c.get('a', now=211.0) == ({'v': 3}, True)
+    assert c.get('a', now=211.5) == ({'v': 3}, False)
+    c.fail_revalidate('a')
+    assert c.get('a', now=212.0) == ({'v': 3}, True)
+    assert c.get('a', now=212.5) == ({'v': 3}, False)
+
+    # least recently used value is evicted first when bytes exceed
+    size = len(json.dumps({'v': 1}))
+    c = cache.ResponseCache(size * 3)
+    for key in ('a', 'b', 'c'):
+        c.put(key, {'v': 1}, 10.0, now=100.0)
+    assert c.get('a', now=101.0) is not None
+    c.put('d', {'v': 1}, 10.0, now=102.0)
+    assert c.get('b', now=103.0) is None
+    for key in ('a', 'c', 'd'):
+        assert c.get(key, now=103.0) is not None
+    metrics = c.get_metrics()
+    assert metrics['bytes'] == size * 3
+    assert metrics['evictions'] == 1
+
+    # replacing value does not count its old size
+    c = cache.ResponseCache(10 ** 6)
+    c.put('a', {'v': 1}, 10.0, now=100.0)
+    c.put('a', {'v': 10}, 10.0, now=101.0)
+    assert c.get_metrics()['bytes'] == len(json.dumps({'v': 10}))
+
+    # value larger than cache and unhashable key are not kept
+    c = cache.ResponseCache(size)
+    c.put('big', {'v': 'x' * 100}, 10.0, now=100.0)
+    c.put(['list'], {'v': 1}, 10.0, now=100.0)
+    assert c.get('big', now=100.0) is None
+    assert c.get(['list'], now=100.0) is None
+    assert c.get_metrics()['entries'] == 0
+
+    print('OK')
@@ -0,0 +1,91 @@
+# Test for circuit breakers of LOLAdmin
+# States of _CircuitBreaker are driven by 'now' instead of real time.
+# Then one argument which always fails should not keep the circuit of its
+# method open, since the probe is the next real request.
+if __name__ == '__main__':
+    import time
+    from pentakill.lolapi import lolapi, lolfastapi
+    import local_api
+
+    CB = lolfastapi._CircuitBreaker
+
+    # opens after threshold failures in a row
+    b = CB('m', threshold=3, backoff=1.0, max_backoff=5.0)
+    assert b.allow(0.0)
+    assert b.fail(0.0) is None
+    assert b.fail(0.0) is None
+    # success resets the count
+    assert not b.succeed()
+    assert b.failures == 0
+    assert b.fail(0.0) is None and b.fail(0.0) is None
+    assert b.fail(10.0) == 1.0
+    assert b.state == lolfastapi.CB_OPEN and b.retry_at == 11.0
+
+    # open, requests fail fast until backoff passes
+    assert not b.allow(10.5)
+    assert b.get_status()['rejected'] == 1
+    # failure of request sent before opening does not extend backoff
+    assert b.fail(10.5) is None
+    assert b.retry_at == 11.0
+
+    # half open, only one request passes as probe
+    assert b.allow(11.0)
+    assert b.state == lolfastapi.CB_HALF_OPEN
+    assert not b.allow(11.0)
+
+    # failed probe doubles backoff up to max
+    assert b.fail(11.5) == 2.0
+    assert b.retry_at == 13.5
+    assert b.allow(13.5) and b.fail(13.5) == 4.0
+    assert b.allow(17.5) and b.fail(17.5) == 5.0
+    assert b.allow(22.5) and b.fail(22.5) == 5.0
+    assert b.get_status()['opened'] == 5
+
+    # probe without result lets next request probe
+    assert b.allow(27.5)
+    b.abort()
+    assert b.state == lolfastapi.CB_OPEN
+    assert b.allow(27.5)
+
+    # successful probe closes circuit and resets backoff
+    assert b.succeed()
+    assert b.state == lolfastapi.CB_CLOSED
+    assert b.backoff == 1.0
+    assert b.allow(27.5) and b.allow(27.5)
+    assert b.fail(30.0) is None
+
+    # one bad argument does not keep circuit open
+    local_api.setup_config(BREAKER_ON=True, BREAKER_THRESHOLD=3,
+                           BREAKER_BACKOFF=0.2, BREAKER_MAX_BACKOFF=1.0)
+
+    class LocalAPI(local_api.LocalAPI):
+        def get_status(self, loc):
+            if '/0/' in loc:
+                return ('500', 'Internal Server Error')
+            return self.status
+
+    api = lolfastapi.LOLFastAPI(servants=1, limit=[(1000, 1.0)], cores=1,
+                                api=LocalAPI)
+    api.set_keep_alive(False)
+    api.start_multiple_get_mode()
+    admin = api.admin
+    method = lolapi.LOLAPI.get_recent_games
+    for i in range(3):
+        assert admin.get_data(method, (0,))[0][0] == '500'
+    try:
+        admin.get_data(method, (1,))
+    except lolfastapi.CircuitOpenError:
+        pass
+    else:
+        assert 0
+    sent = LocalAPI.sent
+    time.sleep(0.3)
+    # no probe of the bad argument is sent by itself
+    assert LocalAPI.sent == sent
+    assert admin.get_data(method, (1,))[0][0] == '200'
+    status = admin.get_breaker_status()[0]
+    assert status['state'] == lolfastapi.CB_CLOSED, status
+    assert admin.get_data(method, (2,))[0][0] == '200'
+
+    api.close_multiple_get_mode()
+    print('OK')
@@ -0,0 +1,174 @@
+# Test for adaptive concurrency controller of LOLFastAPI
+# adjust() is driven by scripted loads of fake admin instead of traffic,
+# and each rule of decrease and increase is checked by the limit it sets.
+# Latency it reads does not include waiting for connection of pool.
+if __name__ == '__main__':
+    import time
+    from pentakill.lolapi import lolapi, lolfastapi, config
+    import local_api
+
+    config.CONCURRENCY_MIN = 1
+    config.CONCURRENCY_MAX = 20
+    config.POOL_MAX_SIZE = 30
+    config.CONCURRENCY_DECREASE = 0.5
+    config.CONCURRENCY_LIMITED_RATIO = 0.01
+    config.CONCURRENCY_GATE_RATIO = 0.5
+    config.CONCURRENCY_HEADROOM = 1.0
+
+    # admin whose load is cumulative sums of scripted intervals
+    class FakeAdmin(object):
+        def __init__(self):
+            self.load = {'permits': 0, 'waited': 0, 'limited': 0,
+                         'latency': (0, 0.0), 'rate': 10.0}
+            self.cores = None
+
+        def add(self, permits=0, waited=0, limited=0, count=0, latency=0.0,
+                rate=None):
+            load = self.load
+            total = load['latency'][1] + count * latency
+            self.load = {'permits': load['permits'] + permits,
+                         'waited': load['waited'] + waited,
+                         'limited': load['limited'] + limited,
+                         'latency': (load['latency'][0] + count, total),
+                         'rate': load['rate'] if rate is None else rate}
+
+        def get_load(self):
+            return self.load
+
+        def set_core_num(self, num):
+            self.cores = num
+
+        def _debug_msg(self, msg):
+            pass
+
+    class FakeMaster(object):
+        def __init__(self):
+            self.admin = FakeAdmin()
+            self.queue = []
+            self.servants = None
+
+        def set_servant_num(self, num):
+            self.servants = num
+
+    def make(limit):
+        master = FakeMaster()
+        controller = lolfastapi._ConcurrencyController(master, limit)
+        controller.last = master.admin.get_load()
+        return master, controller
+
+    # limit is clamped to [min, max] from the start
+    assert make(0)[1].limit == 1
+    assert make(100)[1].limit == 20
+    # and to connections of pool
+    config.POOL_MAX_SIZE = 10
+    assert make(100)[1].limit == 10
+    config.POOL_ON = False
+    assert make(100)[1].limit == 20
+    config.POOL_ON = True
+    config.POOL_MAX_SIZE = 30
+
+    # nothing happened, nothing changes
+    master, c = make(4)
+    c.adjust()
+    assert c.limit == 4 and master.servants is None
+
+    # backlog with unknown latency, increase by one
+    master, c = make(4)
+    master.queue = [None] * 10
+    c.adjust()
+    assert c.limit == 5 and c.needed is None
+    assert master.servants == 5 and master.admin.cores == 5
+
+    # backlog with known latency, half of the gap to needed number
+    # needed is rate 10/s * latency 1.2s = 12
+    master, c = make(4)
+    master.queue = [None] * 10
+    master.admin.add(permits=10, count=10, latency=1.2)
+    c.adjust()
+    assert c.needed == 12
+    assert c.limit == 8, c.limit
+    master.admin.add(permits=10, count=10, latency=1.2)
+    c.adjust()
+    assert c.limit == 10, c.limit
+    # enough servants for the quota, backlog does not increase more
+    master, c = make(12)
+    master.queue = [None] * 10
+    master.admin.add(permits=10, count=10, latency=1.2)
+    c.adjust()
+    assert c.limit == 12 and master.servants is None
+
+    # no backlog, no increase
+    master, c = make(4)
+    master.admin.add(permits=10, count=10, latency=1.2)
+    c.adjust()
+    assert c.limit == 4
+
+    # 429 above the ratio, multiplicative decrease even with backlog
+    master, c = make(10)
+    master.queue = [None] * 10
+    master.admin.add(permits=100, count=100, latency=0.1, limited=2)
+    c.adjust()
+    assert c.limit == 5, c.limit
+    assert master.servants == 5 and master.admin.cores == 5
+    master.admin.add(permits=100, count=100, latency=0.1, limited=2)
+    c.adjust()
+    assert c.limit == 2, c.limit
+    # down to min at most
+    for i in range(3):
+        master.admin.add(permits=100, count=100, latency=0.1, limited=50)
+        c.adjust()
+    assert c.limit == 1
+    # 429 at the ratio is tolerated
+    master, c = make(10)
+    master.admin.add(permits=100, count=100, latency=0.1, limited=1)
+    c.adjust()
+    assert c.limit == 10
+
+    # requests waiting at permit gate with more servants than needed,
+    # decrease by one
+    # needed is rate 10/s * latency 0.5s = 5
+    master, c = make(8)
+    master.admin.add(permits=10, waited=6, count=10, latency=0.5)
+    c.adjust()
+    assert c.limit == 7, c.limit
+    # not below needed number
+    master, c = make(5)
+    master.admin.add(permits=10, waited=6, count=10, latency=0.5)
+    c.adjust()
+    assert c.limit == 5
+    # not at the ratio
+    master, c = make(8)
+    master.admin.add(permits=10, waited=5, count=10, latency=0.5)
+    c.adjust()
+    assert c.limit == 8
+
+    # increase stops at max
+    master, c = make(18)
+    master.queue = [None] * 10
+    master.admin.add(permits=10, count=10, latency=10.0)
+    c.adjust()
+    assert c.needed == 100
+    assert c.limit == 20
+
+    # decisions and counters
+    metrics = c.get_metrics()
+    assert metrics['increases'] == 1 and metrics['decreases'] == 0
+    assert [d[1:3] for d in metrics['decisions']] == [(18, 20)]
+    assert metrics['decisions'][0][3] == 'backlog 10'
+
+    # time waited for connection of pool is not latency
+    local_api.setup_config()
+
+    class LocalAPI(local_api.LocalAPI):
+        def _send_request(self, type, loc):
+            time.sleep(0.3)
+            self.last_pool_wait = 0.25
+            return local_api.LocalAPI._send_request(self, type, loc)
+
+    admin = lolfastapi.LOLAdmin([(10, 1.0)], cores=1, api=LocalAPI)
+    admin.init()
+    admin.get_data(lolapi.LOLAPI.get_recent_games, (1,))
+    count, total = admin.get_load()['latency']
+    assert count == 1 and 0.05 <= total < 0.2, total
+
+    print('OK')
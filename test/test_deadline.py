@@ -0,0 +1,59 @@
+# Test for deadlines and cancellation of FastRequest
+# Requests not sent before deadline of their FastRequest are dropped with
+# FS_TIMEOUT, cancelled ones get FS_CANCELLED, and neither reaches server.
+if __name__ == '__main__':
+    import time
+    from pentakill.lolapi import lolapi, lolfastapi
+    import local_api
+
+    local_api.setup_config()
+    local_api.LocalAPI.latency = 0.3
+
+    api = lolfastapi.LOLFastAPI(servants=1, limit=[(1000, 1.0)], cores=1,
+                                api=local_api.LocalAPI)
+    api.set_keep_alive(False)
+    api.start_multiple_get_mode()
+    method = lolapi.LOLAPI.get_recent_games
+
+    # the only core is busy until its deadline passes
+    busy = lolfastapi.FastRequest()
+    busy.add_request_name('busy', (method, (0,)))
+    busy = api.get_multiple_data(busy)
+    time.sleep(0.05)
+    late = lolfastapi.FastRequest(deadline=time.time() + 0.1)
+    for i in range(3):
+        late.add_request_name(i, (method, (i + 1,)))
+    late = api.get_multiple_data(late)
+    assert late.wait_response(5)
+    assert all(r[1][0] == lolfastapi.FS_TIMEOUT for r in late)
+    assert busy.wait_response(5)
+    assert busy.get_response('busy')[0] == lolfastapi.FS_OK
+    assert local_api.LocalAPI.sent == 1
+
+    # requests with deadline to come are sent
+    req = lolfastapi.FastRequest()
+    req.set_deadline(time.time() + 5.0)
+    req.add_request_name('games', (method, (10,)))
+    res = api.get_multiple_data(req)
+    assert res.wait_response(5)
+    assert res.get_response('games')[0] == lolfastapi.FS_OK
+    assert local_api.LocalAPI.sent == 2
+
+    # cancelled requests not sent yet are dropped
+    busy = lolfastapi.FastRequest()
+    busy.add_request_name('busy', (method, (20,)))
+    busy = api.get_multiple_data(busy)
+    time.sleep(0.05)
+    req = lolfastapi.FastRequest()
+    for i in range(3):
+        req.add_request_name(i, (method, (21 + i,)))
+    res = api.get_multiple_data(req)
+    res.cancel()
+    assert res.wait_response(5)
+    assert all(r[1][0] == lolfastapi.FS_CANCELLED for r in res)
+    assert busy.wait_response(5)
+    assert local_api.LocalAPI.sent == 3
+    assert api.admin.limiter.inflight == 0
+
+    api.close_multiple_get_mode()
+    print('OK')
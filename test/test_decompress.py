@@ -0,0 +1,111 @@
+# Test for decompression of response body
+# http and asyncio backend decode gzip, deflate (raw) and zlib bodies in
+# the same way, segment by segment, and report truncated bodies. Stream
+# of decompressed segments can be given to incremental parser.
+if __name__ == '__main__':
+    import asyncio, zlib, json, io
+    from pentakill.lolapi import lolapi, lolasyncapi, http
+    import local_api
+
+    data = {'name': 'Annie', 'ids': list(range(2000))}
+    raw = json.dumps(data).encode('utf8')
+
+    def compress(encoding, body):
+        wbits = {'gzip': zlib.MAX_WBITS | 16, 'deflate': -zlib.MAX_WBITS,
+                 'zlib': zlib.MAX_WBITS}[encoding]
+        comp = zlib.compressobj(6, zlib.DEFLATED, wbits)
+        return comp.compress(body) + comp.flush()
+
+    # segment by segment
+    for encoding in ('gzip', 'deflate', 'zlib'):
+        body = compress(encoding, raw)
+        decomp = http.BodyDecompressor(encoding)
+        out = b''.join(decomp.decompress(body[i:i + 100])
+                       for i in range(0, len(body), 100))
+        assert out + decomp.flush() == raw, encoding
+    decomp = http.BodyDecompressor('')
+    assert decomp.decompress(raw) == raw and decomp.flush() == b''
+    # stream over segments as they are decompressed
+    body = compress('gzip', raw)
+    decomp = http.BodyDecompressor('gzip')
+    segments = (decomp.decompress(body[i:i + 100])
+                for i in range(0, len(body), 100))
+    stream = io.BufferedReader(http._BodyStream(segments))
+    assert json.load(io.TextIOWrapper(stream, 'utf8')) == data
+    stream = http._BodyStream(iter([b'ab', b'', b'cde']))
+    buf = bytearray(4)
+    assert stream.readinto(buf) == 2 and buf[:2] == b'ab'
+    assert stream.readinto(buf) == 3 and buf[:3] == b'cde'
+    assert stream.readinto(buf) == 0
+
+    # truncated body
+    decomp = http.BodyDecompressor('gzip')
+    decomp.decompress(compress('gzip', raw)[:-20])
+    try:
+        decomp.flush()
+    except http.DecompressFail:
+        pass
+    else:
+        assert 0
+
+    async def read(message):
+        reader = asyncio.StreamReader()
+        reader.feed_data(message)
+        reader.feed_eof()
+        return await lolasyncapi._read_response(reader)
+
+    def response(headers, body):
+        lines = ['HTTP/1.1 200 OK'] + ['%s: %s' % h for h in headers]
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin1') + body
+
+    # asyncio backend reads the same bodies
+    for encoding in ('gzip', 'deflate', 'zlib'):
+        body = compress(encoding, raw)
+        status, headers, content, keep = asyncio.run(read(response(
+            [('Content-Encoding', encoding),
+             ('Content-Length', str(len(body)))], body)))
+        assert status == ('200', 'OK') and keep
+        assert content == data, encoding
+        # chunked
+        chunks = b''.join(b'%x\r\n%s\r\n' % (len(body[i:i + 500]),
+                                              body[i:i + 500])
+                          for i in range(0, len(body), 500))
+        status, headers, content, keep = asyncio.run(read(response(
+            [('Content-Encoding', encoding),
+             ('Transfer-Encoding', 'chunked')], chunks + b'0\r\n\r\n')))
+        assert content == data, encoding
+
+    # not JSON content is returned as string
+    status, headers, content, keep = asyncio.run(read(response(
+        [('Content-Length', '5'), ('Connection', 'close')], b'hello')))
+    assert content == 'hello' and not keep
+
+    # truncated body fails
+    body = compress('deflate', raw)[:-20]
+    try:
+        asyncio.run(read(response([('Content-Encoding', 'deflate'),
+                                   ('Content-Length', str(len(body)))], body)))
+    except lolapi.HTTPFail:
+        pass
+    else:
+        assert 0
+
+    # LOLAPI reads body of server through http
+    local_api.setup_config()
+    encodings = []
+
+    async def respond(path):
+        encoding = encodings.pop(0)
+        return ('200 OK', {'Content-Encoding': encoding},
+                compress(encoding, raw))
+
+    ServerAPI = local_api.make_server_api(local_api.start_server(respond))
+    api = ServerAPI()
+    api.init()
+    for encoding in ('gzip', 'deflate', 'zlib'):
+        encodings.append(encoding)
+        status, content = api.get_recent_games(1)
+        assert status[0] == '200' and content == data, encoding
+    api.close()
+
+    print('OK')
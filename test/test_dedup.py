@@ -0,0 +1,48 @@
+# Test for priority of deduplicated requests of LOLFastAPI
+# Interactive request attached to identical background request waiting
+# in queue should not wait behind the background requests.
+if __name__ == '__main__':
+    import threading, time
+    from pentakill.lolapi import lolapi, lolfastapi
+    import local_api
+
+    BACKLOG = 20
+
+    local_api.setup_config(DEDUP_ON=True)
+
+    gate = threading.Event()
+
+    class LocalAPI(local_api.LocalAPI):
+        def get_latency(self, loc):
+            gate.wait()
+            return 0.01
+
+    api = lolfastapi.LOLFastAPI(servants=1, limit=[(1000, 1.0)], cores=1,
+                                api=LocalAPI)
+    api.set_keep_alive(False)
+    api.start_multiple_get_mode()
+
+    # servant is busy with the first request until gate opens
+    bg = lolfastapi.FastRequest(lolfastapi.PR_BACKGROUND)
+    for i in range(BACKLOG + 1):
+        bg.add_request_name(i, (lolapi.LOLAPI.get_recent_games, (i,)))
+    bg_res = api.get_multiple_data(bg)
+    time.sleep(0.1)
+
+    # identical to the last background request
+    req = lolfastapi.FastRequest(lolfastapi.PR_INTERACTIVE)
+    req.add_request_name('x', (lolapi.LOLAPI.get_recent_games, (BACKLOG,)))
+    res = api.get_multiple_data(req)
+    assert api.get_metrics()['dedup_hits'] == 1
+    gate.set()
+
+    assert res.wait_response(20)
+    before = bg_res.response_num
+    assert res.get_response('x')[0] == lolfastapi.FS_OK
+    # the first request and the promoted flight itself at most
+    assert before <= 2, before
+    assert bg_res.wait_response(20)
+    assert LocalAPI.sent == BACKLOG + 1
+
+    api.close_multiple_get_mode()
+    print('OK')
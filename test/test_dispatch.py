@@ -0,0 +1,65 @@
+# Test for dispatch of requests to cores of LOLAdmin
+# While one core is stuck with slow request, least loaded dispatch sends
+# the others to idle core, and round robin makes some of them wait.
+if __name__ == '__main__':
+    import threading, time
+    from pentakill.lolapi import lolapi, lolfastapi, config
+    import local_api
+
+    class LocalAPI(local_api.LocalAPI):
+        def get_latency(self, loc):
+            return 0.6 if '/999/' in loc else 0.01
+
+    def run(dispatch):
+        local_api.setup_config(CORE_DISPATCH=dispatch)
+        admin = lolfastapi.LOLAdmin([(1000, 1.0)], cores=2, api=LocalAPI)
+        admin.init()
+        method = lolapi.LOLAPI.get_recent_games
+        slow = threading.Thread(target=admin.get_data, args=(method, (999,)))
+        slow.start()
+        time.sleep(0.05)
+        assert sorted(s['assigned'] for s in admin.get_core_status()) == [0, 1]
+        begin = time.time()
+        for i in range(6):
+            assert admin.get_data(method, (i,))[0][0] == '200'
+        elapsed = time.time() - begin
+        slow.join()
+        assert [s['assigned'] for s in admin.get_core_status()] == [0, 0]
+        return elapsed
+
+    # no request waits behind the slow one
+    elapsed = run(config.D_LEAST_LOADED)
+    assert elapsed < 0.3, elapsed
+    # in turn, the next request of the slow core waits for it
+    elapsed = run(config.D_ROUND_ROBIN)
+    assert elapsed >= 0.4, elapsed
+
+    # core whose latency is high gets fewer requests when none is idle
+    class SlowCoreAPI(local_api.LocalAPI):
+        made = []
+
+        def __init__(self, *args, **kwargs):
+            local_api.LocalAPI.__init__(self, *args, **kwargs)
+            SlowCoreAPI.made.append(self)
+
+        def get_latency(self, loc):
+            return 0.1 if self is SlowCoreAPI.made[0] else 0.02
+
+    local_api.setup_config(CORE_DISPATCH=config.D_LEAST_LOADED)
+    admin = lolfastapi.LOLAdmin([(1000, 1.0)], cores=2, api=SlowCoreAPI)
+    admin.init()
+
+    def call(i):
+        admin.get_data(lolapi.LOLAPI.get_recent_games, (i,))
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(40)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.005)
+    for thread in threads:
+        thread.join()
+    latency = [s['latency'] for s in admin.get_core_status()]
+    counts = [core.latency.get()['count'] for core in admin.cores]
+    slow = latency.index(max(latency))
+    assert counts[slow] < counts[1 - slow], (counts, latency)
+
+    print('OK')
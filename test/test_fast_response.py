@@ -0,0 +1,71 @@
+# Test for waiting on responses of FastResponse
+# Responses are given in order they arrive, waiters of a request wake up
+# only for it, and timeouts expire while other requests are responded.
+if __name__ == '__main__':
+    import threading, time
+    from pentakill.lolapi import lolfastapi
+
+    FS_OK = lolfastapi.FS_OK
+
+    def respond_later(res, items):
+        def run():
+            for delay, name in items:
+                time.sleep(delay)
+                res.add_response(name, (FS_OK, name))
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    # in order of response, not of request
+    res = lolfastapi.FastResponse(3)
+    respond_later(res, [(0.05, 'c'), (0.05, 'a'), (0.05, 'b')])
+    assert [name for name, r in res.as_completed(timeout=5)] == ['c', 'a', 'b']
+    assert res.responded_all()
+    # read ones are not given again
+    assert list(res.as_completed()) == []
+    assert res.next_response() is None
+    assert res.get_response('a') == (FS_OK, 'a')
+
+    # only targets, the others stay unread
+    res = lolfastapi.FastResponse(3)
+    respond_later(res, [(0.05, 'a'), (0.05, 'b'), (0.05, 'c')])
+    assert [name for name, r in res.as_completed(['c', 'a'], 5)] == ['a', 'c']
+    assert res.next_response() == ('b', (FS_OK, 'b'))
+
+    # waiting for any and for all of targets
+    res = lolfastapi.FastResponse(3)
+    thread = respond_later(res, [(0.05, 'a'), (0.2, 'b'), (0.05, 'c')])
+    assert not res.wait(['b'], lolfastapi.W_ALL, 0.1)
+    assert res.wait(['b', 'c'], lolfastapi.W_ANY, 5)
+    assert res.wait(['b', 'c'], lolfastapi.W_ALL, 5)
+    assert res.wait_response(5)
+    thread.join()
+    # the first response of a name is kept
+    res.add_response('a', (lolfastapi.FS_ERROR, 'again'))
+    assert res.get_response('a') == (FS_OK, 'a')
+
+    # timeout of as_completed is for all of them
+    res = lolfastapi.FastResponse(2)
+    respond_later(res, [(0.05, 'a'), (1.0, 'b')])
+    got = []
+    begin = time.time()
+    try:
+        for name, r in res.as_completed(timeout=0.3):
+            got.append(name)
+    except lolfastapi.TimeoutError:
+        pass
+    else:
+        assert 0
+    assert got == ['a']
+    assert 0.3 <= time.time() - begin < 0.9
+    try:
+        res.wait_target_response(['b'], 0.05)
+    except lolfastapi.TimeoutError:
+        pass
+    else:
+        assert 0
+    assert res.wait_target_response(['b'], 5) == ('b', (FS_OK, 'b'))
+    assert res.wait_target_response() is None
+
+    print('OK')
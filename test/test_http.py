@@ -0,0 +1,86 @@
+# Test for buffered socket reader of lolapi http
+# Lines and bodies split at any size are read the same, and bytes of
+# next response are kept for it on keep-alive connection.
+if __name__ == '__main__':
+    import json
+    from pentakill.lolapi import lolapi, http, pool
+    import local_api
+
+    # socket which gives bytes in pieces of 'size'
+    class PieceSocket(object):
+        def __init__(self, data, size):
+            self.data = data
+            self.size = size
+            self.calls = 0
+
+        def recv_into(self, buf):
+            self.calls += 1
+            piece = self.data[:min(self.size, len(buf))]
+            self.data = self.data[len(piece):]
+            buf[:len(piece)] = piece
+            return len(piece)
+
+    data = (b'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello' +
+            b'x' * 100 + b'\nlast')
+    for size in (1, 3, 16, len(data)):
+        reader = http._SocketReader(32)
+        reader.attach(PieceSocket(data, size))
+        assert reader.readline() == b'HTTP/1.1 200 OK\r\n'
+        assert reader.readline() == b'Content-Length: 5\r\n'
+        assert reader.readline() == b'\r\n'
+        assert reader.readexact(5) == b'hello'
+        # line longer than limit is cut
+        assert reader.readline(40) == b'x' * 40
+        assert reader.readline() == b'x' * 60 + b'\n'
+        # bytes left without newline when closed
+        assert reader.readline() == b'last'
+        assert reader.readline() == b''
+        assert reader.read() == b''
+
+    # lines are found in buffer, not by receive of each byte
+    sock = PieceSocket(b'a\r\n' * 1000, 100000)
+    reader = http._SocketReader()
+    reader.attach(sock)
+    for i in range(1000):
+        assert reader.readline() == b'a\r\n'
+    assert sock.calls <= 2, sock.calls
+
+    # body larger than buffer goes directly into returned bytes
+    reader = http._SocketReader()
+    size = http.C_RBUFSIZE * 2
+    reader.attach(PieceSocket(b'0123456789' * (size // 10 + 2), 7000))
+    assert reader.read(4) == b'0123'
+    body = reader.readexact(size)
+    assert len(body) == size and body.startswith(b'456789012')
+    assert reader.read() == (b'0123456789' * (size // 10 + 2))[size + 4:]
+    try:
+        reader.readexact(1)
+    except http.IncompleteRead:
+        pass
+    else:
+        assert 0
+    # bytes of previous socket are discarded
+    reader.attach(PieceSocket(b'new', 7))
+    assert reader.read() == b'new'
+
+    # responses of various sizes on one keep-alive connection
+    local_api.setup_config()
+    sizes = [0, 10, http.C_RBUFSIZE - 50, http.C_RBUFSIZE * 3 + 7, 1]
+
+    async def respond(path):
+        size = sizes[int(path.split('/by-summoner/')[1].split('/')[0])]
+        return ('200 OK', {'Connection': 'keep-alive'},
+                json.dumps({'data': 'x' * size}).encode())
+
+    ServerAPI = local_api.make_server_api(local_api.start_server(respond))
+    api = ServerAPI()
+    api.init()
+    for i in range(len(sizes)):
+        status, content = api.get_recent_games(i)
+        assert status[0] == '200'
+        assert content == {'data': 'x' * sizes[i]}, i
+    metrics = api.pools[lolapi.H_MAIN].get_metrics()
+    assert metrics['created'] == 1 and metrics['reused'] == len(sizes) - 1
+    api.close()
+
+    print('OK')
@@ -0,0 +1,65 @@
+# Test for keys of LOLKeyManager getting out of and back into rotation
+# Fake API answers 401 for one key for a while. The key gets out of
+# rotation by its own timer, not by request through the manager, and it
+# should come back once it's healthy while the other key keeps serving.
+# Cores set by concurrency controller are split among keys.
+if __name__ == '__main__':
+    import time
+    from pentakill.lolapi import lolapi, lolfastapi
+    import local_api
+
+    local_api.setup_config(KEY_RECHECK_INTERVAL=0.2)
+
+    BAD_KEY = 'b'
+    bad_until = [time.time() + 0.5]
+
+    class LocalAPI(local_api.LocalAPI):
+        latency = 0.01
+
+        def get_status(self, loc):
+            if self.key == BAD_KEY and time.time() < bad_until[0]:
+                return ('401', 'Unauthorized')
+            return self.status
+
+    def run(api, num):
+        req = lolfastapi.FastRequest()
+        for i in range(num):
+            req.add_request((lolapi.LOLAPI.get_recent_games, (i,)))
+        res = api.get_multiple_data(req)
+        assert res.wait_response(20)
+        return [r[1][0] for r in res]
+
+    api = lolfastapi.LOLFastAPI(servants=4, limit=[(1000, 1.0)], cores=2,
+                                api=LocalAPI, keys=['a', BAD_KEY])
+    api.set_keep_alive(False)
+    api.start_multiple_get_mode()
+    admins = api.admin.admins
+
+    # bad key goes out of rotation
+    end = time.time() + 5.0
+    while admins[1].is_available() and time.time() < end:
+        try:
+            admins[1].get_data(lolapi.LOLAPI.get_recent_games, (0,))
+        except lolfastapi.Error:
+            pass
+        time.sleep(0.01)
+    assert not admins[1].is_available()
+    assert admins[0].is_available()
+
+    # healthy again, the other key keeps serving meanwhile
+    while time.time() < bad_until[0]:
+        time.sleep(0.05)
+    end = time.time() + 3.0
+    while not admins[1].is_available() and time.time() < end:
+        assert all(status == lolfastapi.FS_OK for status in run(api, 5))
+        time.sleep(0.05)
+    assert [admin.is_available() for admin in admins] == [True, True]
+
+    # cores set for all keys are split among them
+    api.admin.set_core_num(5)
+    assert [admin.core_num for admin in admins] == [3, 2]
+    api.admin.set_core_num(1)
+    assert [admin.core_num for admin in admins] == [1, 1]
+
+    api.close_multiple_get_mode()
+    print('OK')
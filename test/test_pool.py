@@ -0,0 +1,123 @@
+# Test for shared connection pool of lolapi
+# Idle connection closed by server is not handed out, reaper closes idle
+# connections after idle timeout and keeps min_idle ones ready, and
+# exhausted pool is not taken as timeout of server: its permit is given
+# back and circuit breaker does not count it.
+if __name__ == '__main__':
+    import socket, threading, time
+    from pentakill.lolapi import lolapi, lolfastapi, pool, http, config
+
+    # server which accepts connections and keeps them until told to close
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(16)
+    PORT = listener.getsockname()[1]
+    accepted = []
+
+    def accept():
+        while True:
+            sock, addr = listener.accept()
+            accepted.append(sock)
+    thread = threading.Thread(target=accept)
+    thread.daemon = True
+    thread.start()
+
+    def wait_accepted(num):
+        end = time.time() + 5.0
+        while len(accepted) < num and time.time() < end:
+            time.sleep(0.01)
+        assert len(accepted) == num, len(accepted)
+
+    p = pool.ConnectionPool(http.HTTP, '127.0.0.1', PORT, timeout=1.0,
+                            max_size=2, idle_timeout=0.3)
+
+    # idle connection is reused while it is alive
+    conn = p.acquire()
+    p.release(conn)
+    assert p.acquire() is conn
+    p.release(conn)
+    wait_accepted(1)
+    assert p.get_metrics()['reused'] == 1
+
+    # connection closed by server is discarded, new one is made
+    accepted[0].close()
+    time.sleep(0.1)
+    other = p.acquire()
+    assert other is not conn
+    metrics = p.get_metrics()
+    assert metrics['discarded'] == 1 and metrics['created'] == 2
+    assert metrics['size'] == 1
+
+    # exhausted pool raises PoolExhausted, not timeout
+    third = p.acquire()
+    begin = time.time()
+    try:
+        p.acquire(timeout=0.1)
+    except pool.PoolExhausted as err:
+        assert not isinstance(err, http.Timeout)
+    else:
+        assert 0
+    assert time.time() - begin >= 0.1
+    p.release(other)
+    p.release(third)
+
+    # reaper closes connections idle for idle timeout
+    time.sleep(0.4)
+    p.reap()
+    metrics = p.get_metrics()
+    assert metrics['idle'] == 0 and metrics['size'] == 0
+    assert metrics['discarded'] == 3
+
+    # and keeps min_idle connections ready
+    p.min_idle = 2
+    p.reap()
+    metrics = p.get_metrics()
+    assert metrics['idle'] == 2 and metrics['warmed'] == 2
+    p.close()
+    assert p.get_metrics()['size'] == 0
+
+    # request finding no connection in pool is not sent
+    config.STATUS_INIT = False
+    config.STATIC_INIT = False
+    config.CONCURRENCY_ON = False
+    config.BREAKER_THRESHOLD = 1
+
+    # cores make their own API objects, which share the pool of timeout
+    class ServerAPI(lolapi.LOLAPI):
+        def __init__(self, *args, **kwargs):
+            kwargs['timeout'] = 0.2
+            lolapi.LOLAPI.__init__(self, *args, **kwargs)
+
+        def _get_endpoint(self, type):
+            return (http.HTTP, '127.0.0.1', PORT)
+
+    api = ServerAPI()
+    api.init()
+    shared = api.pools[lolapi.H_MAIN]
+    shared.max_size = 1
+    held = shared.acquire()
+    try:
+        api.get_recent_games(1)
+    except lolapi.PoolExhausted:
+        pass
+    else:
+        assert 0
+
+    admin = lolfastapi.LOLAdmin([(10, 1.0)], cores=1, api=ServerAPI)
+    admin.init()
+    try:
+        admin.get_data(lolapi.LOLAPI.get_recent_games, (1,))
+    except lolfastapi.PoolExhaustedError:
+        pass
+    else:
+        assert 0
+    # permit is given back, not counted as used
+    assert admin.limiter.inflight == 0
+    assert admin.limiter.get_left() == 10
+    # neither breaker nor error policy counts it
+    assert admin.get_breaker_status()[0]['state'] == lolfastapi.CB_CLOSED
+    assert admin.get_breaker_status()[0]['failures'] == 0
+    assert admin.is_available()
+    shared.release(held)
+
+    print('OK')
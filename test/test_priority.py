@@ -0,0 +1,63 @@
+# Test for priority classes of LOLFastAPI requests
+# Queue serves higher class first but every class gets its minimum share,
+# and interactive requests go ahead of background requests queued before.
+if __name__ == '__main__':
+    import time
+    from pentakill.lolapi import lolapi, lolfastapi
+    import local_api
+
+    # every class gets its share, the rest goes to the highest
+    q = lolfastapi._PriorityQueue((0.5, 0.2, 0.1))
+    for priority in range(3):
+        for i in range(100):
+            q.push(priority, (priority, i))
+    served = [q.pop()[0] for i in range(100)]
+    counts = [served.count(priority) for priority in range(3)]
+    assert counts[0] >= 60 and counts[1] >= 18 and counts[2] >= 9, counts
+    # lower class is not starved at the start
+    assert 2 in served[:10], served
+    # order in a class is kept, item put first goes first
+    q = lolfastapi._PriorityQueue((0.5, 0.2, 0.1))
+    for i in range(3):
+        q.push(2, i)
+    q.push(2, 'retry', True)
+    assert [q.pop() for i in range(4)] == ['retry', 0, 1, 2]
+    try:
+        q.pop()
+    except IndexError:
+        pass
+    else:
+        assert 0
+
+    try:
+        lolfastapi.FastRequest(len(lolfastapi.config.PRIORITY_SHARES))
+    except lolfastapi.InvalidUseError:
+        pass
+    else:
+        assert 0
+
+    # interactive requests go ahead of background ones queued before
+    local_api.setup_config()
+    local_api.LocalAPI.latency = 0.02
+    api = lolfastapi.LOLFastAPI(servants=1, limit=[(1000, 1.0)], cores=1,
+                                api=local_api.LocalAPI)
+    api.set_keep_alive(False)
+    api.start_multiple_get_mode()
+    method = lolapi.LOLAPI.get_recent_games
+
+    req = lolfastapi.FastRequest(lolfastapi.PR_BACKGROUND)
+    for i in range(30):
+        req.add_request_name(i, (method, (i,)))
+    background = api.get_multiple_data(req)
+    req = lolfastapi.FastRequest(lolfastapi.PR_INTERACTIVE)
+    for i in range(3):
+        req.add_request_name(i, (method, (100 + i,)))
+    interactive = api.get_multiple_data(req)
+    assert interactive.wait_response(10)
+    assert all(r[1][0] == lolfastapi.FS_OK for r in interactive)
+    # background requests keep their share, but most are still queued
+    assert background.response_num < 10, background.response_num
+    assert background.wait_response(10)
+
+    api.close_multiple_get_mode()
+    print('OK')
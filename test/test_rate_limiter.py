@@ -0,0 +1,140 @@
+# Test for rate limiter of LOLAdmin
+# Every window of limits holds permits at once, and permits in flight
+# count until they finish. Counts of server only raise windows, even if
+# responses arrive out of order, limits told by server replace the
+# configured ones, and limit exceeded blocks permits for Retry-After or
+# its default.
+if __name__ == '__main__':
+    import time, threading
+    from pentakill.lolapi import lolapi, lolfastapi, config
+    import local_api
+
+    RL = lolfastapi._RateLimiter
+
+    # both windows apply at once
+    r = RL([(3, 1.0), (5, 10.0)])
+    assert r.get_capacity() == 3
+    for i in range(3):
+        assert r.acquire(0.0)
+    assert not r.acquire(0.0)
+    # in flight permits wait for finish, no time is known
+    assert r.get_next_refill(0.0) is None
+    for i in range(3):
+        r.release(0.5)
+    assert r.inflight == 0 and r.get_left(0.5) == 0
+    assert r.get_next_refill(0.5) == 1.0
+    # short window refilled, long one has 2 left
+    assert r.get_left(1.5) == 2
+    assert r.acquire(1.5, 2)
+    r.release(1.5)
+    r.cancel()
+    assert r.get_left(1.6) == 1
+    # the oldest permit of long window leaves first
+    assert r.acquire(1.6)
+    r.release(1.6)
+    assert r.get_left(1.6) == 0
+    assert r.get_next_refill(2.0) == 8.5
+    assert r.get_next_refill(2.0, 3) == 8.5
+    # more than short window holds
+    assert r.get_next_refill(2.0, 4) is None
+    assert r.get_left(10.5) == 3
+
+    # permits of admin are shared by cores of all threads
+    local_api.setup_config()
+    local_api.LocalAPI.latency = 0.05
+    admin = lolfastapi.LOLAdmin([(5, 0.5)], cores=4, api=local_api.LocalAPI)
+    admin.init()
+    sent = []
+
+    def run(i):
+        admin.get_data(lolapi.LOLAPI.get_recent_games, (i,))
+        sent.append(time.time())
+    begin = time.time()
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    sent = sorted(t - begin for t in sent)
+    # 5 in the first window, the rest after it
+    assert sent[4] < 0.4 and sent[5] >= 0.5, sent
+    assert admin.limiter.inflight == 0
+    local_api.LocalAPI.latency = 0.0
+
+    # responses arriving out of order, the newest count is 10
+    r = RL([(10, 10.0)])
+    for count in range(10, 0, -1):
+        r.correct([], [(count, 10.0)], now=100.0)
+    assert len(r.logs[0]) == 10
+    assert r.get_left(100.0) == 0
+    # requests we logged ourselves are not dropped by lower count
+    r = RL([(10, 10.0)])
+    for i in range(4):
+        assert r.acquire(100.0)
+        r.release(100.0)
+    r.correct([], [(1, 10.0)], now=100.5)
+    assert r.get_left(100.5) == 6
+    r.correct([], [(7, 10.0)], now=101.0)
+    assert r.get_left(101.0) == 3
+    # counted requests expire with the window
+    assert r.get_left(110.6) == 7
+    assert r.get_left(111.1) == 10
+
+    # headers of server tell limits and counts
+    r = RL([(20, 1.0)])
+    headers = {'x-app-rate-limit': '5:1,50:10',
+               'x-app-rate-limit-count': '3:1,30:10'}
+    assert r.apply_headers('200', headers, now=200.0) is None
+    assert r.limits == [(5, 1.0), (50, 10.0)]
+    assert r.get_left(200.0) == 2
+    # after short window, long one still counts
+    assert r.get_left(201.5) == 5
+    r.correct([], [(48, 10.0)], now=201.5)
+    assert r.get_left(201.5) == 2
+    # headers of other limiter are ignored
+    assert r.apply_headers('200', {'x-method-rate-limit-count': '9:1'},
+                           now=201.5) is None
+    assert r.get_left(201.5) == 2
+
+    # limit exceeded blocks for Retry-After
+    r = RL([(10, 1.0)])
+    assert r.apply_headers(config.SC_LIMIT_EXCEEDED,
+                           {'retry-after': '3'}, now=300.0) == 3.0
+    assert r.get_left(302.9) == 0
+    assert r.get_next_refill(302.0) == 1.0
+    assert r.get_left(303.0) == 10
+    # and for default without it
+    assert r.apply_headers(config.SC_LIMIT_EXCEEDED, {},
+                           now=400.0) == config.RETRY_AFTER_DEFAULT
+    assert r.get_left(400.0 + config.RETRY_AFTER_DEFAULT) == 10
+    assert r.get_left(400.0 + config.RETRY_AFTER_DEFAULT - 0.1) == 0
+
+    # admin corrects its limiter by headers of responses
+    local_api.setup_config()
+    replies = []
+
+    class LocalAPI(local_api.LocalAPI):
+        def _send_request(self, type, loc):
+            self.last_response = replies.pop(0)
+            return self.last_response
+
+    admin = lolfastapi.LOLAdmin([(100, 10.0)], cores=1, api=LocalAPI)
+    admin.init()
+    method = lolapi.LOLAPI.get_recent_games
+    replies.append((('200', 'OK'),
+                    {'x-app-rate-limit': '20:10',
+                     'x-app-rate-limit-count': '15:10'}))
+    admin.get_data(method, (1,))
+    assert admin.limits == [(20, 10.0)]
+    assert admin.limiter.get_left() == 5
+    begin = time.time()
+    replies.append((('429', 'Too Many Requests'),
+                    {'retry-after': '0.5', 'x-rate-limit-type': 'application'}))
+    replies.append((('200', 'OK'), {}))
+    # request is sent again after Retry-After
+    assert admin.get_data(method, (2,))[0][0] == '200'
+    assert time.time() - begin >= 0.5
+    assert admin.limiter.blocked_until >= begin + 0.5
+    assert admin.limiter.get_left() == 3
+
+    print('OK')
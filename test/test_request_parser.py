@@ -0,0 +1,82 @@
+# Test for buffered request parser of update server
+# Requests split at any byte or sent back to back on keep-alive
+# connection are parsed the same, and bytes of next request are kept
+# for it.
+if __name__ == '__main__':
+    import socket, threading
+    from pentakill.update import server
+    from pentakill.update.server import ParseError
+
+    REQUESTS = [
+        (b'GET /summoner?name=hide%20on%20bush&region=kr HTTP/1.1\r\n'
+         b'Host: localhost\r\n'
+         b'Connection: keep-alive\r\n\r\n'),
+        (b'POST /match HTTP/1.1\r\n'
+         b'Host: localhost\r\n'
+         b'Content-Type: text/json\r\n'
+         b'Content-Length: 20\r\n\r\n'
+         b'{"match_id": 123456}'),
+        (b'POST /runes HTTP/1.1\r\n'
+         b'Transfer-Encoding: chunked\r\n\r\n'
+         b'a\r\n{"id": 123\r\n1;ext\r\n}\r\n0\r\n\r\n'),
+    ]
+
+    # socket which gives bytes in pieces of 'size'
+    class PieceSocket(object):
+        def __init__(self, data, size):
+            self.data = data
+            self.size = size
+
+        def recv_into(self, buf):
+            piece = self.data[:min(self.size, len(buf))]
+            self.data = self.data[len(piece):]
+            buf[:len(piece)] = piece
+            return len(piece)
+
+    def check(parser):
+        parser.parse_request()
+        assert parser.get_request() == ('GET', '/summoner?name=hide%20on%20bush'
+                                        '&region=kr', 'HTTP/1.1')
+        assert parser.get_get() == {'name': 'hide%20on%20bush', 'region': 'kr'}
+        assert parser.get_header('Connection') == 'keep-alive'
+        assert parser.get_body() is None
+        parser.parse_request()
+        assert parser.get_request()[:2] == ('POST', '/match')
+        assert parser.get_header('content-type') == 'text/json'
+        assert parser.get_body() == b'{"match_id": 123456}'
+        assert parser.get_get() == {}
+        parser.parse_request()
+        assert parser.get_body() == b'{"id": 123}'
+
+    data = b''.join(REQUESTS)
+    for size in (1, 2, 7, 64, len(data)):
+        check(server.Server._RequestParser(PieceSocket(data, size)))
+
+    # many requests on real socket, across boundaries of buffer
+    a, b = socket.socketpair()
+    num = 2000
+    thread = threading.Thread(target=lambda: (a.sendall(data * num),
+                                              a.shutdown(socket.SHUT_WR)))
+    thread.start()
+    parser = server.Server._RequestParser(b)
+    for i in range(num):
+        check(parser)
+    thread.join()
+    a.close()
+    b.close()
+
+    # errors
+    def fails(data):
+        try:
+            server.Server._RequestParser(PieceSocket(data, 16)).parse_request()
+        except ParseError:
+            return True
+        return False
+    assert fails(b'GET /' + b'a' * server.LINE_MAX_SIZE + b' HTTP/1.1\r\n\r\n')
+    assert fails(b'BAD\r\n\r\n')
+    assert fails(b'POST /a HTTP/1.1\r\nContent-Length: 10\r\n\r\nshort')
+    assert fails(b'POST /a HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n'
+                 b'zz\r\n')
+    assert fails(b'POST /a HTTP/1.1\r\nHost: a\r\n\r\n')
+
+    print('OK')
@@ -0,0 +1,77 @@
+# Test for heap scheduler of lib
+# Events run in order of time, cancelled ones do not run, and slow
+# blocking event does not delay other events due meanwhile.
+if __name__ == '__main__':
+    import threading, time
+    from pentakill.lib import scheduler
+
+    s = scheduler.Scheduler('test', max_workers=2)
+
+    # order of time, not of scheduling
+    fired = []
+    done = threading.Event()
+    s.schedule(0.2, fired.append, ('c',))
+    s.schedule(0.1, fired.append, ('b',))
+    s.schedule(0.0, fired.append, ('a',))
+    s.schedule(0.3, done.set)
+    assert done.wait(5)
+    assert fired == ['a', 'b', 'c'], fired
+
+    # cancel by handle and by name, the same name replaces event
+    fired = []
+    done.clear()
+    event = s.schedule(0.1, fired.append, ('x',))
+    s.schedule(0.1, fired.append, ('y',), name='n')
+    s.schedule(0.1, fired.append, ('z',), name='n')
+    assert s.cancel(event)
+    assert not s.cancel(event)
+    s.schedule(0.3, done.set)
+    assert done.wait(5)
+    assert fired == ['z'], fired
+    assert s.cancel('n') is False
+
+    # slow blocking event does not delay another due event
+    started = {}
+    release = threading.Event()
+    def slow():
+        started['slow'] = time.time()
+        release.wait(5)
+    def fast(name):
+        started[name] = time.time()
+    begin = time.time()
+    s.schedule(0.0, slow, blocking=True)
+    s.schedule(0.1, fast, ('blocking',), blocking=True)
+    s.schedule(0.1, fast, ('plain',))
+    time.sleep(0.5)
+    assert 'slow' in started
+    assert started['blocking'] - begin < 0.3, started['blocking'] - begin
+    assert started['plain'] - begin < 0.3, started['plain'] - begin
+    release.set()
+
+    # blocking events beyond the pool wait for a worker
+    release.clear()
+    count = [0]
+    count_mutex = threading.Lock()
+    def block():
+        with count_mutex:
+            count[0] += 1
+        release.wait(5)
+    for i in range(5):
+        s.schedule(0.0, block, blocking=True)
+    time.sleep(0.3)
+    assert count[0] == 2, count[0]
+    release.set()
+    time.sleep(0.3)
+    assert count[0] == 5, count[0]
+    metrics = s.get_metrics()
+    assert metrics['workers'] == 2
+    # scheduler thread and workers
+    assert metrics['threads_created'] == 3
+
+    # error of event does not stop scheduler
+    done.clear()
+    s.schedule(0.0, lambda: 1 / 0)
+    s.schedule(0.1, done.set)
+    assert done.wait(5)
+
+    print('OK')
@@ -0,0 +1,90 @@
+# Test for static data store of lolapi
+# Data of new version replaces the old one, whose mapping is closed and
+# whose file is removed. LOLFastAPI checks new version periodically.
+if __name__ == '__main__':
+    import tempfile, shutil, os, time
+    from pentakill.lolapi import static_store, lolfastapi
+    import local_api
+
+    path = tempfile.mkdtemp()
+    try:
+        store = static_store.StaticStore(path)
+        assert not store.open()
+        assert store.get('champion', 1) is None
+
+        store.write('1.0', {'champion': {1: {'name': 'Annie'}},
+                            'item': {1001: {'name': 'Boots'}}})
+        assert store.get_version() == '1.0'
+        assert store.get('champion', 1) == {'name': 'Annie'}
+        assert store.get('champion', 2) is None
+        assert sorted(store.get_ids('item')) == ['1001']
+        old = store.current[0]
+
+        # the same file is not mapped again
+        assert store.open()
+        assert store.current[0] is old
+
+        # another process sees the same data
+        other = static_store.StaticStore(path)
+        assert other.open()
+        assert other.get('item', 1001) == {'name': 'Boots'}
+
+        store.write('1.1', {'champion': {1: {'name': 'Annie2'}}})
+        assert store.get_version() == '1.1'
+        assert store.get('champion', 1) == {'name': 'Annie2'}
+        assert store.get('item', 1001) is None
+        assert old.closed
+        files = [name for name in os.listdir(path) if name.endswith('.jsonl')]
+        assert files == ['static-1.1.jsonl'], files
+
+        # the other process keeps its mapping until it opens again
+        assert other.get_version() == '1.0'
+        assert other.open()
+        assert other.get('champion', 1) == {'name': 'Annie2'}
+
+        store.close()
+        other.close()
+        assert store.get('champion', 1) is None
+
+        # new version is found while multiple get mode is on
+        local_api.setup_config(STATIC_STORE_ON=True, STATIC_STORE_DIR=path,
+                               STATIC_REFRESH_INTERVAL=0.2)
+        versions = ['2.0']
+
+        class LocalAPI(local_api.LocalAPI):
+            def init_static(self):
+                pass
+
+            def get_versions(self):
+                return (('200', 'OK'), list(versions))
+
+            def _get_static(self, version=None, **options):
+                return (('200', 'OK'),
+                        {'data': {1: {'name': 'Annie', 'version': version}}})
+            get_static_champions = _get_static
+            get_static_items = _get_static
+            get_static_runes = _get_static
+            get_static_masteries = _get_static
+
+        api = lolfastapi.LOLFastAPI(servants=1, limit=[(10, 1.0)], cores=1,
+                                    api=LocalAPI)
+        api.set_keep_alive(False)
+        api.start_multiple_get_mode()
+        assert api.get_static('champion', 1)['version'] == '2.0'
+        versions.insert(0, '2.1')
+        end = time.time() + 5.0
+        while (api.get_static('champion', 1)['version'] != '2.1' and
+               time.time() < end):
+            time.sleep(0.05)
+        assert api.get_static('champion', 1)['version'] == '2.1'
+        api.close_multiple_get_mode()
+        assert api.static_event is None
+        # no check after close
+        versions.insert(0, '2.2')
+        time.sleep(0.4)
+        assert api.get_static('champion', 1)['version'] == '2.1'
+        api.static.close()
+    finally:
+        shutil.rmtree(path)
+
+    print('OK')
@@ -1,6 +1,8 @@
 # Pentakill update server
 import socket, threading, json, urllib.request, urllib.parse, urllib.error, unicodedata
+import asyncio, concurrent.futures
 from pentakill.update import updator
+from pentakill.lolapi import lolfastapi
 from pentakill.lib import tree
 
 # Server configuration
@@ -10,19 +12,34 @@ BACKLOG = 20
 
 READ_TIMEOUT = 10.0
 LINE_MAX_SIZE = 1024
+# Size of receive buffer of request parser, at least LINE_MAX_SIZE
+RECV_BUF_SIZE = 8192
 
 HDR_SERVER = 'Pentakill Update Server'
 HDR_CONTENT_TYPE = 'text/json; charset=utf-8'
 HDR_ACCESS_CONTROL_ORIGIN = '*'
 HDR_KEEP_ALIVE = 20
 
+# Serving modes
+# MODE_THREAD : each connection runs in another dedicated thread
+# MODE_ASYNC  : all connections are multiplexed on one asyncio event loop
+#               and blocking update work is handed to a bounded executor
+MODE_THREAD = 'thread'
+MODE_ASYNC = 'async'
+MODE = MODE_THREAD
+
+# Maximum number of threads doing update work in asyncio mode
+WORKER_NUM = 32
+
 # Update server runs in dedicated thread
-# Each connection runs in another dedicated thread
+# Each connection runs in another dedicated thread, or in the event loop
+# of the server thread in asyncio mode
 class UpdateServer(object):
-    def __init__(self, ip=IP, port=PORT, backlog=BACKLOG):
+    def __init__(self, ip=IP, port=PORT, backlog=BACKLOG, mode=MODE):
         self.ip = ip
         self.port = port
         self.backlog = backlog
+        self.mode = mode
         
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
         
@@ -37,7 +54,10 @@ class UpdateServer(object):
 
     def start(self):
         self.sock.listen(self.backlog)
-        self.routine = self.ServerRoutine(self)
+        if self.mode == MODE_ASYNC:
+            self.routine = self.AsyncServerRoutine(self)
+        else:
+            self.routine = self.ServerRoutine(self)
         self.routine.daemon = True
         self.routine.start()
         
@@ -48,7 +68,7 @@ class UpdateServer(object):
         #sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
         #ip = '127.0.0.1' if self.ip == '0.0.0.0' else self.ip
         # listening socket close must come first
-        self.sock.close()
+        self.routine.stop()
         #sock.connect((ip, self.port))
         #time.sleep(20)
         #sock.close()
@@ -70,6 +90,11 @@ class UpdateServer(object):
         def run(self):
             self._routine()
             
+        # Stop accepting connections, closing listening socket makes
+        # accept() in routine fail
+        def stop(self):
+            self.sock.close()
+            
         # Server routine
         def _routine(self):
             n = 0
@@ -108,6 +133,113 @@ class UpdateServer(object):
                 if server is None:
                     break
                 server.join(10)
+                
+    # Server routine serving every connection in one asyncio event loop
+    # Parsing and sending are done in the loop, and only work for request
+    # which may block on DB or API is run by executor with WORKER_NUM threads
+    class AsyncServerRoutine(ServerRoutine):
+        def __init__(self, server):
+            super(UpdateServer.AsyncServerRoutine, self).__init__(server)
+            self.loop = None
+            self.executor = None
+            self.aserver = None
+            # tasks serving connections
+            self.conns = set()
+            
+        def stop(self):
+            loop = self.loop
+            if loop is None or loop.is_closed():
+                self.sock.close()
+                return
+            try:
+                loop.call_soon_threadsafe(self._close)
+            except RuntimeError:
+                # loop is already closed
+                self.sock.close()
+            
+        # Must be called in event loop
+        def _close(self):
+            if self.aserver:
+                self.aserver.close()
+            for task in self.conns:
+                task.cancel()
+            self.loop.stop()
+            
+        def _routine(self):
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.executor = concurrent.futures.ThreadPoolExecutor(WORKER_NUM)
+            try:
+                self.loop.run_until_complete(self._start())
+                self.loop.run_forever()
+                # wait for cancelled connections to close
+                if self.conns:
+                    self.loop.run_until_complete(
+                        asyncio.gather(*self.conns, return_exceptions=True))
+            finally:
+                self.executor.shutdown(wait=False)
+                self.loop.close()
+                self.sock.close()
+            
+        async def _start(self):
+            self.aserver = await asyncio.start_server(self._serve, sock=self.sock,
+                                                      limit=LINE_MAX_SIZE)
+            
+        # Serve one connection, same as Server.run() in thread mode
+        async def _serve(self, reader, writer):
+            task = asyncio.current_task()
+            self.conns.add(task)
+            addr = writer.get_extra_info('peername')
+            print('client :', addr, 'start')
+            worker = RequestWorker(self)
+            parser = Server._AsyncRequestParser(reader)
+            sender = Server._ResponseSender(None)
+            cnt = 0
+            close = False
+            while True:
+                try:
+                    # keep-alive connection is closed after READ_TIMEOUT idle
+                    await asyncio.wait_for(parser.parse_request(), READ_TIMEOUT)
+                    
+                    headers = parser.get_headers()
+                    hdr_conn = parser.get_header('Connection')
+                    if hdr_conn and hdr_conn == 'close':
+                        close = True
+                    
+                    method, path, http = parser.get_request()
+                    print(parser.get_request())
+                    msg = await self.loop.run_in_executor(self.executor, worker.work,
+                                                          method, path, parser.get_get(),
+                                                          parser.get_body())
+                    if msg is None:
+                        continue
+                    print(msg)
+                    sender.set_status('200', 'OK')
+                    sender.look_headers(headers)
+                    sender.set_body(msg)
+                    writer.write(sender.make_respond())
+                    await writer.drain()
+                    sender.reset()
+                    
+                    if close:
+                        break
+                except asyncio.CancelledError:
+                    break
+                except (Error, socket.error, asyncio.TimeoutError) as err:
+                    print(err)
+                    break
+                except (KeyError, ValueError, Exception) as err:
+                    cnt += 1
+                    if cnt >= 10:
+                        break
+                    import traceback
+                    traceback.print_exc()
+                    print(err)
+                    continue
+                
+            print('client :', addr, 'close')
+            self.conns.discard(task)
+            writer.close()
         
 class SyncInitFinal(updator.UpdatorInitFinal):
     def __init__(self, key, tree):
@@ -157,17 +289,12 @@ class PollingInitFinal(SyncInitFinal):
     def wait_start(self):
         self.sema.acquire()
         
-class Server(threading.Thread):
-    def __init__(self, id, conn, addr, routine):
-        super(Server, self).__init__()
-        self.id = id
-        self.conn, self.addr = conn, addr
-        self.request, self.arg = None, None
-        self.conn.settimeout(READ_TIMEOUT)
+# Does work for parsed request and makes response message
+# Both serving modes use it, one worker per connection
+class RequestWorker(object):
+    def __init__(self, routine):
         self.module = routine.server.get_updator()
         
-        self.servers = routine.servers
-        
         self.summoner_name_tree = routine.summoner_name_tree
         self.summoner_id_tree = routine.summoner_id_tree
         self.match_tree = routine.match_tree
@@ -175,79 +302,34 @@ class Server(threading.Thread):
         
         self.data = None
         
-    def run(self):
-        print('client :', self.addr, 'start')
-        cnt = 0
-        parser = self._RequestParser(self.conn)
-        sender = self._ResponseSender(self.conn)
-        close = False
-        while True:
-            try:
-                self.data = {}
-                parser.parse_request()
-                
-                headers = parser.get_headers()
-                hdr_conn = parser.get_header('Connection')
-                if hdr_conn and hdr_conn == 'close':
-                    close = True
-                    #print 'connection', hdr_conn
-                
-                method, path, http = parser.get_request()
-                print(parser.get_request())
-                # Put data from request
-                method = method.upper()
-                if method == 'GET':
-                    # Get method data
-                    data = parser.get_get()
-                    if 'name' in data:
-                        data['name'] = urllib.parse.unquote(data['name'])
-                elif method == 'POST':
-                    body = parser.get_body().decode('utf8')
-                    data = json.loads(body, 'utf8')
-                    if 'name' in data:
-                        data['name'] = data['name'].encode('utf8')
-                else:
-                    continue
-                self._put_input(data)
-                
-                split = path.split('?')[0].split('/')
-                pathdir = split[1]
-                if pathdir.lower() != 'update':
-                    continue
-                
-                msg = self._work_for_request()
-                print(msg)
-                sender.set_status('200', 'OK')
-                sender.look_headers(headers)
-                sender.set_body(msg)
-                sender.send_respond()
-                sender.reset()
-                
-                if close:
-                    break
-            except (Error, socket.error) as err:
-                import traceback
-                traceback.print_exc()
-                print(err)
-                break
-            except (KeyError, ValueError, Exception) as err:
-                cnt += 1
-                if cnt >= 10:
-                    break
-                import traceback
-                traceback.print_exc()
-                print(err)                
-                continue
-            
-        print('client :', self.addr, 'close')
-        self.servers.acquire_mutex()
-        self.servers.delete(self.id)
-        self.servers.release_mutex()
-        try:
-            self.conn.shutdown(socket.SHUT_RDWR)
-        except socket.error:
-            pass
-        self.conn.close()
+    # Work for request and return response message
+    # If request is not for update, return None
+    # get : dictionary of GET method data
+    # body : request body bytes or None
+    def work(self, method, path, get, body):
+        self.data = {}
+        # Put data from request
+        method = method.upper()
+        if method == 'GET':
+            # Get method data
+            data = get
+            if 'name' in data:
+                data['name'] = urllib.parse.unquote(data['name'])
+        elif method == 'POST':
+            body = body.decode('utf8')
+            data = json.loads(body, 'utf8')
+            if 'name' in data:
+                data['name'] = data['name'].encode('utf8')
+        else:
+            return None
+        self._put_input(data)
+        
+        split = path.split('?')[0].split('/')
+        pathdir = split[1]
+        if pathdir.lower() != 'update':
+            return None
+        
+        return self._work_for_request()
         
     def _put_input(self, data):
         self.data['request'] = data['request']
@@ -300,6 +382,8 @@ class Server(threading.Thread):
         
         key = id if id is not None else name
         if block:
+            # user is waiting, so it goes ahead of background updates
+            updator.set_priority(lolfastapi.PR_INTERACTIVE)
             initfinal = SyncInitFinal(key, tree)
             updator.init(db, initfinal)
         else:
@@ -380,6 +464,71 @@ class Server(threading.Thread):
         elif type == 'match':
             return self.match_tree
             
+class Server(threading.Thread):
+    def __init__(self, id, conn, addr, routine):
+        super(Server, self).__init__()
+        self.id = id
+        self.conn, self.addr = conn, addr
+        self.request, self.arg = None, None
+        self.conn.settimeout(READ_TIMEOUT)
+        
+        self.servers = routine.servers
+        self.worker = RequestWorker(routine)
+        
+    def run(self):
+        print('client :', self.addr, 'start')
+        cnt = 0
+        parser = self._RequestParser(self.conn)
+        sender = self._ResponseSender(self.conn)
+        close = False
+        while True:
+            try:
+                parser.parse_request()
+                
+                headers = parser.get_headers()
+                hdr_conn = parser.get_header('Connection')
+                if hdr_conn and hdr_conn == 'close':
+                    close = True
+                    #print 'connection', hdr_conn
+                
+                method, path, http = parser.get_request()
+                print(parser.get_request())
+                msg = self.worker.work(method, path, parser.get_get(), parser.get_body())
+                if msg is None:
+                    continue
+                print(msg)
+                sender.set_status('200', 'OK')
+                sender.look_headers(headers)
+                sender.set_body(msg)
+                sender.send_respond()
+                sender.reset()
+                
+                if close:
+                    break
+            except (Error, socket.error) as err:
+                import traceback
+                traceback.print_exc()
+                print(err)
+                break
+            except (KeyError, ValueError, Exception) as err:
+                cnt += 1
+                if cnt >= 10:
+                    break
+                import traceback
+                traceback.print_exc()
+                print(err)                
+                continue
+            
+        print('client :', self.addr, 'close')
+        self.servers.acquire_mutex()
+        self.servers.delete(self.id)
+        self.servers.release_mutex()
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.conn.close()
+        
     class _ResponseSender(object):
         def __init__(self, conn):
             self.conn = conn
@@ -421,6 +570,10 @@ class Server(threading.Thread):
             self.body = body
             
         def send_respond(self):
+            self.conn.sendall(self.make_respond())
+            
+        # Make encoded response message
+        def make_respond(self):
             rheaders = {} if self.req_headers is None else self.req_headers
             size = 0
             if self.body:
@@ -449,11 +602,19 @@ class Server(threading.Thread):
             
             message = '{0}{1}{2}'.format(*(respond_line, headers, body))
             #print 'body', body
-            self.conn.sendall(message.encode('utf8'))
+            return message.encode('utf8')
             
+    # Request parser reads from socket in large chunks into reusable buffer
+    # and finds line boundaries in the buffer. Bytes read beyond current
+    # request are left in the buffer for next request on keep-alive connection
     class _RequestParser(object):
         def __init__(self, conn):
             self.conn = conn
+            # bytes in buf[start:end] are received but not parsed yet
+            self.buf = bytearray(max(RECV_BUF_SIZE, LINE_MAX_SIZE))
+            self.view = memoryview(self.buf)
+            self.start = 0
+            self.end = 0
                 
         def _init(self):
             self.method, self.path, self.http = None, None, None
@@ -461,57 +622,76 @@ class Server(threading.Thread):
             self.headers = {}
             self.body = None
             
+        # Receive more bytes into the buffer
+        # Returns number of bytes received, 0 if connection is closed
+        def _fill(self):
+            if self.start == self.end:
+                self.start = self.end = 0
+            elif self.end == len(self.buf):
+                # move unparsed bytes to the front
+                left = self.end - self.start
+                self.view[:left] = self.view[self.start:self.end]
+                self.start, self.end = 0, left
+            read = self.conn.recv_into(self.view[self.end:])
+            self.end += read
+            return read
+            
+        # Returns line including CRLF
+        # If connection is closed, returns bytes left without newline
         def _readline(self):
-            size = LINE_MAX_SIZE
-            array = []
-            cnt = 0
+            scanned = 0
             while True:
-                c = self.conn.recv(1)
-                if not c:
-                    break
-                array.append(c)
-                cnt += 1
-                if cnt == size or c == b'\n':
-                    break
-                
-            return b''.join(array)
+                idx = self.buf.find(b'\n', self.start + scanned, self.end)
+                if idx >= 0:
+                    if idx + 1 - self.start > LINE_MAX_SIZE:
+                        raise ParseError('request line too long')
+                    line = bytes(self.view[self.start:idx + 1])
+                    self.start = idx + 1
+                    return line
+                scanned = self.end - self.start
+                if scanned >= LINE_MAX_SIZE:
+                    raise ParseError('request line too long')
+                if not self._fill():
+                    line = bytes(self.view[self.start:self.end])
+                    self.start = self.end
+                    return line
                 
+        # Read exactly 'size' bytes, buffered bytes are taken first and
+        # the rest is received directly into returned bytearray
         def _safe_read(self, size):
-            array = []
-            cnt = 0
-            left = size
-            while True:
-                cs = self.conn.recv(left)
-                read = len(cs)
+            data = bytearray(size)
+            view = memoryview(data)
+            cnt = min(size, self.end - self.start)
+            view[:cnt] = self.view[self.start:self.start + cnt]
+            self.start += cnt
+            while cnt < size:
+                read = self.conn.recv_into(view[cnt:])
                 if read == 0:
                     raise ParseError('connection closed while '
                                      'expected bytes are left')
-                array.append(cs)
                 cnt += read
-                left -= read
-                if left == 0:
-                    break
             
-            return b''.join(array)
+            return data
+        
+        def _chunk_size(self, line):
+            # check chunk-extension
+            comma = line.find(b';')
+            if comma != -1:
+                line = line[:comma]
+            else:
+                #line = self._remove_crlf(line)
+                line = line[:len(line)-2]
+            
+            try:
+                return int(line, 16)
+            except ValueError:
+                raise ParseError('invalid chunk size')
         
         def _chunked_read(self):
             chunks = []
             
             while True:
-                line = self._readline()
-                
-                # check chunk-extension
-                comma = line.find(b';')
-                if comma != -1:
-                    line = line[:comma]
-                else:
-                    #line = self._remove_crlf(line)
-                    line = line[:len(line)-2]
-                
-                try:
-                    chunk_size = int(line, 16)
-                except ValueError:
-                    raise ParseError('invalid chunk size')
+                chunk_size = self._chunk_size(self._readline())
                 
                 if not chunk_size:
                     # read CRLF
@@ -543,39 +723,55 @@ class Server(threading.Thread):
                     raise ParseError('not enough key value data')
                 
         def _parse_headers(self):
-            while True:
-                header = self._readline().decode('utf8')
-                header = header.strip()
-                if len(header) == 0:
-                    break
-                keyval = header.split(':')
-                key = keyval[0].strip().lower()
-                val = ':'.join(keyval[1:]).strip().lower()
-                self.headers[key] = val
+            while self._add_header(self._readline()):
+                pass
+            
+        # Add header line, returns False if it is the empty line
+        # which ends headers
+        def _add_header(self, header):
+            header = header.decode('utf8')
+            header = header.strip()
+            if len(header) == 0:
+                return False
+            keyval = header.split(':')
+            key = keyval[0].strip().lower()
+            val = ':'.join(keyval[1:]).strip().lower()
+            self.headers[key] = val
+            return True
             
         def _parse_request_start(self):
-            header = self._readline().decode('utf8')
+            self._set_request_start(self._readline())
+            
+        def _set_request_start(self, header):
+            header = header.decode('utf8')
             try:
                 method, path, http = header.strip().split(' ')
                 self.method, self.path, self.http = method, path, http
             except Exception:
                 raise ParseError('invalid request header')
             
+        # Returns size of body, or None if body is chunked
+        # Returns 0 if request has no body
+        def _body_size(self):
+            if self.method.upper() != 'POST':
+                return 0
+            if 'content-length' in self.headers:
+                return int(self.headers['content-length'])
+            elif 'transfer-encoding' in self.headers:
+                encoding = self.headers['transfer-encoding']
+                if encoding != 'chunked':
+                    raise ParseError('unsupported transfer encoding')
+                return None
+            else:
+                raise ParseError('cannot read body')
+            
         def _parse_body(self):
             if self.method.upper() == 'POST':
-                if 'content-length' in self.headers:
-                    size = int(self.headers['content-length'])
-                    data = self._safe_read(size)
-                    self.body = data
-                elif 'transfer-encoding' in self.headers:
-                    encoding = self.headers['transfer-encoding']
-                    if encoding != 'chunked':
-                        raise ParseError('unsupported transfer encoding')
-                    
-                    data = self._chunked_read()
-                    self.body = data
+                size = self._body_size()
+                if size is None:
+                    self.body = self._chunked_read()
                 else:
-                    raise ParseError('cannot read body')
+                    self.body = self._safe_read(size)
                 
         def parse_request(self):
             self._init()
@@ -601,6 +797,59 @@ class Server(threading.Thread):
         
         def get_body(self):
             return self.body
+        
+    # Request parser reading from asyncio stream in asyncio serving mode
+    # Line length is limited to LINE_MAX_SIZE by limit of the stream reader
+    class _AsyncRequestParser(_RequestParser):
+        def __init__(self, reader):
+            # stream reader does buffering, so no receive buffer here
+            self.conn = None
+            self.reader = reader
+            
+        async def _areadline(self):
+            try:
+                return await self.reader.readline()
+            except ValueError:
+                raise ParseError('request line too long')
+            
+        async def _asafe_read(self, size):
+            try:
+                return await self.reader.readexactly(size)
+            except asyncio.IncompleteReadError:
+                raise ParseError('connection closed while '
+                                 'expected bytes are left')
+            
+        async def _achunked_read(self):
+            chunks = []
+            
+            while True:
+                chunk_size = self._chunk_size(await self._areadline())
+                
+                if not chunk_size:
+                    # read CRLF
+                    await self._asafe_read(2)
+                    break
+                
+                chunk = await self._asafe_read(chunk_size)
+                # read CRLF in the end of chunk
+                await self._asafe_read(2)
+                chunks.append(chunk)
+                
+            # We assume there is no any trailer
+            return b''.join(chunks)
+        
+        async def parse_request(self):
+            self._init()
+            self._set_request_start(await self._areadline())
+            self._parse_get()
+            while self._add_header(await self._areadline()):
+                pass
+            if self.method.upper() == 'POST':
+                size = self._body_size()
+                if size is None:
+                    self.body = await self._achunked_read()
+                else:
+                    self.body = await self._asafe_read(size)
 
 E_UNKNOWNR = 0     
 E_PARSE_ERROR = 1       # Error during request parsing
@@ -627,10 +876,12 @@ class WorkError(Error):
         Error.__init__(self, msg, E_WORK_ERROR)
         
 if __name__ == '__main__':
-    import time
+    import time, sys
     # Start server
+    # serving mode can be given as argument ('thread' or 'async')
     print('Pentakill Update Server 1.0')
-    server = UpdateServer()
+    mode = sys.argv[1] if len(sys.argv) > 1 else MODE
+    server = UpdateServer(mode=mode)
     server.init()
     server.start()
     print('Server started')
@@ -18,7 +18,7 @@ from pentakill.db import connector
 from pentakill.db import error as dbError
 from pentakill.update import constant, util
 from pentakill.lib import servant, progress_note, error
-import threading, traceback
+import threading, traceback, time
 
 # Simple configuration
 T_WAIT = 22.0      # timeout for api data
@@ -136,6 +136,7 @@ class UpdateModule(object):
                     elif cmd == self.module.CMD_RUNEMASTERY:
                         id = req[1]
                         updator = self.module.getRuneMasteryUpdator()
+                        updator.set_priority(lolfastapi.PR_BACKGROUND)
                         updator.init()
                         updator.put_data({'id':id})
                         updator.update()
@@ -223,6 +224,8 @@ class PentakillUpdator(Updator):
         self.api = module.api
         self.db = None
         self.trial = trial
+        # priority class of API requests
+        self.priority = lolfastapi.PR_NORMAL
         self.data = None
         self.prog = progress_note.ProgressNote()
         
@@ -341,21 +344,30 @@ class PentakillUpdator(Updator):
             self.db.close()
             self.db = None
         
+    # Returns FastRequest whose requests not sent within T_WAIT are dropped
+    # Nobody waits for their responses after T_WAIT, so they should not
+    # take permits.
+    def _make_request(self):
+        return lolfastapi.FastRequest(self.priority, time.time() + T_WAIT)
+    
+    # On timeout, requests not sent yet are cancelled not to use quota
     def _wait_response(self, respond):
         if not respond.wait_response(T_WAIT):
+            respond.cancel()
             raise error.APITimeout("Sever do not respond too long")
         
     def _wait_target_response(self, respond, list):
         try:
             ret = respond.wait_target_response(list, T_WAIT)
         except lolfastapi.TimeoutError:
+            respond.cancel()
             raise error.APITimeout("Sever do not respond too long")
         else:
             return ret
         
     # Check fastResponse response code and status code
     def _check_response(self, res, notfound=True):
-        if res[0] == lolfastapi.FS_TIMEOUT:
+        if res[0] in (lolfastapi.FS_TIMEOUT, lolfastapi.FS_CANCELLED):
             raise error.APITimeout("Sever do not respond too long")
         elif res[0] == lolfastapi.FS_SERVICE_UNAVAILABLE:
             raise error.APIUnavailable("Server is not available now")
@@ -375,6 +387,11 @@ class PentakillUpdator(Updator):
     def set_debug(self, level=True):
         self.debug = level
         
+    # priority : priority class of API requests, one of lolfastapi.PR_* value
+    # (e.g. PR_INTERACTIVE when user is waiting for the update)
+    def set_priority(self, priority):
+        self.priority = priority
+        
     def _get_game_query(self):
         query1 = ("insert into games (game_id, create_date, time_played, "
                   "game_mode, game_type, sub_type) "
@@ -462,10 +479,13 @@ class SummonerUpdator(PentakillUpdator):
         self.module.orderRuneMasteryUpdate(self.data['id'])
         return True
     
+    # Requests of update are sent as bundle, so that update is not left
+    # half fetched when quota runs out
     def _get_api_response(self, summoner_by_id=False):
         id = self.data['id']
         
-        reqs = lolfastapi.FastRequest()
+        reqs = self._make_request()
+        reqs.set_bundle()
         if summoner_by_id:
             reqs.add_request_name('summoner', (lolapi.LOLAPI.get_summoners_by_ids, (id,)))        
         reqs.add_request_name('leagues', (lolapi.LOLAPI.get_league_entries, (id,)))
@@ -479,7 +499,8 @@ class SummonerUpdator(PentakillUpdator):
     def _get_api_data(self, summoner_by_id=False):
         id = self.data['id']
         
-        reqs = lolfastapi.FastRequest()
+        reqs = self._make_request()
+        reqs.set_bundle()
         if summoner_by_id:
             reqs.add_request_name('summoner', (lolapi.LOLAPI.get_summoners_by_ids, (id,)))
         reqs.add_request_name('leagues', (lolapi.LOLAPI.get_league_entries, (id,)))
@@ -502,7 +523,7 @@ class SummonerUpdator(PentakillUpdator):
         name = Util.transform_names(data['name'])
         data['name'] = name
         
-        reqs = lolfastapi.FastRequest()
+        reqs = self._make_request()
         reqs.add_request_name('summoner', (lolapi.LOLAPI.get_summoners_by_names, (name,)))
         
         response = self.api.get_multiple_data(reqs)
@@ -863,7 +884,7 @@ class RuneMasteryUpdator(PentakillUpdator):
     def _get_api_data(self):
         id = self.data['id']
         
-        reqs = lolfastapi.FastRequest()
+        reqs = self._make_request()
         reqs.add_request_name('runes', (lolapi.LOLAPI.get_summoner_runes, (id,)))
         reqs.add_request_name('masteries', (lolapi.LOLAPI.get_summoner_masteries, (id,)))
         
@@ -995,7 +1016,7 @@ class MatchUpdator(PentakillUpdator):
     def _get_match_data(self):
         id = self.data['id']
         
-        reqs = lolfastapi.FastRequest()
+        reqs = self._make_request()
         reqs.add_request_name('match', (lolapi.LOLAPI.get_match, (id, 'true')))
         
         response = self.api.get_multiple_data(reqs)
@@ -1203,7 +1224,7 @@ class MatchUpdator(PentakillUpdator):
                  "live = values(live)")
         
         ids = Util.list_to_str(lids)
-        reqs = lolfastapi.FastRequest()
+        reqs = self._make_request()
         reqs.add_request_name('summoners', (lolapi.LOLAPI.get_summoners_by_ids, (ids,)))
         
         response = self.api.get_multiple_data(reqs)